@@ -1,26 +1,80 @@
 # Recycled from Ominicontrol 
 
+import argparse
+import os
+import queue
+import time
 import gradio as gr
 import torch
 from PIL import Image
 from diffusers.pipelines import FluxPipeline
 from diffusers import FluxTransformer2DModel
 
+from flux.cache import LatentCache, PromptCache, StepCache
 from flux.condition import Condition
-from flux.generate import generate
-from flux.lora_controller import set_lora_scale
+from flux.generate import GenerationRequest, generate_batch
+from flux.lora_controller import FusedLoRA
+from flux.adapters import AdapterPool
+from flux.serving import BatchingServer
+from flux.memory import MemoryTracer
+from flux.snapshot import SNAPSHOT_FILE, load_snapshot, save_snapshot
+from flux.staging import GenerationStages, StagedExecutor
+from flux.streaming import stream_blocks
+from flux.tiling import VAETiling
 
 pipe = None
+fused_lora = None
+adapter_pool = None
+executor = None
+block_streamer = None
+# the adapter at its trained scale, as the demo always ran: its former
+# `set_lora_scale(["subject"], scale=3.0)` got adapter names instead of LoRA
+# layers and scaled nothing
+lora_scale = 1.0
+# LoRA weights per condition type, preloaded in host memory
+adapter_paths = {
+    "subject": "weights/zen2con_1440_17000/pytorch_lora_weights.safetensors",
+}
+latent_cache = LatentCache(max_bytes=512 * 1024**2)
+prompt_cache = PromptCache(cache_dir=os.environ.get("PROMPT_CACHE_DIR"))
+# opt-in step skipping, e.g. STEP_CACHE_THRESHOLD=0.1 (only used by the server worker)
+step_cache = (
+    StepCache(float(os.environ["STEP_CACHE_THRESHOLD"]))
+    if os.environ.get("STEP_CACHE_THRESHOLD")
+    else None
+)
+# opt-in Chrome traces with memory accounting of every batch, e.g. TRACE_DIR=traces
+trace_dir = os.environ.get("TRACE_DIR")
+if trace_dir:
+    os.makedirs(trace_dir, exist_ok=True)
+# encode the conditions at this resolution whatever the `size` slider, e.g.
+# CONDITION_RESOLUTION=512 (4x fewer condition tokens than at 1024)
+condition_resolution = int(os.environ.get("CONDITION_RESOLUTION", 0)) or None
+# drop the condition tokens of the white background pasted around cut-outs
+prune_background = os.environ.get("PRUNE_BACKGROUND", "0") == "1"
+# overlap the condition/prompt encoding and the VAE decode of consecutive
+# batches with the denoising, STAGED_EXECUTION=1 (not traced)
+staged_execution = os.environ.get("STAGED_EXECUTION", "0") == "1"
+# tiled VAE encode/decode above the tile this activation budget allows, e.g.
+# VAE_MEMORY_BUDGET_MB=4096 (the tile size is measured on the GPU at startup)
+vae_memory_budget = int(os.environ.get("VAE_MEMORY_BUDGET_MB", 0)) * 1024**2
+# assembled pipeline written by `--snapshot`, loaded instead of assembling it
+snapshot_dir = os.environ.get("SNAPSHOT_DIR")
+# keep the transformer blocks in host memory (memory-mapped with SNAPSHOT_DIR)
+# and stream them to the GPU, instead of the int8 checkpoint on small GPUs
+block_streaming = os.environ.get("BLOCK_STREAMING", "0") == "1"
 use_int8 = False
-model_config = { "union_cond_attn": True, "add_cond_attn": False, "latent_lora": False, "independent_condition": False}
+model_config = { "union_cond_attn": True, "add_cond_attn": False, "latent_lora": False, "independent_condition": False, "fuse_streams": False}
 
 def get_gpu_memory():
     return torch.cuda.get_device_properties(0).total_memory / 1024**3
 
 
 def init_pipeline():
-    global pipe
-    if use_int8 or get_gpu_memory() < 33:
+    global pipe, fused_lora, adapter_pool, block_streamer
+    if snapshot_dir and os.path.exists(os.path.join(snapshot_dir, SNAPSHOT_FILE)):
+        pipe = load_snapshot(snapshot_dir)
+    elif not block_streaming and (use_int8 or get_gpu_memory() < 33):
         transformer_model = FluxTransformer2DModel.from_pretrained(
             "sayakpaul/flux.1-schell-int8wo-improved",
             torch_dtype=torch.bfloat16,
@@ -35,12 +89,29 @@ def init_pipeline():
         pipe = FluxPipeline.from_pretrained(
             "black-forest-labs/FLUX.1-schnell", torch_dtype=torch.bfloat16
         )
-    pipe = pipe.to("cuda")
+    if block_streaming:
+        block_streamer = stream_blocks(pipe, "cuda", pin_memory=not snapshot_dir)
+    else:
+        pipe = pipe.to("cuda")
+    if vae_memory_budget:
+        VAETiling(vae_memory_budget).apply(pipe.vae)
     
-    # Optional: Load additional LoRA weights, put the loaded weigths here!
-    pipe.load_lora_weights("weights/zen2con_1440_17000/pytorch_lora_weights.safetensors",
-        adapter_name="subject")
-    pipe.set_adapters(["subject"])
+    # Optional: Load additional LoRA weights, put the loaded weigths in `adapter_paths`!
+    # The active adapter is baked into the weights, the image stream keeps the
+    # unmerged copies it needs
+    # (not with streamed blocks, their weights are swapped at every use)
+    fused_lora = (
+        None
+        if block_streaming
+        else FusedLoRA(pipe.transformer, latent_lora=model_config["latent_lora"])
+    )
+    adapter_pool = AdapterPool(pipe, fused_lora=fused_lora, lora_scale=lora_scale, pin_memory=True)
+    for adapter_name, path in adapter_paths.items():
+        adapter_pool.preload(adapter_name, path)
+    # adapters restored from the snapshot are already in the transformer
+    for adapter_name in getattr(pipe.transformer, "peft_config", {}):
+        adapter_pool.loaded[adapter_name] = None
+    adapter_pool.activate("subject")
     
 def paste_on_white_background(image: Image.Image) -> Image.Image:
     """
@@ -55,6 +126,29 @@ def paste_on_white_background(image: Image.Image) -> Image.Image:
     return white_bg.convert("RGB")  # Convert back to RGB if you don't need alpha
 
 
+def run_batch(requests, **params):
+    # called from the server worker, which owns the pipeline (or hands it to
+    # the executor)
+    global executor
+    if pipe is None:
+        init_pipeline()
+    runtime = dict(adapter_pool=adapter_pool, block_streamer=block_streamer)
+    if staged_execution and not trace_dir:
+        if executor is None:
+            stages = GenerationStages(pipe, latent_cache, prompt_cache)
+            executor = StagedExecutor(stages.run, stages.prepare, stages.finish)
+        return executor.submit((requests, dict(params, **runtime)))
+    if not trace_dir:
+        return generate_batch(pipe, requests, **runtime, **params).images
+    with MemoryTracer(synchronize=True) as tracer:
+        images = generate_batch(pipe, requests, tracer=tracer, **runtime, **params).images
+    tracer.save(os.path.join(trace_dir, f"trace_{time.time_ns()}.json"))
+    return images
+
+
+server = BatchingServer(run_batch, max_batch_size=4, max_wait=0.05)
+
+
 def process_image_and_text(image, text, steps=8, strength_sub=1.0, strength_spat=1.0, size=1024):
     # center crop image
     w, h, min_size = image.size[0], image.size[1], min(image.size)
@@ -68,26 +162,41 @@ def process_image_and_text(image, text, steps=8, strength_sub=1.0, strength_spat
     )
     image = image.resize((size, size))
     image = paste_on_white_background(image) #Optional, you can remove this line if you want just make sure the size it matched.
-    condition0 = Condition("subject", image, position_delta=(0, size // 16))
-    condition1 = Condition("subject", image, position_delta=(0, -size // 16))
-    
-    if pipe is None:
-        init_pipeline()
+    # the ids of downscaled conditions are scaled to the 1024 output grid
+    grid = (1024 if condition_resolution else size) // 16
+    condition0 = Condition("subject", image, position_delta=(0, grid))
+    condition1 = Condition("subject", image, position_delta=(0, -grid))
     
-    with set_lora_scale(["subject"], scale=3.0):
-        result_img = generate(
-            pipe,
-            prompt=text.strip(),
-            conditions=[condition0, condition1],
-            num_inference_steps=steps,
-            height=1024,
-            width=1024,
-            condition_scale = [strength_sub,strength_spat],
-            model_config=model_config,
-            default_lora=True,
-        ).images[0]
-
-    return [condition0.condition, condition1.condition, result_img]
+    # previews of every step but the last one, streamed until the result
+    previews = queue.Queue()
+    request = GenerationRequest(
+        text.strip(),
+        conditions=[condition0, condition1],
+        condition_scale=[strength_sub, strength_spat],
+        on_preview=lambda step, preview: previews.put(preview),
+    )
+    future = server.start().submit(
+        request,
+        num_inference_steps=int(steps),
+        height=1024,
+        width=1024,
+        model_config=model_config,
+        default_lora=True,
+        latent_cache=latent_cache,
+        prompt_cache=prompt_cache,
+        step_cache=step_cache,
+        condition_resolution=condition_resolution,
+        prune_background=prune_background,
+        preview_steps=list(range(int(steps) - 1)),
+    )
+    while not future.done():
+        try:
+            preview = previews.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        yield [condition0.condition, condition1.condition, preview]
+
+    yield [condition0.condition, condition1.condition, future.result()]
 
 
 def get_samples():
@@ -116,10 +225,23 @@ demo = gr.Interface(
             ),
     title="ZenCtrl / Subject driven generation",
     examples=get_samples(),
+    # let concurrent users reach the server so they can share a batch
+    concurrency_limit=server.max_batch_size,
 )
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--snapshot",
+        metavar="DIR",
+        help="write the assembled pipeline to DIR (see SNAPSHOT_DIR) and exit",
+    )
+    args = parser.parse_args()
     init_pipeline()
+    if args.snapshot:
+        save_snapshot(pipe, args.snapshot, fused_lora)
+        raise SystemExit
+    server.start()
     demo.launch(
         debug=True,
         # share=True
@@ -0,0 +1,341 @@
+"""
+CPU micro-benchmarks of the transformer hot paths: `tranformer_forward`,
+`block_forward` and `attn_forward` (their fused variants under
+`fuse_streams`) on a tiny `FluxTransformer2DModel`, across image token
+counts, condition counts, attention modes and `condition_scale` on/off.
+
+Run from the repository root, the timings are written as JSON:
+
+    python -m benchmarks.forward --output bench.json
+    python -m benchmarks.forward --baseline bench.json --tolerance 0.2
+
+With `--baseline` every case slower than the baseline by more than
+`tolerance` is reported and the exit code is 1.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import torch
+from typing import Any, Callable, Dict, List, Optional
+from diffusers import FluxTransformer2DModel
+
+from flux.block import (
+    attn_forward,
+    block_forward,
+    fused_attn_forward,
+    fused_block_forward,
+)
+from flux.embeddings import pack_rotary_emb
+from flux.layout import AttentionLayout
+from flux.transformer import tranformer_forward
+
+# model_config of each attention mode, `add_cond_attn` needs conditions as
+# large as the image
+MODES = {
+    "union": {"union_cond_attn": True},
+    "separate": {"union_cond_attn": False},
+    "independent": {"union_cond_attn": True, "independent_condition": True},
+    "dense": {"union_cond_attn": True, "dense_attention_mask": True},
+    "add_cond": {"union_cond_attn": True, "add_cond_attn": True},
+    "fused": {"union_cond_attn": True, "fuse_streams": True},
+}
+TARGETS = ("transformer", "block", "attn")
+
+
+def tiny_transformer(
+    num_layers: int = 2,
+    num_single_layers: int = 2,
+    heads: int = 4,
+    head_dim: int = 32,
+    seed: int = 0,
+) -> FluxTransformer2DModel:
+    torch.manual_seed(seed)
+    return FluxTransformer2DModel(
+        patch_size=1,
+        in_channels=64,
+        num_layers=num_layers,
+        num_single_layers=num_single_layers,
+        attention_head_dim=head_dim,
+        num_attention_heads=heads,
+        joint_attention_dim=64,
+        pooled_projection_dim=64,
+        guidance_embeds=False,
+        axes_dims_rope=(head_dim // 4, 3 * head_dim // 8, 3 * head_dim // 8),
+    ).eval()
+
+
+def latent_ids(side: int, offset: int = 0) -> torch.Tensor:
+    ids = torch.zeros(side, side, 3)
+    ids[..., 1] = torch.arange(side)[:, None]
+    ids[..., 2] = torch.arange(side)[None, :] + offset
+    return ids.reshape(-1, 3)
+
+
+def measure(fn: Callable[[], Any], warmup: int, repeat: int) -> Dict[str, float]:
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        "median_ms": statistics.median(times),
+        "min_ms": min(times),
+        "repeat": repeat,
+    }
+
+
+def make_case(
+    transformer: FluxTransformer2DModel,
+    target: str,
+    side: int,
+    condition_count: int,
+    model_config: Dict[str, Any],
+    condition_scale: Optional[List[float]],
+    batch_size: int = 1,
+    text_n: int = 16,
+) -> Callable[[], Any]:
+    """
+    Returns a closure running one call of `target` on random inputs.
+    """
+    config = transformer.config
+    inner_dim = config.num_attention_heads * config.attention_head_dim
+    image_n = side * side
+    condition_sizes = [image_n] * condition_count
+    use_condition = condition_count > 0
+    fuse_streams = use_condition and model_config.get("fuse_streams", False)
+
+    txt_ids = torch.zeros(text_n, 3)
+    img_ids = latent_ids(side)
+    condition_ids = (
+        torch.cat([latent_ids(side, side * (i + 1)) for i in range(condition_count)])
+        if use_condition
+        else None
+    )
+    layout = (
+        AttentionLayout(
+            text_n=text_n,
+            image_n=image_n,
+            condition_sizes=condition_sizes,
+            model_config=model_config,
+            condition_scale=condition_scale,
+        )
+        if use_condition
+        else None
+    )
+
+    if target == "transformer":
+        params = dict(
+            hidden_states=torch.randn(batch_size, image_n, config.in_channels),
+            encoder_hidden_states=torch.randn(
+                batch_size, text_n, config.joint_attention_dim
+            ),
+            pooled_projections=torch.randn(batch_size, config.pooled_projection_dim),
+            timestep=torch.full((batch_size,), 0.5),
+            img_ids=img_ids,
+            txt_ids=txt_ids,
+            return_dict=False,
+        )
+        condition_latents = (
+            torch.randn(batch_size, image_n * condition_count, config.in_channels)
+            if use_condition
+            else None
+        )
+        return lambda: tranformer_forward(
+            transformer,
+            condition_latents=condition_latents,
+            condition_ids=condition_ids,
+            condition_type_ids=None,
+            condition_sizes=condition_sizes,
+            model_config=model_config,
+            attention_layout=layout,
+            **params,
+        )
+
+    hidden_states = torch.randn(batch_size, image_n, inner_dim)
+    encoder_hidden_states = torch.randn(batch_size, text_n, inner_dim)
+    condition_latents = (
+        torch.randn(batch_size, image_n * condition_count, inner_dim)
+        if use_condition
+        else None
+    )
+    image_rotary_emb = transformer.pos_embed(torch.cat((txt_ids, img_ids), dim=0))
+    cond_rotary_emb = transformer.pos_embed(condition_ids) if use_condition else None
+    block = transformer.transformer_blocks[0]
+
+    if target == "block":
+        temb = torch.randn(batch_size, inner_dim)
+        block_fn = fused_block_forward if fuse_streams else block_forward
+        kwargs = (
+            {"packed_rotary_emb": pack_rotary_emb(image_rotary_emb, cond_rotary_emb)}
+            if fuse_streams
+            else {}
+        )
+        return lambda: block_fn(
+            block,
+            hidden_states=hidden_states,
+            encoder_hidden_states=encoder_hidden_states,
+            condition_latents=condition_latents,
+            temb=temb,
+            cond_temb=temb if use_condition else None,
+            cond_rotary_emb=cond_rotary_emb,
+            image_rotary_emb=image_rotary_emb,
+            model_config=model_config,
+            attention_layout=layout,
+            **kwargs,
+        )
+
+    if fuse_streams:
+        packed = torch.cat([hidden_states, condition_latents], dim=1)
+        rotary_emb = pack_rotary_emb(image_rotary_emb, cond_rotary_emb)
+        return lambda: fused_attn_forward(
+            block.attn,
+            packed,
+            image_n,
+            layout,
+            encoder_hidden_states=encoder_hidden_states,
+            rotary_emb=rotary_emb,
+            model_config=model_config,
+        )
+    return lambda: attn_forward(
+        block.attn,
+        hidden_states=hidden_states,
+        encoder_hidden_states=encoder_hidden_states,
+        condition_latents=condition_latents,
+        image_rotary_emb=image_rotary_emb,
+        cond_rotary_emb=cond_rotary_emb,
+        model_config=model_config,
+        attention_layout=layout,
+    )
+
+
+def run(
+    sides: List[int],
+    condition_counts: List[int],
+    modes: List[str],
+    targets: List[str],
+    warmup: int = 2,
+    repeat: int = 5,
+    **transformer_kwargs: dict,
+) -> List[Dict[str, Any]]:
+    transformer = tiny_transformer(**transformer_kwargs)
+    results = []
+    with torch.inference_mode():
+        for target in targets:
+            for side in sides:
+                for condition_count in condition_counts:
+                    # the modes and scales only matter with conditions
+                    case_modes = modes if condition_count else ["none"]
+                    scales = [False, True] if condition_count else [False]
+                    for mode in case_modes:
+                        for scaled in scales:
+                            condition_scale = (
+                                [0.8 + 0.2 * i for i in range(condition_count)]
+                                if scaled
+                                else None
+                            )
+                            fn = make_case(
+                                transformer,
+                                target,
+                                side,
+                                condition_count,
+                                MODES.get(mode, {}),
+                                condition_scale,
+                            )
+                            results.append(
+                                {
+                                    "target": target,
+                                    "image_n": side * side,
+                                    "conditions": condition_count,
+                                    "mode": mode,
+                                    "condition_scale": scaled,
+                                    **measure(fn, warmup, repeat),
+                                }
+                            )
+    return results
+
+
+def case_key(result: Dict[str, Any]) -> tuple:
+    return tuple(
+        result[key]
+        for key in ("target", "image_n", "conditions", "mode", "condition_scale")
+    )
+
+
+def regressions(
+    results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float
+) -> List[Dict[str, Any]]:
+    """
+    Returns the cases whose median is more than `tolerance` slower than in
+    the baseline, with the ratio of the two medians.
+    """
+    reference = {case_key(each): each for each in baseline}
+    slower = []
+    for each in results:
+        base = reference.get(case_key(each))
+        if base is None:
+            continue
+        ratio = each["median_ms"] / base["median_ms"]
+        if ratio > 1 + tolerance:
+            slower.append(dict(each, ratio=ratio))
+    return slower
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="benchmark_forward.json")
+    parser.add_argument("--sides", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--conditions", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--targets", nargs="+", default=list(TARGETS), choices=TARGETS)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    results = run(
+        args.sides,
+        args.conditions,
+        args.modes,
+        args.targets,
+        warmup=args.warmup,
+        repeat=args.repeat,
+    )
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"{len(results)} cases written to {args.output}")
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    slower = regressions(results, baseline, args.tolerance)
+    for each in slower:
+        print(
+            "slower x{ratio:.2f}: {target} image_n={image_n} conditions={conditions} "
+            "mode={mode} condition_scale={condition_scale} "
+            "({median_ms:.3f} ms)".format(**each)
+        )
+    return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import torch
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple, Union
+from diffusers.pipelines import FluxPipeline
+
+from .cache import LRUCache
+from .lora_controller import FusedLoRA, lora_registry
+
+
+class AdapterPool(LRUCache):
+    """
+    LoRA weight sets of the condition types (`subject`, `sr`, `cot`) kept in
+    host memory, so switching the adapter of a request never reads the disk.
+    The state dicts are evicted least-recently-used under `max_bytes`, an
+    evicted adapter is read again from its source when needed.
+
+    At most `max_loaded` adapters are loaded in the transformer at once, a
+    switch between loaded adapters is only a `set_adapters`. With a
+    `fused_lora`, the active adapter is merged at `lora_scale` after each
+    switch. Only the transformer layers of the adapters are loaded.
+    """
+
+    def __init__(
+        self,
+        pipeline: FluxPipeline,
+        max_bytes: int = 4 << 30,
+        max_loaded: int = 3,
+        fused_lora: Optional[FusedLoRA] = None,
+        lora_scale: float = 1.0,
+        pin_memory: bool = False,
+    ) -> None:
+        super().__init__(max_bytes)
+        self.pipeline = pipeline
+        self.max_loaded = max_loaded
+        self.fused_lora = fused_lora
+        self.lora_scale = lora_scale
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.sources: Dict[str, Tuple[Any, Dict[str, Any]]] = {}
+        self.loaded: "OrderedDict[str, None]" = OrderedDict()
+        self.active: Optional[str] = None
+        self.disk_reads = 0
+        self.loads = 0
+        self.switches = 0
+
+    def preload(
+        self,
+        adapter_name: str,
+        source: Union[str, Dict[str, torch.Tensor]],
+        **kwargs: dict,
+    ) -> None:
+        """
+        Reads the LoRA weights of `adapter_name` (a path, hub id or state
+        dict, `kwargs` go to `lora_state_dict`) into host memory.
+        """
+        self.sources[adapter_name] = (source, kwargs)
+        self.put(adapter_name, self.read(adapter_name))
+
+    def read(self, adapter_name: str) -> Tuple[Dict[str, torch.Tensor], Optional[Dict]]:
+        source, kwargs = self.sources[adapter_name]
+        if not isinstance(source, dict):
+            self.disk_reads += 1
+        state_dict, network_alphas = self.pipeline.lora_state_dict(
+            source, return_alphas=True, **kwargs
+        )
+        state_dict = {
+            key: value.detach().to("cpu", copy=True) for key, value in state_dict.items()
+        }
+        if self.pin_memory:
+            state_dict = {key: value.pin_memory() for key, value in state_dict.items()}
+        return state_dict, network_alphas
+
+    def weights(self, adapter_name: str) -> Tuple[Dict[str, torch.Tensor], Optional[Dict]]:
+        weights = self.get(adapter_name)
+        if weights is None:
+            if adapter_name not in self.sources:
+                raise KeyError(f"Adapter {adapter_name} was not preloaded")
+            weights = self.read(adapter_name)
+            self.put(adapter_name, weights)
+        return weights
+
+    def activate(self, adapter_name: str) -> None:
+        """
+        Makes `adapter_name` the only active adapter, loading it from host
+        memory if it is not in the transformer.
+        """
+        if adapter_name == self.active:
+            return
+        if self.fused_lora is not None:
+            self.fused_lora.deactivate()
+        if adapter_name not in self.loaded:
+            state_dict, network_alphas = self.weights(adapter_name)
+            while len(self.loaded) >= self.max_loaded:
+                evicted, _ = self.loaded.popitem(last=False)
+                self.pipeline.delete_adapters(evicted)
+            self.pipeline.load_lora_into_transformer(
+                dict(state_dict),
+                network_alphas=network_alphas,
+                transformer=self.pipeline.transformer,
+                adapter_name=adapter_name,
+                _pipeline=self.pipeline,
+            )
+            self.loaded[adapter_name] = None
+            self.loads += 1
+        self.loaded.move_to_end(adapter_name)
+        self.pipeline.set_adapters(adapter_name)
+        lora_registry(self.pipeline.transformer)
+        if self.fused_lora is not None:
+            self.fused_lora.activate(self.lora_scale)
+        self.active = adapter_name
+        self.switches += 1
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            **super().stats,
+            "loaded": len(self.loaded),
+            "loads": self.loads,
+            "switches": self.switches,
+            "disk_reads": self.disk_reads,
+        }
@@ -1,24 +1,54 @@
-# Recycled from Ominicontrol and modified to accept an extra condition.
-# While Zenctrl pursued a similar idea, it diverged structurally. 
+# Recycled from Ominicontrol and modified to accept several conditions.
+# While Zenctrl pursued a similar idea, it diverged structurally.
 # We appreciate the clarity of Omini's implementation and decided to align with it.
 
 import torch
 from typing import Optional, Dict, Any
 from diffusers.models.attention_processor import Attention, F
-from .lora_controller import enable_lora
+from .lora_controller import enable_lora, packed_linear
+from .cache import ConditionKVCache
+from .layout import AttentionLayout
+from .embeddings import pack_rotary_emb
+from .memory import count_transient
 from diffusers.models.embeddings import apply_rotary_emb
 
+
+def segmented_attention(
+    query: torch.FloatTensor,
+    key: torch.FloatTensor,
+    value: torch.FloatTensor,
+    attention_layout: AttentionLayout,
+) -> torch.FloatTensor:
+    """
+    Attention with the segment bias of the layout folded into extra query and
+    key channels instead of a dense mask, so SDPA keeps its fused kernels.
+    """
+    batch_size, heads, query_n, head_dim = query.shape
+    query_bias, key_select = attention_layout.folded_bias(head_dim)
+    query = torch.cat(
+        [query, query_bias[:, :, :query_n].expand(batch_size, heads, -1, -1)], dim=-1
+    )
+    key = torch.cat([key, key_select.expand(batch_size, heads, -1, -1)], dim=-1)
+    # the fused kernels want the same head dim for the values
+    value = F.pad(value, (0, key_select.shape[-1]))
+    count_transient("segmented_qkv", query, key, value)
+    hidden_states = F.scaled_dot_product_attention(
+        query, key, value, dropout_p=0.0, is_causal=False, scale=head_dim**-0.5
+    )
+    return hidden_states[..., :head_dim]
+
+
 def attn_forward(
     attn: Attention,
     hidden_states: torch.FloatTensor,
     encoder_hidden_states: torch.FloatTensor = None,
     condition_latents: torch.FloatTensor = None,
-    extra_condition_latents: torch.FloatTensor = None,
     attention_mask: Optional[torch.FloatTensor] = None,
     image_rotary_emb: Optional[torch.Tensor] = None,
     cond_rotary_emb: Optional[torch.Tensor] = None,
-    extra_cond_rotary_emb: Optional[torch.Tensor] = None,
     model_config: Optional[Dict[str, Any]] = {},
+    kv_cache: Optional[ConditionKVCache] = None,
+    attention_layout: Optional[AttentionLayout] = None,
 ) -> torch.FloatTensor:
     batch_size, _, _ = (
         hidden_states.shape
@@ -78,11 +108,11 @@ def attn_forward(
         value = torch.cat([encoder_hidden_states_value_proj, value], dim=2)
 
     if image_rotary_emb is not None:
-        
-
         query = apply_rotary_emb(query, image_rotary_emb)
         key = apply_rotary_emb(key, image_rotary_emb)
 
+    # all the conditions are packed in one stream, the layout knows where
+    # each of them starts
     if condition_latents is not None:
         cond_query = attn.to_q(condition_latents)
         cond_key = attn.to_k(condition_latents)
@@ -99,108 +129,61 @@ def attn_forward(
             cond_query = attn.norm_q(cond_query)
         if attn.norm_k is not None:
             cond_key = attn.norm_k(cond_key)
-    
-    #extra condition
-    if extra_condition_latents is not None:
-        extra_cond_query = attn.to_q(extra_condition_latents)
-        extra_cond_key = attn.to_k(extra_condition_latents)
-        extra_cond_value = attn.to_v(extra_condition_latents)
-
-        extra_cond_query = extra_cond_query.view(batch_size, -1, attn.heads, head_dim).transpose(
-            1, 2
-        )
-        extra_cond_key = extra_cond_key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-        extra_cond_value = extra_cond_value.view(batch_size, -1, attn.heads, head_dim).transpose(
-            1, 2
-        )
-        if attn.norm_q is not None:
-            extra_cond_query = attn.norm_q(extra_cond_query)
-        if attn.norm_k is not None:
-            extra_cond_key = attn.norm_k(extra_cond_key)
-
 
-    if extra_cond_rotary_emb is not None:
-        extra_cond_query = apply_rotary_emb(extra_cond_query, extra_cond_rotary_emb)
-        extra_cond_key = apply_rotary_emb(extra_cond_key, extra_cond_rotary_emb)
-
-    if cond_rotary_emb is not None:
-        cond_query = apply_rotary_emb(cond_query, cond_rotary_emb)
-        cond_key = apply_rotary_emb(cond_key, cond_rotary_emb)
-
-    if condition_latents is not None:
-        if extra_condition_latents is not None:
-            
-            query = torch.cat([query, cond_query, extra_cond_query], dim=2)
-            key = torch.cat([key, cond_key, extra_cond_key], dim=2)
-            value = torch.cat([value, cond_value, extra_cond_value], dim=2)
-        else:
-            query = torch.cat([query, cond_query], dim=2)
-            key = torch.cat([key, cond_key], dim=2)
-            value = torch.cat([value, cond_value], dim=2)
-            print("concat Omini latents: ", query.shape, key.shape, value.shape)
-
-        
-    if not model_config.get("union_cond_attn", True):
-        
-        attention_mask = torch.ones(
-            query.shape[2], key.shape[2], device=query.device, dtype=torch.bool
-        )
-        condition_n = cond_query.shape[2]
-        attention_mask[-condition_n:, :-condition_n] = False
-        attention_mask[:-condition_n, -condition_n:] = False
-    elif model_config.get("independent_condition", False):
-        attention_mask = torch.ones(
-            query.shape[2], key.shape[2], device=query.device, dtype=torch.bool
+        if cond_rotary_emb is not None:
+            cond_query = apply_rotary_emb(cond_query, cond_rotary_emb)
+            cond_key = apply_rotary_emb(cond_key, cond_rotary_emb)
+
+        query = torch.cat([query, cond_query], dim=2)
+        key = torch.cat([key, cond_key], dim=2)
+        value = torch.cat([value, cond_value], dim=2)
+        if kv_cache is not None:
+            kv_cache.store(attn, cond_key, cond_value)
+    elif kv_cache is not None and attn in kv_cache:
+        # replay the condition keys/values recorded on the first step
+        cond_key, cond_value = kv_cache.load(attn)
+        key = torch.cat([key, cond_key], dim=2)
+        value = torch.cat([value, cond_value], dim=2)
+
+    if attention_layout is None:
+        # without a layout all the conditions form a single segment
+        condition_n = key.shape[2] - query.shape[2]
+        if condition_latents is not None:
+            condition_n = condition_latents.shape[1]
+        attention_layout = AttentionLayout(
+            text_n=0,
+            image_n=key.shape[2] - condition_n,
+            condition_sizes=[condition_n] if condition_n else [],
+            model_config=model_config,
+            device=query.device,
+            dtype=query.dtype,
         )
-        condition_n = cond_query.shape[2]
-        attention_mask[-condition_n:, :-condition_n] = False
-        
-    if hasattr(attn, "c_factor"):
-        attention_mask = torch.zeros(
-            query.shape[2], key.shape[2], device=query.device, dtype=query.dtype
+    if attention_layout.attention_mask is not None:
+        attention_mask = attention_layout.mask(query.shape[2])
+    count_transient("attention_qkv", query, key, value)
+    if attention_mask is not None:
+        count_transient("attention_mask", attention_mask)
+
+    if attention_mask is None and attention_layout.segmented:
+        hidden_states = segmented_attention(query, key, value, attention_layout)
+    else:
+        hidden_states = F.scaled_dot_product_attention(
+            query, key, value, dropout_p=0.0, is_causal=False, attn_mask=attention_mask
         )
-        condition_n = cond_query.shape[2]
-        condition_e = extra_cond_query.shape[2]
-        bias = torch.log(attn.c_factor[0])
-        attention_mask[-condition_n-condition_e:-condition_e, :-condition_n-condition_e] = bias
-        attention_mask[:-condition_n-condition_e, -condition_n-condition_e:-condition_e] = bias
-        
-        bias = torch.log(attn.c_factor[1])
-        attention_mask[-condition_e:, :-condition_n-condition_e] = bias
-        attention_mask[:-condition_n-condition_e, -condition_e:] = bias
-        
-    hidden_states = F.scaled_dot_product_attention(
-        query, key, value, dropout_p=0.0, is_causal=False, attn_mask=attention_mask
-    )
+    count_transient("attention_output", hidden_states)
     hidden_states = hidden_states.transpose(1, 2).reshape(
         batch_size, -1, attn.heads * head_dim
     )
     hidden_states = hidden_states.to(query.dtype)
 
+    main_n = attention_layout.main_n
     if encoder_hidden_states is not None:
-        if condition_latents is not None:
-            if extra_condition_latents is not None:
-                encoder_hidden_states, hidden_states, condition_latents, extra_condition_latents = (
-                    hidden_states[:, : encoder_hidden_states.shape[1]],
-                    hidden_states[
-                        :, encoder_hidden_states.shape[1] : -condition_latents.shape[1]*2
-                    ],
-                    hidden_states[:, -condition_latents.shape[1]*2 :-condition_latents.shape[1]],
-                    hidden_states[:, -condition_latents.shape[1] :], #extra condition latents
-                )
-            else:
-                encoder_hidden_states, hidden_states, condition_latents = (
-                hidden_states[:, : encoder_hidden_states.shape[1]],
-                hidden_states[
-                    :, encoder_hidden_states.shape[1] : -condition_latents.shape[1]
-                ],
-                hidden_states[:, -condition_latents.shape[1] :]
-            )
-        else:
-            encoder_hidden_states, hidden_states = (
-                hidden_states[:, : encoder_hidden_states.shape[1]],
-                hidden_states[:, encoder_hidden_states.shape[1] :],
-            )
+        text_n = encoder_hidden_states.shape[1]
+        encoder_hidden_states, hidden_states, condition_latents = (
+            hidden_states[:, :text_n],
+            hidden_states[:, text_n:main_n],
+            hidden_states[:, main_n:] if condition_latents is not None else None,
+        )
 
         with enable_lora((attn.to_out[0],), model_config.get("latent_lora", False)):
             # linear proj
@@ -213,31 +196,18 @@ def attn_forward(
             condition_latents = attn.to_out[0](condition_latents)
             condition_latents = attn.to_out[1](condition_latents)
 
-        if extra_condition_latents is not None:
-            extra_condition_latents = attn.to_out[0](extra_condition_latents)
-            extra_condition_latents = attn.to_out[1](extra_condition_latents)
-
-
         return (
-            # (hidden_states, encoder_hidden_states, condition_latents, extra_condition_latents)
-            (hidden_states, encoder_hidden_states, condition_latents, extra_condition_latents)
+            (hidden_states, encoder_hidden_states, condition_latents)
             if condition_latents is not None
             else (hidden_states, encoder_hidden_states)
         )
     elif condition_latents is not None:
         # if there are condition_latents, we need to separate the hidden_states and the condition_latents
-        if extra_condition_latents is not None:
-            hidden_states, condition_latents, extra_condition_latents = (
-                hidden_states[:, : -condition_latents.shape[1]*2],
-                hidden_states[:, -condition_latents.shape[1]*2 :-condition_latents.shape[1]],
-                hidden_states[:, -condition_latents.shape[1] :],
-            )
-        else:
-            hidden_states, condition_latents = (
-                hidden_states[:, : -condition_latents.shape[1]],
-                hidden_states[:, -condition_latents.shape[1] :],
-            )
-        return hidden_states, condition_latents, extra_condition_latents
+        hidden_states, condition_latents = (
+            hidden_states[:, :main_n],
+            hidden_states[:, main_n:],
+        )
+        return hidden_states, condition_latents
     else:
         return hidden_states
 
@@ -247,18 +217,15 @@ def block_forward(
     hidden_states: torch.FloatTensor,
     encoder_hidden_states: torch.FloatTensor,
     condition_latents: torch.FloatTensor,
-    extra_condition_latents: torch.FloatTensor,
     temb: torch.FloatTensor,
     cond_temb: torch.FloatTensor,
-    extra_cond_temb: torch.FloatTensor,
     cond_rotary_emb=None,
-    extra_cond_rotary_emb=None,
     image_rotary_emb=None,
     model_config: Optional[Dict[str, Any]] = {},
+    kv_cache: Optional[ConditionKVCache] = None,
+    attention_layout: Optional[AttentionLayout] = None,
 ):
     use_cond = condition_latents is not None
-
-    use_extra_cond = extra_condition_latents is not None
     with enable_lora((self.norm1.linear,), model_config.get("latent_lora", False)):
         norm_hidden_states, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.norm1(
             hidden_states, emb=temb
@@ -276,13 +243,6 @@ def block_forward(
             cond_scale_mlp,
             cond_gate_mlp,
         ) = self.norm1(condition_latents, emb=cond_temb)
-        (
-            norm_extra_condition_latents,
-            extra_cond_gate_msa,
-            extra_cond_shift_mlp,
-            extra_cond_scale_mlp,
-            extra_cond_gate_mlp,
-        ) = self.norm1(extra_condition_latents, emb=extra_cond_temb)
 
     # Attention.
     result = attn_forward(
@@ -291,15 +251,13 @@ def block_forward(
         hidden_states=norm_hidden_states,
         encoder_hidden_states=norm_encoder_hidden_states,
         condition_latents=norm_condition_latents if use_cond else None,
-        extra_condition_latents=norm_extra_condition_latents if use_cond else None,
         image_rotary_emb=image_rotary_emb,
         cond_rotary_emb=cond_rotary_emb if use_cond else None,
-        extra_cond_rotary_emb=extra_cond_rotary_emb if use_extra_cond else None,
+        kv_cache=kv_cache,
+        attention_layout=attention_layout,
     )
-    
     attn_output, context_attn_output = result[:2]
     cond_attn_output = result[2] if use_cond else None
-    extra_condition_output = result[3]
 
     # Process attention outputs for the `hidden_states`.
     # 1. hidden_states
@@ -307,21 +265,15 @@ def block_forward(
     hidden_states = hidden_states + attn_output
     # 2. encoder_hidden_states
     context_attn_output = c_gate_msa.unsqueeze(1) * context_attn_output
-    
-    encoder_hidden_states = encoder_hidden_states + context_attn_output 
+    encoder_hidden_states = encoder_hidden_states + context_attn_output
     # 3. condition_latents
     if use_cond:
         cond_attn_output = cond_gate_msa.unsqueeze(1) * cond_attn_output
         condition_latents = condition_latents + cond_attn_output
-        #need to make new condition_extra and add extra_condition_output
-        if use_extra_cond:
-            extra_condition_output = extra_cond_gate_msa.unsqueeze(1) * extra_condition_output
-            extra_condition_latents = extra_condition_latents + extra_condition_output
-
         if model_config.get("add_cond_attn", False):
-            hidden_states += cond_attn_output
-            hidden_states += extra_condition_output
-
+            # every condition must have as many tokens as the image
+            for segment in attention_layout.condition_slices:
+                hidden_states += cond_attn_output[:, segment]
 
     # LayerNorm + MLP.
     # 1. hidden_states
@@ -342,14 +294,6 @@ def block_forward(
             + cond_shift_mlp[:, None]
         )
 
-    if use_extra_cond:
-        #added conditions
-        extra_norm_condition_latents = self.norm2(extra_condition_latents)
-        extra_norm_condition_latents = (
-            extra_norm_condition_latents * (1 + extra_cond_scale_mlp[:, None])
-            + extra_cond_shift_mlp[:, None]
-        )
-    
     # Feed-forward.
     with enable_lora((self.ff.net[2],), model_config.get("latent_lora", False)):
         # 1. hidden_states
@@ -363,23 +307,17 @@ def block_forward(
         cond_ff_output = self.ff(norm_condition_latents)
         cond_ff_output = cond_gate_mlp.unsqueeze(1) * cond_ff_output
 
-    if use_extra_cond:
-        extra_cond_ff_output = self.ff(extra_norm_condition_latents)
-        extra_cond_ff_output = extra_cond_gate_mlp.unsqueeze(1) * extra_cond_ff_output
-
     # Process feed-forward outputs.
     hidden_states = hidden_states + ff_output
     encoder_hidden_states = encoder_hidden_states + context_ff_output
     if use_cond:
         condition_latents = condition_latents + cond_ff_output
-    if use_extra_cond:
-        extra_condition_latents = extra_condition_latents + extra_cond_ff_output
 
     # Clip to avoid overflow.
     if encoder_hidden_states.dtype == torch.float16:
         encoder_hidden_states = encoder_hidden_states.clip(-65504, 65504)
 
-    return encoder_hidden_states, hidden_states, condition_latents, extra_condition_latents if use_cond else None
+    return encoder_hidden_states, hidden_states, condition_latents if use_cond else None
 
 
 def single_block_forward(
@@ -388,16 +326,14 @@ def single_block_forward(
     temb: torch.FloatTensor,
     image_rotary_emb=None,
     condition_latents: torch.FloatTensor = None,
-    extra_condition_latents: torch.FloatTensor = None,
     cond_temb: torch.FloatTensor = None,
-    extra_cond_temb: torch.FloatTensor = None,
     cond_rotary_emb=None,
-    extra_cond_rotary_emb=None,
     model_config: Optional[Dict[str, Any]] = {},
+    kv_cache: Optional[ConditionKVCache] = None,
+    attention_layout: Optional[AttentionLayout] = None,
 ):
 
     using_cond = condition_latents is not None
-    using_extra_cond = extra_condition_latents is not None
     residual = hidden_states
     with enable_lora(
         (
@@ -413,31 +349,24 @@ def single_block_forward(
         norm_condition_latents, cond_gate = self.norm(condition_latents, emb=cond_temb)
         mlp_cond_hidden_states = self.act_mlp(self.proj_mlp(norm_condition_latents))
 
-    if using_extra_cond:
-        extra_residual_cond = extra_condition_latents
-        extra_norm_condition_latents, extra_cond_gate = self.norm(extra_condition_latents, emb=extra_cond_temb)
-        extra_mlp_cond_hidden_states = self.act_mlp(self.proj_mlp(extra_norm_condition_latents))
-
     attn_output = attn_forward(
         self.attn,
         model_config=model_config,
         hidden_states=norm_hidden_states,
         image_rotary_emb=image_rotary_emb,
+        kv_cache=kv_cache,
+        attention_layout=attention_layout,
         **(
             {
                 "condition_latents": norm_condition_latents,
                 "cond_rotary_emb": cond_rotary_emb if using_cond else None,
-                "extra_condition_latents": extra_norm_condition_latents if using_cond else None,
-                "extra_cond_rotary_emb": extra_cond_rotary_emb if using_cond else None,
             }
             if using_cond
             else {}
         ),
     )
-
     if using_cond:
-        attn_output, cond_attn_output, extra_cond_attn_output = attn_output
-
+        attn_output, cond_attn_output = attn_output
 
     with enable_lora((self.proj_out,), model_config.get("latent_lora", False)):
         hidden_states = torch.cat([attn_output, mlp_hidden_states], dim=2)
@@ -450,12 +379,292 @@ def single_block_forward(
         condition_latents = cond_gate * self.proj_out(condition_latents)
         condition_latents = residual_cond + condition_latents
 
-        extra_condition_latents = torch.cat([extra_cond_attn_output, extra_mlp_cond_hidden_states], dim=2)
-        extra_cond_gate = extra_cond_gate.unsqueeze(1)
-        extra_condition_latents = extra_cond_gate * self.proj_out(extra_condition_latents)
-        extra_condition_latents = extra_residual_cond + extra_condition_latents
+    if hidden_states.dtype == torch.float16:
+        hidden_states = hidden_states.clip(-65504, 65504)
+
+    return hidden_states if not using_cond else (hidden_states, condition_latents)
+
 
+def modulate(
+    hidden_states: torch.FloatTensor,
+    shift: torch.FloatTensor,
+    scale: torch.FloatTensor,
+    image_n: int,
+) -> torch.FloatTensor:
+    """
+    In-place `x * (1 + scale) + shift` over tokens packed as `[image,
+    condition]`: row 0 of the (B, 2, D) `shift` and `scale` modulates the
+    first `image_n` tokens, row 1 the condition tokens.
+    """
+    hidden_states[:, :image_n].mul_(1 + scale[:, :1]).add_(shift[:, :1])
+    hidden_states[:, image_n:].mul_(1 + scale[:, 1:]).add_(shift[:, 1:])
+    return hidden_states
+
+
+def gate_streams(
+    hidden_states: torch.FloatTensor, gate: torch.FloatTensor, image_n: int
+) -> torch.FloatTensor:
+    """
+    In-place per-stream gating of packed tokens, see `modulate`.
+    """
+    hidden_states[:, :image_n].mul_(gate[:, :1])
+    hidden_states[:, image_n:].mul_(gate[:, 1:])
+    return hidden_states
+
+
+def fused_attn_forward(
+    attn: Attention,
+    hidden_states: torch.FloatTensor,
+    image_n: int,
+    attention_layout: AttentionLayout,
+    encoder_hidden_states: torch.FloatTensor = None,
+    rotary_emb: Optional[torch.Tensor] = None,
+    model_config: Optional[Dict[str, Any]] = {},
+    kv_cache: Optional[ConditionKVCache] = None,
+) -> torch.FloatTensor:
+    """
+    `attn_forward` over the image and condition streams packed in
+    `hidden_states` (the first `image_n` tokens being the image), running
+    each shared projection once. `rotary_emb` covers the whole sequence.
+    Returns the packed output, and the text output for the double blocks.
+    """
+    batch_size = hidden_states.shape[0]
+    latent_lora = model_config.get("latent_lora", False)
+
+    query = packed_linear(attn.to_q, hidden_states, image_n, latent_lora)
+    key = packed_linear(attn.to_k, hidden_states, image_n, latent_lora)
+    value = packed_linear(attn.to_v, hidden_states, image_n, latent_lora)
+
+    inner_dim = key.shape[-1]
+    head_dim = inner_dim // attn.heads
+
+    query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+    if attn.norm_q is not None:
+        query = attn.norm_q(query)
+    if attn.norm_k is not None:
+        key = attn.norm_k(key)
+
+    if encoder_hidden_states is not None:
+        # `context` projections.
+        encoder_hidden_states_query_proj = attn.add_q_proj(encoder_hidden_states)
+        encoder_hidden_states_key_proj = attn.add_k_proj(encoder_hidden_states)
+        encoder_hidden_states_value_proj = attn.add_v_proj(encoder_hidden_states)
+
+        encoder_hidden_states_query_proj = encoder_hidden_states_query_proj.view(
+            batch_size, -1, attn.heads, head_dim
+        ).transpose(1, 2)
+        encoder_hidden_states_key_proj = encoder_hidden_states_key_proj.view(
+            batch_size, -1, attn.heads, head_dim
+        ).transpose(1, 2)
+        encoder_hidden_states_value_proj = encoder_hidden_states_value_proj.view(
+            batch_size, -1, attn.heads, head_dim
+        ).transpose(1, 2)
+
+        if attn.norm_added_q is not None:
+            encoder_hidden_states_query_proj = attn.norm_added_q(
+                encoder_hidden_states_query_proj
+            )
+        if attn.norm_added_k is not None:
+            encoder_hidden_states_key_proj = attn.norm_added_k(
+                encoder_hidden_states_key_proj
+            )
+
+        query = torch.cat([encoder_hidden_states_query_proj, query], dim=2)
+        key = torch.cat([encoder_hidden_states_key_proj, key], dim=2)
+        value = torch.cat([encoder_hidden_states_value_proj, value], dim=2)
+
+    if rotary_emb is not None:
+        query = apply_rotary_emb(query, rotary_emb)
+        key = apply_rotary_emb(key, rotary_emb)
+
+    if kv_cache is not None:
+        condition_n = hidden_states.shape[1] - image_n
+        kv_cache.store(
+            attn,
+            key[:, :, -condition_n:].contiguous(),
+            value[:, :, -condition_n:].contiguous(),
+        )
+
+    attention_mask = attention_layout.mask(query.shape[2])
+    count_transient("attention_qkv", query, key, value)
+    if attention_mask is not None:
+        count_transient("attention_mask", attention_mask)
+    if attention_mask is None and attention_layout.segmented:
+        hidden_states = segmented_attention(query, key, value, attention_layout)
+    else:
+        hidden_states = F.scaled_dot_product_attention(
+            query, key, value, dropout_p=0.0, is_causal=False, attn_mask=attention_mask
+        )
+    count_transient("attention_output", hidden_states)
+    hidden_states = hidden_states.transpose(1, 2).reshape(
+        batch_size, -1, attn.heads * head_dim
+    )
+    hidden_states = hidden_states.to(query.dtype)
+
+    if encoder_hidden_states is None:
+        return hidden_states
+
+    text_n = encoder_hidden_states.shape[1]
+    encoder_hidden_states, hidden_states = (
+        hidden_states[:, :text_n],
+        hidden_states[:, text_n:],
+    )
+    hidden_states = packed_linear(attn.to_out[0], hidden_states, image_n, latent_lora)
+    hidden_states = attn.to_out[1](hidden_states)
+    encoder_hidden_states = attn.to_add_out(encoder_hidden_states)
+    return hidden_states, encoder_hidden_states
+
+
+def fused_block_forward(
+    self,
+    hidden_states: torch.FloatTensor,
+    encoder_hidden_states: torch.FloatTensor,
+    condition_latents: torch.FloatTensor,
+    temb: torch.FloatTensor,
+    cond_temb: torch.FloatTensor,
+    cond_rotary_emb=None,
+    image_rotary_emb=None,
+    model_config: Optional[Dict[str, Any]] = {},
+    kv_cache: Optional[ConditionKVCache] = None,
+    attention_layout: Optional[AttentionLayout] = None,
+    packed_rotary_emb=None,
+):
+    """
+    `block_forward` with the image and condition streams packed along the
+    sequence, so the norms, projections and feed-forward sharing weights run
+    once with per-stream modulation. The condition LoRA is still disabled
+    on the image tokens unless `latent_lora` is set. `packed_rotary_emb`
+    covers the packed sequence, it is built from the two tables if missing.
+    """
+    latent_lora = model_config.get("latent_lora", False)
+    image_n = hidden_states.shape[1]
+    hidden_states = torch.cat([hidden_states, condition_latents], dim=1)
+    rotary_emb = packed_rotary_emb or pack_rotary_emb(image_rotary_emb, cond_rotary_emb)
+
+    # one modulation row per stream: image (temb) and conditions (cond_temb)
+    emb = packed_linear(
+        self.norm1.linear,
+        self.norm1.silu(torch.stack([temb, cond_temb], dim=1)),
+        1,
+        latent_lora,
+    )
+    shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = emb.chunk(6, dim=-1)
+    norm_hidden_states = modulate(
+        self.norm1.norm(hidden_states), shift_msa, scale_msa, image_n
+    )
+
+    norm_encoder_hidden_states, c_gate_msa, c_shift_mlp, c_scale_mlp, c_gate_mlp = (
+        self.norm1_context(encoder_hidden_states, emb=temb)
+    )
+
+    # Attention.
+    attn_output, context_attn_output = fused_attn_forward(
+        self.attn,
+        norm_hidden_states,
+        image_n,
+        attention_layout,
+        encoder_hidden_states=norm_encoder_hidden_states,
+        rotary_emb=rotary_emb,
+        model_config=model_config,
+        kv_cache=kv_cache,
+    )
+
+    # Process attention outputs.
+    attn_output = gate_streams(attn_output, gate_msa, image_n)
+    hidden_states = hidden_states + attn_output
+    context_attn_output = c_gate_msa.unsqueeze(1) * context_attn_output
+    encoder_hidden_states = encoder_hidden_states + context_attn_output
+    if model_config.get("add_cond_attn", False):
+        # every condition must have as many tokens as the image
+        for segment in attention_layout.condition_slices:
+            hidden_states[:, :image_n] += attn_output[
+                :, image_n + segment.start : image_n + segment.stop
+            ]
+
+    # LayerNorm + MLP.
+    norm_hidden_states = modulate(
+        self.norm2(hidden_states), shift_mlp, scale_mlp, image_n
+    )
+    norm_encoder_hidden_states = self.norm2_context(encoder_hidden_states)
+    norm_encoder_hidden_states = (
+        norm_encoder_hidden_states * (1 + c_scale_mlp[:, None]) + c_shift_mlp[:, None]
+    )
+
+    # Feed-forward.
+    ff_output = self.ff.net[1](self.ff.net[0](norm_hidden_states))
+    ff_output = packed_linear(self.ff.net[2], ff_output, image_n, latent_lora)
+    for module in self.ff.net[3:]:
+        ff_output = module(ff_output)
+    ff_output = gate_streams(ff_output, gate_mlp, image_n)
+    context_ff_output = self.ff_context(norm_encoder_hidden_states)
+    context_ff_output = c_gate_mlp.unsqueeze(1) * context_ff_output
+
+    # Process feed-forward outputs.
+    hidden_states = hidden_states + ff_output
+    encoder_hidden_states = encoder_hidden_states + context_ff_output
+
+    # Clip to avoid overflow.
+    if encoder_hidden_states.dtype == torch.float16:
+        encoder_hidden_states = encoder_hidden_states.clip(-65504, 65504)
+
+    return encoder_hidden_states, hidden_states[:, :image_n], hidden_states[:, image_n:]
+
+
+def fused_single_block_forward(
+    self,
+    hidden_states: torch.FloatTensor,
+    temb: torch.FloatTensor,
+    image_rotary_emb=None,
+    condition_latents: torch.FloatTensor = None,
+    cond_temb: torch.FloatTensor = None,
+    cond_rotary_emb=None,
+    model_config: Optional[Dict[str, Any]] = {},
+    kv_cache: Optional[ConditionKVCache] = None,
+    attention_layout: Optional[AttentionLayout] = None,
+    packed_rotary_emb=None,
+):
+    """
+    `single_block_forward` with packed streams, see `fused_block_forward`.
+    """
+    latent_lora = model_config.get("latent_lora", False)
+    image_n = hidden_states.shape[1]
+    residual = hidden_states = torch.cat([hidden_states, condition_latents], dim=1)
+    rotary_emb = packed_rotary_emb or pack_rotary_emb(image_rotary_emb, cond_rotary_emb)
+
+    emb = packed_linear(
+        self.norm.linear,
+        self.norm.silu(torch.stack([temb, cond_temb], dim=1)),
+        1,
+        latent_lora,
+    )
+    shift, scale, gate = emb.chunk(3, dim=-1)
+    norm_hidden_states = modulate(self.norm.norm(hidden_states), shift, scale, image_n)
+    mlp_hidden_states = self.act_mlp(
+        packed_linear(self.proj_mlp, norm_hidden_states, image_n, latent_lora)
+    )
+
+    attn_output = fused_attn_forward(
+        self.attn,
+        norm_hidden_states,
+        image_n,
+        attention_layout,
+        rotary_emb=rotary_emb,
+        model_config=model_config,
+        kv_cache=kv_cache,
+    )
+
+    hidden_states = torch.cat([attn_output, mlp_hidden_states], dim=2)
+    hidden_states = packed_linear(self.proj_out, hidden_states, image_n, latent_lora)
+    hidden_states = residual + gate_streams(hidden_states, gate, image_n)
+
+    hidden_states, condition_latents = (
+        hidden_states[:, :image_n],
+        hidden_states[:, image_n:],
+    )
     if hidden_states.dtype == torch.float16:
         hidden_states = hidden_states.clip(-65504, 65504)
 
-    return hidden_states if not using_cond else (hidden_states, condition_latents, extra_condition_latents)
+    return hidden_states, condition_latents
@@ -0,0 +1,254 @@
+import torch
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple, Union
+from diffusers.models.attention_processor import Attention
+from PIL import Image
+
+
+class ConditionKVCache(object):
+    """
+    Condition keys/values of every attention module, recorded on the first
+    denoising step and replayed on the following ones.
+
+    Only valid when the condition tokens cannot attend to the text and image
+    tokens (`independent_condition`): their hidden states then only depend on
+    the constant condition timestep embedding and the condition latents.
+    """
+
+    def __init__(self) -> None:
+        self.entries: Dict[Attention, Tuple[torch.Tensor, torch.Tensor]] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, attn: Attention) -> bool:
+        return attn in self.entries
+
+    def store(
+        self,
+        attn: Attention,
+        key: torch.Tensor,
+        value: torch.Tensor,
+    ) -> None:
+        self.entries[attn] = (key, value)
+
+    def load(self, attn: Attention) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.entries[attn]
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+class StepCache(object):
+    """
+    Skips whole transformer steps of the denoising loop. The modulated input
+    of the first double-stream block is compared with its value at the
+    previous step; while the relative change accumulated since the last
+    computed step stays below `threshold`, the residual the blocks added at
+    that step is reused instead of running them.
+
+    A higher threshold skips more steps at the cost of quality, `skipped`
+    counts the reused steps. The first `warmup_steps` steps are always
+    computed.
+
+    The change is accumulated on the device. Deciding which kernels run
+    needs its value on the host, so each step after the warmup reads one
+    boolean from the device; the warmup steps do not synchronize.
+    """
+
+    def __init__(self, threshold: float = 0.1, warmup_steps: int = 1) -> None:
+        self.threshold = threshold
+        self.warmup_steps = warmup_steps
+        self.steps = 0
+        self.skipped = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forgets the previous step, called at the start of each `generate`.
+        """
+        self.previous: Optional[torch.Tensor] = None
+        self.residual: Optional[torch.Tensor] = None
+        self.accumulated: Union[float, torch.Tensor] = 0.0
+        self.step = 0
+
+    def skip(self, modulated: torch.Tensor) -> bool:
+        """
+        Returns whether the step with this first-block modulated input can
+        reuse the cached residual.
+        """
+        previous, self.previous = self.previous, modulated
+        self.step += 1
+        self.steps += 1
+        if (
+            previous is None
+            or self.residual is None
+            or previous.shape != modulated.shape
+            or self.step <= self.warmup_steps
+        ):
+            self.accumulated = 0.0
+            return False
+        change = (modulated - previous).abs().mean() / previous.abs().mean()
+        accumulated = self.accumulated + change
+        # the only read from the device per step
+        if not bool(accumulated < self.threshold):
+            self.accumulated = 0.0
+            return False
+        self.accumulated = accumulated
+        self.skipped += 1
+        return True
+
+    def store(self, hidden_states: torch.Tensor, output: torch.Tensor) -> None:
+        self.residual = output - hidden_states
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"steps": self.steps, "skipped": self.skipped}
+
+
+class LRUCache(object):
+    """
+    Least-recently-used mapping of tensors (or tuples of tensors), evicted by
+    byte budget. Keeps hit/miss counters so the cache can be monitored. Safe
+    to share between threads (see `StagedExecutor`).
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30) -> None:
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    @staticmethod
+    def size_of(value: Any) -> int:
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(LRUCache.size_of(each) for each in value)
+        if isinstance(value, dict):
+            return sum(LRUCache.size_of(each) for each in value.values())
+        return 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.size_of(self.entries.pop(key))
+            size = self.size_of(value)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = value
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= self.size_of(evicted)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class LatentCache(LRUCache):
+    """
+    Condition latents `(tokens, ids)` keyed by the content of the condition
+    image. With `deterministic` the mode of the latent distribution is used
+    instead of a sample, so a cached entry is what a fresh encode would give.
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30, deterministic: bool = True) -> None:
+        super().__init__(max_bytes)
+        self.deterministic = deterministic
+
+
+def content_key(image: Union[Image.Image, torch.Tensor]) -> Tuple:
+    """
+    Returns a hashable key made of the content hash and the size of an image.
+    """
+    if isinstance(image, Image.Image):
+        data = image.tobytes()
+        meta = (image.mode, image.size)
+    else:
+        tensor = image.detach().cpu().contiguous()
+        data = tensor.flatten().view(torch.uint8).numpy().tobytes()
+        meta = (str(tensor.dtype), tuple(tensor.shape))
+    return (hashlib.sha1(data).hexdigest(),) + meta
+
+
+class PromptCache(LRUCache):
+    """
+    Prompt embeddings `(prompt_embeds, pooled_prompt_embeds, text_ids)` of a
+    single prompt, keyed by text encoder fingerprint, prompt and encoding
+    parameters (see `prompt_cache_keys`).
+
+    With `cache_dir` every entry is also written to disk and memory misses are
+    looked up there, so a restarted worker starts with a warm cache.
+    `misses` counts memory misses, `disk_hits` the ones served from disk.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024**2, cache_dir: Optional[str] = None) -> None:
+        super().__init__(max_bytes)
+        self.cache_dir = cache_dir
+        self.disk_hits = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key: Hashable) -> str:
+        return os.path.join(
+            self.cache_dir, hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".pt"
+        )
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        value = super().get(key)
+        if value is not None or self.cache_dir is None:
+            return value
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        value = tuple(torch.load(path, map_location="cpu", weights_only=True))
+        self.disk_hits += 1
+        super().put(key, value)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        super().put(key, value)
+        if self.cache_dir is None:
+            return
+        path = self.path(key)
+        if not os.path.exists(path):
+            # write then rename so concurrent workers never read a partial file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.save([each.cpu() for each in value], tmp_path)
+            os.replace(tmp_path, path)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return dict(super().stats, disk_hits=self.disk_hits)
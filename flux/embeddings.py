@@ -0,0 +1,97 @@
+import torch
+from typing import Optional, Dict, Any, Tuple
+from diffusers.models.transformers.transformer_flux import (
+    FluxTransformer2DModel,
+    USE_PEFT_BACKEND,
+    scale_lora_layers,
+    unscale_lora_layers,
+)
+
+
+def pack_rotary_emb(
+    image_rotary_emb: Tuple[torch.Tensor, torch.Tensor],
+    cond_rotary_emb: Tuple[torch.Tensor, torch.Tensor],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Rotary table of the packed `[text, image, conditions]` sequence.
+    """
+    return tuple(
+        torch.cat(each, dim=0) for each in zip(image_rotary_emb, cond_rotary_emb)
+    )
+
+
+class EmbeddingSchedule(object):
+    """
+    Timestep embeddings of every denoising step and rotary tables of a
+    `generate` call, computed once up front instead of in every
+    `tranformer_forward` call. Only the text/image timestep embedding changes
+    between steps: the conditions use the constant timestep `c_t` and the ids
+    never change during a run.
+
+    `timesteps` are given as passed to the transformer (divided by 1000).
+    """
+
+    def __init__(
+        self,
+        transformer: FluxTransformer2DModel,
+        timesteps: torch.Tensor,
+        pooled_projections: torch.Tensor,
+        txt_ids: torch.Tensor,
+        img_ids: torch.Tensor,
+        condition_ids: Optional[torch.Tensor] = None,
+        guidance: Optional[torch.Tensor] = None,
+        c_t: float = 0,
+        lora_scale: Optional[float] = None,
+    ) -> None:
+        dtype = transformer.dtype
+        batch_size = pooled_projections.shape[0]
+        steps = timesteps.shape[0]
+
+        if USE_PEFT_BACKEND and lora_scale is not None:
+            # same LoRA weighting as inside `tranformer_forward`
+            scale_lora_layers(transformer, lora_scale)
+        try:
+            # one embedding call for the whole schedule
+            timestep = timesteps.to(dtype).repeat_interleave(batch_size) * 1000
+            pooled = pooled_projections.repeat(steps, 1)
+            cond_timestep = torch.ones_like(timestep[:batch_size]) * c_t * 1000
+            if guidance is None:
+                temb = transformer.time_text_embed(timestep, pooled)
+                cond_temb = transformer.time_text_embed(cond_timestep, pooled_projections)
+            else:
+                guidance = guidance.to(dtype) * 1000
+                temb = transformer.time_text_embed(
+                    timestep, guidance.repeat(steps), pooled
+                )
+                cond_temb = transformer.time_text_embed(
+                    cond_timestep, torch.ones_like(guidance) * 1000, pooled_projections
+                )
+        finally:
+            if USE_PEFT_BACKEND and lora_scale is not None:
+                unscale_lora_layers(transformer, lora_scale)
+        self.temb = temb.view(steps, batch_size, -1)
+        self.cond_temb = cond_temb
+
+        self.image_rotary_emb = transformer.pos_embed(torch.cat((txt_ids, img_ids), dim=0))
+        self.cond_rotary_emb = None
+        self.packed_rotary_emb = None
+        if condition_ids is not None:
+            self.cond_rotary_emb = transformer.pos_embed(condition_ids)
+            self.packed_rotary_emb = pack_rotary_emb(
+                self.image_rotary_emb, self.cond_rotary_emb
+            )
+
+    def __len__(self) -> int:
+        return self.temb.shape[0]
+
+    def at(self, step: int) -> Dict[str, Any]:
+        """
+        Returns the `tranformer_forward` arguments of the given step.
+        """
+        return {
+            "temb": self.temb[step],
+            "cond_temb": self.cond_temb,
+            "image_rotary_emb": self.image_rotary_emb,
+            "cond_rotary_emb": self.cond_rotary_emb,
+            "packed_rotary_emb": self.packed_rotary_emb,
+        }
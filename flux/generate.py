@@ -1,13 +1,27 @@
-# Recycled from Ominicontrol and modified to accept an extra condition.
+# Recycled from Ominicontrol and modified to accept several conditions.
 # While Zenctrl pursued a similar idea, it diverged structurally. 
 # We appreciate the clarity of Omini's implementation and decided to align with it.
 
 import torch
 import yaml, os
 from diffusers.pipelines import FluxPipeline
-from typing import List, Union, Optional, Dict, Any, Callable
+from typing import List, Union, Optional, Dict, Any, Callable, Tuple
 from .transformer import tranformer_forward
-from .condition import Condition
+from .condition import (
+    Condition,
+    background_keep_masks,
+    encode_conditions,
+    encode_empty_conditions,
+)
+from .cache import ConditionKVCache, LatentCache, PromptCache, StepCache
+from .layout import AttentionLayout
+from .embeddings import EmbeddingSchedule
+from .pipeline_tools import encode_prompt_cached
+from .lora_controller import lora_registry
+from .adapters import AdapterPool
+from .tracing import Tracer, span
+from .streaming import BlockStreamer
+from .preview import LatentPreviewer, Preview
 
 
 from diffusers.pipelines.flux.pipeline_flux import (
@@ -70,6 +84,79 @@ def prepare_params(
     )
 
 
+def stack_conditions(
+    encoded: List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]], batch_size: int
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Stacks one encoded condition per sample along the batch dimension. The ids
+    are shared by the batch, so every sample must have the same size and
+    position delta.
+    """
+    tokens = torch.cat([each[0] for each in encoded], dim=0)
+    ids, type_ids = encoded[0][1], encoded[0][2]
+    for _, other_ids, _ in encoded[1:]:
+        if not torch.equal(other_ids, ids):
+            raise ValueError(
+                "Batched conditions must share their size and position_delta"
+            )
+    if tokens.shape[0] != batch_size:
+        # one condition shared by the batch or several images per prompt
+        tokens = tokens.repeat_interleave(batch_size // tokens.shape[0], dim=0)
+    return tokens, ids, type_ids
+
+
+def pack_conditions(
+    encoded: List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]],
+    condition_count: int,
+    batch_size: int,
+    keep_masks: Optional[List[torch.Tensor]] = None,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, List[int]]:
+    """
+    Packs the encoded conditions, `condition_count` per sample, into one
+    condition stream. Returns the tokens, ids, type ids and the token count
+    of each condition. `keep_masks` select the tokens kept in each slot
+    (see `background_keep_masks`).
+    """
+    stacked = [
+        stack_conditions(encoded[index::condition_count], batch_size)
+        for index in range(condition_count)
+    ]
+    if keep_masks is not None:
+        pruned = []
+        for (tokens, ids, type_ids), keep in zip(stacked, keep_masks):
+            keep = keep.to(tokens.device)
+            pruned.append((tokens[:, keep], ids[keep], type_ids[keep]))
+        stacked = pruned
+    return (
+        torch.cat([each[0] for each in stacked], dim=1),
+        torch.cat([each[1] for each in stacked], dim=0),
+        torch.cat([each[2] for each in stacked], dim=0),
+        [each[0].shape[1] for each in stacked],
+    )
+
+
+def decode_latents(
+    pipeline: FluxPipeline,
+    latents: torch.Tensor,
+    height: int,
+    width: int,
+    output_type: str = "pil",
+    tracer: Optional[Tracer] = None,
+):
+    """
+    Decodes packed latents with the VAE (tiled if enabled, see `VAETiling`)
+    and postprocesses them to `output_type`.
+    """
+    with span(tracer, "vae_decode"):
+        latents = pipeline._unpack_latents(latents, height, width, pipeline.vae_scale_factor)
+        latents = (
+            latents / pipeline.vae.config.scaling_factor
+        ) + pipeline.vae.config.shift_factor
+        image = pipeline.vae.decode(latents, return_dict=False)[0]
+    with span(tracer, "postprocess"):
+        return pipeline.image_processor.postprocess(image, output_type=output_type)
+
+
 def seed_everything(seed: int = 42):
     torch.backends.cudnn.deterministic = True
     torch.manual_seed(seed)
@@ -77,22 +164,32 @@ def seed_everything(seed: int = 42):
 
 
 @torch.no_grad()
-def generate(
+def generate_stream(
     pipeline: FluxPipeline,
-    conditions: List[Condition] = None,
+    conditions: Union[List[Condition], List[List[Condition]]] = None,
     config_path: str = None,
     model_config: Optional[Dict[str, Any]] = {},
-    condition_scale: float = [1, 1],
+    condition_scale: Optional[Union[List[float], List[List[float]]]] = None,
     default_lora: bool = False,
     image_guidance_scale: float = 1.0,
+    cache_condition_kv: bool = False,
+    latent_cache: Optional[LatentCache] = None,
+    prompt_cache: Optional[PromptCache] = None,
+    step_cache: Optional[StepCache] = None,
+    block_streamer: Optional[BlockStreamer] = None,
+    adapter_pool: Optional[AdapterPool] = None,
+    tracer: Optional[Tracer] = None,
+    condition_resolution: Optional[int] = None,
+    prune_background: bool = False,
+    preview_steps: Optional[List[int]] = None,
+    previewer: Optional[LatentPreviewer] = None,
     **params: dict,
 ):
+    """
+    `generate` as a generator: yields a `Preview` of the predicted image
+    after each step listed in `preview_steps`, then the output.
+    """
     model_config = model_config or get_config(config_path).get("model", {})
-    if condition_scale != [1,1]:
-        for name, module in pipeline.transformer.named_modules():
-            if not name.endswith(".attn"):
-                continue
-            module.c_factor = torch.tensor(condition_scale) 
 
     self = pipeline
     (
@@ -145,62 +242,141 @@ def generate(
 
     device = self._execution_device
 
+    # the image stream LoRA bypass toggles one flag per site, the registry
+    # is only rescanned when adapters were loaded or deleted since
+    lora_registry(self.transformer)
+
     lora_scale = (
         self.joint_attention_kwargs.get("scale", None)
         if self.joint_attention_kwargs is not None
         else None
     )
-    (
-        prompt_embeds,
-        pooled_prompt_embeds,
-        text_ids,
-    ) = self.encode_prompt(
-        prompt=prompt,
-        prompt_2=prompt_2,
-        prompt_embeds=prompt_embeds,
-        pooled_prompt_embeds=pooled_prompt_embeds,
-        device=device,
-        num_images_per_prompt=num_images_per_prompt,
-        max_sequence_length=max_sequence_length,
-        lora_scale=lora_scale,
-    )
+    with span(tracer, "encode_prompt", batch_size=batch_size):
+        (
+            prompt_embeds,
+            pooled_prompt_embeds,
+            text_ids,
+        ) = encode_prompt_cached(
+            self,
+            prompt=prompt,
+            prompt_2=prompt_2,
+            prompt_embeds=prompt_embeds,
+            pooled_prompt_embeds=pooled_prompt_embeds,
+            device=device,
+            num_images_per_prompt=num_images_per_prompt,
+            max_sequence_length=max_sequence_length,
+            lora_scale=lora_scale,
+            prompt_cache=prompt_cache,
+        )
 
     # 4. Prepare latent variables
     num_channels_latents = self.transformer.config.in_channels // 4
-    latents, latent_image_ids = self.prepare_latents(
-        batch_size * num_images_per_prompt,
-        num_channels_latents,
-        height,
-        width,
-        prompt_embeds.dtype,
-        device,
-        generator,
-        latents,
-    )
+    with span(tracer, "prepare_latents"):
+        latents, latent_image_ids = self.prepare_latents(
+            batch_size * num_images_per_prompt,
+            num_channels_latents,
+            height,
+            width,
+            prompt_embeds.dtype,
+            device,
+            generator,
+            latents,
+        )
 
     # 4.1. Prepare conditions
-    condition_latents, condition_ids, condition_type_ids = ([] for _ in range(3))
-    extra_condition_latents, extra_condition_ids, extra_condition_type_ids = ([] for _ in range(3))
-    use_condition = conditions is not None or []
+    # `conditions` is one list of N conditions shared by the batch or one list
+    # per prompt, they are packed along the sequence in a single stream.
+    # With `condition_resolution` they are encoded at that resolution with
+    # their ids scaled to the output grid. `prune_background` drops the
+    # condition tokens of flat white background.
+    use_condition = bool(conditions)
+    condition_sizes = []
     if use_condition:
+        per_sample = isinstance(conditions[0], (list, tuple))
+        condition_sets = conditions if per_sample else [conditions]
+        condition_count = len(condition_sets[0])
+        if any(len(each) != condition_count for each in condition_sets):
+            raise ValueError("Batched samples must have the same number of conditions")
         if not default_lora:
-            pipeline.set_adapters(conditions[1].condition_type)
-        # for condition in conditions:
-        tokens, ids, type_id = conditions[0].encode(self)
-        condition_latents.append(tokens)  # [batch_size, token_n, token_dim]
-        condition_ids.append(ids)  # [token_n, id_dim(3)]
-        condition_type_ids.append(type_id)  # [token_n, 1]
-        condition_latents = torch.cat(condition_latents, dim=1)
-        condition_ids = torch.cat(condition_ids, dim=0)
-        condition_type_ids = torch.cat(condition_type_ids, dim=0)
-
-        tokens, ids, type_id = conditions[1].encode(self)
-        extra_condition_latents.append(tokens)  # [batch_size, token_n, token_dim]
-        extra_condition_ids.append(ids)  # [token_n, id_dim(3)]
-        extra_condition_type_ids.append(type_id)  # [token_n, 1]
-        extra_condition_latents = torch.cat(extra_condition_latents, dim=1)
-        extra_condition_ids = torch.cat(extra_condition_ids, dim=0)
-        extra_condition_type_ids = torch.cat(extra_condition_type_ids, dim=0)
+            condition_types = {each[-1].condition_type for each in condition_sets}
+            if len(condition_types) > 1:
+                raise ValueError(
+                    f"A batch can only activate one adapter, got {sorted(condition_types)}"
+                )
+            # the pool switches adapters from host memory
+            if adapter_pool is not None:
+                adapter_pool.activate(condition_sets[0][-1].condition_type)
+            else:
+                pipeline.set_adapters(condition_sets[0][-1].condition_type)
+        flat_conditions = [condition for each in condition_sets for condition in each]
+        keep_masks = None
+        if prune_background:
+            assert not model_config.get(
+                "add_cond_attn", False
+            ), "prune_background cannot be used with add_cond_attn"
+            keep_masks = background_keep_masks(
+                flat_conditions, condition_count, condition_resolution
+            )
+        with span(tracer, "encode_conditions", conditions=len(flat_conditions)):
+            encoded = encode_conditions(
+                self,
+                flat_conditions,
+                latent_cache,
+                tracer,
+                resolution=condition_resolution,
+                output_size=(height, width),
+            )
+            condition_latents, condition_ids, condition_type_ids, condition_sizes = (
+                pack_conditions(encoded, condition_count, latents.shape[0], keep_masks)
+            )
+        if per_sample and condition_scale is not None:
+            # one row of scales per sample: shared, per prompt or per image
+            scales = torch.as_tensor(condition_scale, dtype=torch.float32).reshape(
+                -1, condition_count
+            )
+            if scales.shape[0] not in (1, len(condition_sets), latents.shape[0]):
+                raise ValueError(
+                    f"Expected 1, {len(condition_sets)} or {latents.shape[0]} rows "
+                    f"of condition_scale, got {scales.shape[0]}"
+                )
+            condition_scale = scales.repeat_interleave(
+                latents.shape[0] // scales.shape[0], dim=0
+            ).tolist()
+
+    # 4.2. Image guidance: the conditional and unconditional (empty conditions)
+    # passes run as one forward on a doubled batch
+    use_image_guidance = use_condition and image_guidance_scale != 1.0
+    if use_image_guidance:
+        with span(tracer, "encode_empty_conditions", conditions=len(flat_conditions)):
+            uncondition_latents = pack_conditions(
+                encode_empty_conditions(
+                    self,
+                    flat_conditions,
+                    latent_cache,
+                    tracer,
+                    resolution=condition_resolution,
+                    output_size=(height, width),
+                ),
+                condition_count,
+                latents.shape[0],
+                keep_masks,
+            )[0]
+        condition_latents = torch.cat([condition_latents, uncondition_latents], dim=0)
+        if per_sample and condition_scale is not None:
+            condition_scale = condition_scale * 2
+    model_batch = latents.shape[0] * (2 if use_image_guidance else 1)
+
+    # 4.3. Segment layout and attention mask, shared by every block and step
+    with span(tracer, "attention_layout"):
+        attention_layout = AttentionLayout(
+            text_n=prompt_embeds.shape[1],
+            image_n=latents.shape[1],
+            condition_sizes=condition_sizes,
+            model_config=model_config,
+            condition_scale=condition_scale,
+            device=device,
+            dtype=self.transformer.dtype,
+        )
 
     # 5. Prepare timesteps
     sigmas = np.linspace(1.0, 1 / num_inference_steps, num_inference_steps)
@@ -225,71 +401,119 @@ def generate(
     )
     self._num_timesteps = len(timesteps)
 
+    # 5.1. Independent conditions never see the image, so their keys/values are
+    # the same at every step: record them on the first step and replay them.
+    kv_cache = None
+    if cache_condition_kv and use_condition:
+        assert model_config.get("independent_condition", False) and not model_config.get(
+            "add_cond_attn", False
+        ), "cache_condition_kv requires independent_condition without add_cond_attn"
+        kv_cache = ConditionKVCache()
+
+    # 5.2. Timestep embeddings of every step and rotary tables, they do not
+    # depend on the latents
+    if self.transformer.config.guidance_embeds:
+        guidance = torch.tensor([guidance_scale], device=device)
+        guidance = guidance.expand(latents.shape[0])
+        if use_image_guidance:
+            # the unconditional pass has no distilled guidance
+            guidance = torch.cat([guidance, torch.ones_like(guidance)])
+    else:
+        guidance = None
+    with span(tracer, "embedding_schedule"):
+        embedding_schedule = EmbeddingSchedule(
+            self.transformer,
+            timesteps=timesteps.to(latents.dtype) / 1000,
+            pooled_projections=(
+                torch.cat([pooled_prompt_embeds] * 2)
+                if use_image_guidance
+                else pooled_prompt_embeds
+            ),
+            txt_ids=text_ids,
+            img_ids=latent_image_ids,
+            condition_ids=condition_ids if use_condition else None,
+            guidance=guidance,
+            lora_scale=lora_scale,
+        )
+
+    # 5.3. Steps reusing the transformer residual of the previous one
+    if step_cache is not None:
+        step_cache.reset()
+
     # 6. Denoising loop
     with self.progress_bar(total=num_inference_steps) as progress_bar:
         for i, t in enumerate(timesteps):
             if self.interrupt:
                 continue
 
-            # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
-            timestep = t.expand(latents.shape[0]).to(latents.dtype)
-
-            # handle guidance
-            if self.transformer.config.guidance_embeds:
-                guidance = torch.tensor([guidance_scale], device=device)
-                guidance = guidance.expand(latents.shape[0])
-            else:
-                guidance = None
-            noise_pred = tranformer_forward(
-                self.transformer,
-                model_config=model_config,
-                # Inputs of the condition (new feature)
-                condition_latents=condition_latents if use_condition else None,
-                condition_ids=condition_ids if use_condition else None,
-                condition_type_ids=condition_type_ids if use_condition else None,
-                extra_condition_latents=extra_condition_latents if use_condition else None,
-                extra_condition_ids=extra_condition_ids if use_condition else None,
-                extra_condition_type_ids=extra_condition_type_ids if use_condition else None,
-                # Inputs to the original transformer
-                hidden_states=latents,
-                # YiYi notes: divide it by 1000 for now because we scale it by 1000 in the transforme rmodel (we should not keep it but I want to keep the inputs same for the model for testing)
-                timestep=timestep / 1000,
-                guidance=guidance,
-                pooled_projections=pooled_prompt_embeds,
-                encoder_hidden_states=prompt_embeds,
-                txt_ids=text_ids,
-                img_ids=latent_image_ids,
-                joint_attention_kwargs=self.joint_attention_kwargs,
-                return_dict=False,
-            )[0]
-
-            if image_guidance_scale != 1.0:
-                uncondition_latents = conditions.encode(self, empty=True)[0]
-                unc_pred = tranformer_forward(
+            with span(tracer, "denoising_step", step=i):
+                # the image guidance batch repeats the latents and the prompt
+                latent_model_input = torch.cat([latents] * 2) if use_image_guidance else latents
+                model_prompt_embeds, model_pooled_prompt_embeds = (
+                    (torch.cat([prompt_embeds] * 2), torch.cat([pooled_prompt_embeds] * 2))
+                    if use_image_guidance
+                    else (prompt_embeds, pooled_prompt_embeds)
+                )
+
+                # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
+                timestep = t.expand(model_batch).to(latents.dtype)
+
+                # once recorded, the condition streams are not computed anymore
+                feed_condition = use_condition and (kv_cache is None or len(kv_cache) == 0)
+                noise_pred = tranformer_forward(
                     self.transformer,
                     model_config=model_config,
+                    kv_cache=kv_cache,
+                    attention_layout=attention_layout,
+                    **embedding_schedule.at(i),
+                    step_cache=step_cache,
+                    block_streamer=block_streamer,
+                    tracer=tracer,
                     # Inputs of the condition (new feature)
-                    condition_latents=uncondition_latents if use_condition else None,
-                    condition_ids=condition_ids if use_condition else None,
-                    condition_type_ids=condition_type_ids if use_condition else None,
+                    condition_latents=condition_latents if feed_condition else None,
+                    condition_ids=condition_ids if feed_condition else None,
+                    condition_type_ids=condition_type_ids if feed_condition else None,
+                    condition_sizes=condition_sizes,
                     # Inputs to the original transformer
-                    hidden_states=latents,
+                    hidden_states=latent_model_input,
                     # YiYi notes: divide it by 1000 for now because we scale it by 1000 in the transforme rmodel (we should not keep it but I want to keep the inputs same for the model for testing)
                     timestep=timestep / 1000,
-                    guidance=torch.ones_like(guidance),
-                    pooled_projections=pooled_prompt_embeds,
-                    encoder_hidden_states=prompt_embeds,
+                    guidance=guidance,
+                    pooled_projections=model_pooled_prompt_embeds,
+                    encoder_hidden_states=model_prompt_embeds,
                     txt_ids=text_ids,
                     img_ids=latent_image_ids,
                     joint_attention_kwargs=self.joint_attention_kwargs,
                     return_dict=False,
                 )[0]
 
-                noise_pred = unc_pred + image_guidance_scale * (noise_pred - unc_pred)
-
-            # compute the previous noisy sample x_t -> x_t-1
-            latents_dtype = latents.dtype
-            latents = self.scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+                if use_image_guidance:
+                    noise_pred, unc_pred = noise_pred.chunk(2)
+                    noise_pred = unc_pred + image_guidance_scale * (noise_pred - unc_pred)
+
+                # predicted clean latents of the preview, x_0 = x_t - sigma * v
+                denoised = (
+                    latents - self.scheduler.sigmas[i] * noise_pred
+                    if preview_steps is not None and i in preview_steps
+                    else None
+                )
+
+                # compute the previous noisy sample x_t -> x_t-1
+                latents_dtype = latents.dtype
+                latents = self.scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+
+            if denoised is not None:
+                with span(tracer, "preview", step=i):
+                    previewer = previewer or LatentPreviewer()
+                    preview = Preview(
+                        i,
+                        previewer(
+                            self._unpack_latents(
+                                denoised, height, width, self.vae_scale_factor
+                            )
+                        ),
+                    )
+                yield preview
 
             if latents.dtype != latents_dtype:
                 if torch.backends.mps.is_available():
@@ -315,23 +539,82 @@ def generate(
         image = latents
 
     else:
-        latents = self._unpack_latents(latents, height, width, self.vae_scale_factor)
-        latents = (
-            latents / self.vae.config.scaling_factor
-        ) + self.vae.config.shift_factor
-        image = self.vae.decode(latents, return_dict=False)[0]
-        image = self.image_processor.postprocess(image, output_type=output_type)
+        image = decode_latents(self, latents, height, width, output_type, tracer)
 
     # Offload all models
     self.maybe_free_model_hooks()
 
-    if condition_scale != [1,1]:
-        for name, module in pipeline.transformer.named_modules():
-            if not name.endswith(".attn"):
-                continue
-            del module.c_factor
-
     if not return_dict:
-        return (image,)
-
-    return FluxPipelineOutput(images=image)
+        yield (image,)
+    else:
+        yield FluxPipelineOutput(images=image)
+
+
+def generate(pipeline: FluxPipeline, *args: Any, **kwargs: dict):
+    """
+    Runs `generate_stream` to the end and returns its output.
+    """
+    for output in generate_stream(pipeline, *args, **kwargs):
+        pass
+    return output
+
+class GenerationRequest(object):
+    def __init__(
+        self,
+        prompt: str,
+        conditions: List[Condition] = None,
+        condition_scale: Optional[List[float]] = None,
+        seed: Optional[int] = None,
+        on_preview: Optional[Callable[[int, Any], None]] = None,
+    ) -> None:
+        self.prompt = prompt
+        self.conditions = conditions
+        self.condition_scale = condition_scale
+        self.seed = seed
+        # called with the step and the preview image, see `preview_steps`
+        self.on_preview = on_preview
+
+
+def generate_batch(
+    pipeline: FluxPipeline,
+    requests: List[GenerationRequest],
+    **kwargs: dict,
+):
+    """
+    Runs several requests as one batch through the transformer, each with its
+    own prompt, conditions, condition scale and seed. The requests must share
+    the generation parameters (size, steps, ...) given as `kwargs`, and their
+    conditions the same size and position delta. Returns one image per request.
+    The previews of the `preview_steps` go to the `on_preview` of each request.
+    """
+    use_condition = requests[0].conditions is not None
+    if any((request.conditions is not None) != use_condition for request in requests):
+        raise ValueError("Either all or none of the batched requests have conditions")
+    generator = [
+        torch.Generator(device="cpu").manual_seed(
+            request.seed
+            if request.seed is not None
+            else int(torch.randint(0, 2**31 - 1, (1,)))
+        )
+        for request in requests
+    ]
+    stream = generate_stream(
+        pipeline,
+        prompt=[request.prompt for request in requests],
+        conditions=[request.conditions for request in requests] if use_condition else None,
+        condition_scale=[
+            request.condition_scale or [1] * len(request.conditions)
+            for request in requests
+        ]
+        if use_condition
+        else None,
+        generator=generator,
+        **kwargs,
+    )
+    for output in stream:
+        if not isinstance(output, Preview):
+            continue
+        for request, image in zip(requests, output.images):
+            if request.on_preview is not None:
+                request.on_preview(output.step, image)
+    return output
@@ -0,0 +1,154 @@
+import torch
+from typing import Optional, Dict, Any, List, Tuple, Union
+
+# Extra query/key channels used to fold the segment bias into the attention
+# (one per segment), rounded up to a multiple of 8 so the head dim stays
+# eligible for the fused SDPA kernels.
+SEGMENT_CHANNELS = 8
+# Finite stand-in for -inf in the folded bias, `0 * -inf` would give NaNs.
+MASKED_BIAS = -1000.0
+
+
+class AttentionLayout(object):
+    """
+    Segment boundaries of the joint attention sequence
+    `[text, image, condition 1, ..., condition N]` and the attention bias
+    derived from them. The conditions are packed in one stream, the layout
+    keeps the offset of each of them so conditions of any size and count
+    only cost their tokens. Built once per `generate` call and shared by
+    every block and every step instead of rebuilding the mask in each
+    attention call.
+
+    The bias is constant per pair of segments (text and image form the `main`
+    segment), so by default it is folded into extra query/key channels and
+    no dense mask is materialized. `dense_attention_mask` in the model config
+    restores the dense (sequence_n, sequence_n) mask.
+    """
+
+    def __init__(
+        self,
+        text_n: int,
+        image_n: int,
+        condition_sizes: List[int] = [],
+        model_config: Optional[Dict[str, Any]] = {},
+        condition_scale: Optional[Union[List[float], List[List[float]]]] = None,
+        device: Optional[torch.device] = None,
+        dtype: torch.dtype = torch.float32,
+    ) -> None:
+        self.text_n = text_n
+        self.image_n = image_n
+        self.condition_sizes = list(condition_sizes)
+        self.main_n = text_n + image_n
+        # offsets of the conditions in the packed condition stream
+        self.condition_offsets = [0]
+        for size in self.condition_sizes:
+            self.condition_offsets.append(self.condition_offsets[-1] + size)
+        self.condition_n = self.condition_offsets[-1]
+        self.sequence_n = self.main_n + self.condition_n
+        self.condition_scale = condition_scale
+        self.device = device
+        self.dtype = dtype
+
+        self.segment_ids = torch.repeat_interleave(
+            torch.arange(len(self.condition_sizes) + 1, device=device),
+            torch.tensor([self.main_n] + self.condition_sizes, device=device),
+        )
+        self.segment_bias = self.build_segment_bias(model_config)
+        self.segmented = self.segment_bias is not None and not model_config.get(
+            "dense_attention_mask", False
+        )
+        self.attention_mask = None if self.segmented else self.build_mask()
+        self._folded_bias: Dict[int, Tuple[torch.Tensor, torch.Tensor]] = {}
+
+    @property
+    def use_condition(self) -> bool:
+        return self.sequence_n > self.main_n
+
+    @property
+    def condition_slices(self) -> List[slice]:
+        """
+        Slices of each condition in the packed condition stream.
+        """
+        return [
+            slice(start, end)
+            for start, end in zip(self.condition_offsets, self.condition_offsets[1:])
+        ]
+
+    @property
+    def segment_channels(self) -> int:
+        # one channel per segment, rounded up to a multiple of SEGMENT_CHANNELS
+        segment_n = len(self.condition_sizes) + 1
+        return -(-segment_n // SEGMENT_CHANNELS) * SEGMENT_CHANNELS
+
+    def build_segment_bias(self, model_config: Dict[str, Any]) -> Optional[torch.Tensor]:
+        """
+        Returns the (S, N + 1, N + 1) additive bias between the main segment
+        and the N conditions (rows are queries), None when no bias is needed.
+        `S` is 1 for a shared `condition_scale` or the batch size when one
+        list of N scales is given per sample. The conditions are treated as
+        one block for the structural modes.
+        """
+        if not self.use_condition:
+            return None
+        segment_n = len(self.condition_sizes) + 1
+        scales = torch.ones(1, segment_n - 1)
+        if self.condition_scale is not None:
+            scales = torch.as_tensor(self.condition_scale, dtype=torch.float32).reshape(
+                -1, segment_n - 1
+            )
+        bias = torch.zeros(scales.shape[0], segment_n, segment_n)
+        if not model_config.get("union_cond_attn", True):
+            bias[:, 1:, 0] = float("-inf")
+            bias[:, 0, 1:] = float("-inf")
+        elif model_config.get("independent_condition", False):
+            bias[:, 1:, 0] = float("-inf")
+
+        if (scales != 1).any():
+            c_factor = torch.log(scales)
+            bias[:, 1:, 0] += c_factor
+            bias[:, 0, 1:] += c_factor
+        return bias if bias.any() else None
+
+    def build_mask(self) -> Optional[torch.Tensor]:
+        """
+        Expands the segment bias to the dense mask, boolean (sequence_n,
+        sequence_n) when it only masks, additive otherwise with a leading
+        (S, 1) dimension for per-sample scales.
+        """
+        if self.segment_bias is None:
+            return None
+        bias = self.segment_bias.to(self.device)
+        rows, cols = self.segment_ids[:, None], self.segment_ids[None, :]
+        if torch.isinf(bias).logical_or(bias == 0).all():
+            return (bias[0] == 0)[rows, cols]
+        if bias.shape[0] == 1:
+            return bias[0].to(self.dtype)[rows, cols]
+        return bias.to(self.dtype)[:, rows, cols].unsqueeze(1)
+
+    def mask(self, query_n: int) -> Optional[torch.Tensor]:
+        """
+        Returns the mask rows of the first `query_n` queries, replayed steps
+        of the condition cache only query the text and image tokens.
+        """
+        if self.attention_mask is None:
+            return None
+        return self.attention_mask[..., :query_n, :]
+
+    def folded_bias(self, head_dim: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the (S, 1, sequence_n, segment_channels) query channels and
+        the (sequence_n, segment_channels) key channels such that
+        `[q, query_bias] . [k, key_select] * head_dim**-0.5` equals
+        `q . k * head_dim**-0.5 + segment_bias`.
+        """
+        if head_dim not in self._folded_bias:
+            channels = self.segment_channels
+            bias = self.segment_bias.clamp(min=MASKED_BIAS) * head_dim**0.5
+            bias = torch.nn.functional.pad(bias, (0, channels - bias.shape[-1]))
+            query_bias = bias.to(self.device)[:, self.segment_ids].unsqueeze(1)
+            key_select = torch.nn.functional.one_hot(self.segment_ids, channels)
+            self._folded_bias[head_dim] = (
+                query_bias.to(self.dtype),
+                key_select.to(self.dtype),
+            )
+        return self._folded_bias[head_dim]
@@ -1,17 +1,133 @@
 #As is from OminiControl
+import threading
+import torch
+from collections import OrderedDict
 from peft.tuners.tuners_utils import BaseTunerLayer
-from typing import List, Any, Optional, Type
+from typing import Dict, List, Any, Optional, Tuple, Type, Union
 from .condition import condition_dict
 
 
+def is_condition_adapter(adapter_name: str) -> bool:
+    """
+    Adapters trained for the conditions, disabled on the image stream unless
+    `latent_lora` is set.
+    """
+    return adapter_name in condition_dict.keys() or adapter_name == "default"
+
+
+class StreamScaling(dict):
+    """
+    `scaling` dict of a registered LoRA layer, reading 0 for the condition
+    adapters while its registry processes the image stream.
+    """
+
+    def __init__(self, scaling: Dict[str, float], registry: "LoRARegistry") -> None:
+        super().__init__(scaling)
+        self.registry = registry
+
+    def __getitem__(self, adapter_name: str) -> float:
+        if self.registry.image_stream and is_condition_adapter(adapter_name):
+            return 0.0
+        return super().__getitem__(adapter_name)
+
+
+class LoRARegistry(object):
+    """
+    The `enable_lora` sites of a transformer, registered once. Their LoRA
+    layers read the `image_stream` flag through `StreamScaling`, so
+    `enable_lora` toggles a single flag instead of filtering the modules and
+    saving and restoring their scales on every call. The flag is
+    thread-local: forward passes in other threads (server worker, staged
+    executor) are not affected by the toggle. `stats` counts the toggles and
+    the per-module scans they avoided.
+    """
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self.modules: List[BaseTunerLayer] = []
+        # the loaded adapters at the last registration, see `lora_registry`
+        self.adapters: Optional[Tuple] = None
+        self.toggles = 0
+        self.skipped_scans = 0
+
+    def register(self, modules: List[torch.nn.Module]) -> "LoRARegistry":
+        """
+        Registers the LoRA layers among `modules`, the ones already registered
+        are skipped so it can be called again after loading adapters. A
+        `scaling` dict that PEFT replaced is wrapped again.
+        """
+        for module in modules:
+            if not isinstance(module, BaseTunerLayer):
+                continue
+            if isinstance(module.scaling, StreamScaling) and (
+                getattr(module, "lora_registry", None) is self
+            ):
+                continue
+            module.scaling = StreamScaling(module.scaling, self)
+            module.fused_scale = getattr(module, "fused_scale", None)
+            if getattr(module, "lora_registry", None) is not self:
+                module.lora_registry = self
+                self.modules.append(module)
+        return self
+
+    @property
+    def image_stream(self) -> bool:
+        return getattr(self._local, "image_stream", False)
+
+    @image_stream.setter
+    def image_stream(self, value: bool) -> None:
+        self._local.image_stream = value
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "modules": len(self.modules),
+            "toggles": self.toggles,
+            "skipped_scans": self.skipped_scans,
+        }
+
+    def reset_stats(self) -> None:
+        self.toggles = 0
+        self.skipped_scans = 0
+
+
+def lora_registry(transformer: torch.nn.Module) -> LoRARegistry:
+    """
+    Returns the LoRA registry of the transformer, built on the first call.
+    The sites are only scanned again when the loaded adapters changed, the
+    LoRA layers added since are then registered.
+    """
+    registry = getattr(transformer, "lora_registry", None)
+    if registry is None:
+        registry = transformer.lora_registry = LoRARegistry()
+    adapters = tuple(
+        (name, id(config))
+        for name, config in (getattr(transformer, "peft_config", None) or {}).items()
+    )
+    if registry.adapters != adapters:
+        registry.register(image_lora_sites(transformer))
+        registry.adapters = adapters
+    return registry
+
+
 class enable_lora:
     def __init__(self, lora_modules: List[BaseTunerLayer], activated: bool) -> None:
         self.activated: bool = activated
         if activated:
             return
-        self.lora_modules: List[BaseTunerLayer] = [
-            each for each in lora_modules if isinstance(each, BaseTunerLayer)
-        ]
+        # registered sites only toggle the flag of their registry, the other
+        # LoRA layers of the group (not registered yet) are scaled to 0
+        self.registries: List[LoRARegistry] = []
+        self.registered = 0
+        self.lora_modules: List[BaseTunerLayer] = []
+        for each in lora_modules:
+            registry = getattr(each, "lora_registry", None)
+            if registry is not None:
+                self.registered += 1
+                if registry not in self.registries:
+                    self.registries.append(registry)
+            elif isinstance(each, BaseTunerLayer):
+                self.lora_modules.append(each)
         self.scales = [
             {
                 active_adapter: lora_module.scaling[active_adapter]
@@ -24,14 +140,14 @@ class enable_lora:
         if self.activated:
             return
 
+        for registry in self.registries:
+            registry.image_stream = True
+            registry.toggles += 1
+            registry.skipped_scans += self.registered
+
         for lora_module in self.lora_modules:
-            if not isinstance(lora_module, BaseTunerLayer):
-                continue
             for active_adapter in lora_module.active_adapters:
-                if (
-                    active_adapter in condition_dict.keys()
-                    or active_adapter == "default"
-                ):
+                if is_condition_adapter(active_adapter):
                     lora_module.scaling[active_adapter] = 0.0
 
     def __exit__(
@@ -42,9 +158,9 @@ class enable_lora:
     ) -> None:
         if self.activated:
             return
+        for registry in self.registries:
+            registry.image_stream = False
         for i, lora_module in enumerate(self.lora_modules):
-            if not isinstance(lora_module, BaseTunerLayer):
-                continue
             for active_adapter in lora_module.active_adapters:
                 lora_module.scaling[active_adapter] = self.scales[i][active_adapter]
 
@@ -79,4 +195,255 @@ class set_lora_scale:
             if not isinstance(lora_module, BaseTunerLayer):
                 continue
             for active_adapter in lora_module.active_adapters:
-                lora_module.scaling[active_adapter] = self.scales[i][active_adapter]
\ No newline at end of file
+                lora_module.scaling[active_adapter] = self.scales[i][active_adapter]
+
+def packed_linear(
+    lora_module: torch.nn.Module,
+    hidden_states: torch.Tensor,
+    image_n: int,
+    activated: bool,
+) -> torch.Tensor:
+    """
+    Runs `lora_module` once over tokens packed as `[image, condition]` along
+    dim 1, the first `image_n` being the image stream. Unless `activated`,
+    the condition adapters only apply to the condition tokens, as if the
+    image tokens went through the module inside `enable_lora`.
+    """
+    if (
+        activated
+        or not isinstance(lora_module, BaseTunerLayer)
+        or lora_module.disable_adapters
+    ):
+        return lora_module(hidden_states)
+    if lora_module.merged:
+        if getattr(lora_module, "fused_scale", None) is None:
+            return lora_module(hidden_states)
+        result = lora_module.base_layer(hidden_states)
+        result[:, :image_n] -= fused_delta(lora_module, hidden_states[:, :image_n]).to(
+            result.dtype
+        )
+        return result
+    if any(lora_module.use_dora.get(each, False) for each in lora_module.active_adapters):
+        with enable_lora((lora_module,), activated):
+            image_states = lora_module(hidden_states[:, :image_n])
+        return torch.cat([image_states, lora_module(hidden_states[:, image_n:])], dim=1)
+
+    result = lora_module.base_layer(hidden_states)
+    result_dtype = result.dtype
+    for active_adapter in lora_module.active_adapters:
+        if active_adapter not in lora_module.lora_A.keys():
+            continue
+        lora_A = lora_module.lora_A[active_adapter]
+        lora_B = lora_module.lora_B[active_adapter]
+        dropout = lora_module.lora_dropout[active_adapter]
+        scaling = lora_module.scaling[active_adapter]
+        start = image_n if is_condition_adapter(active_adapter) else 0
+        x = hidden_states[:, start:].to(lora_A.weight.dtype)
+        result[:, start:] += lora_B(lora_A(dropout(x))) * scaling
+    return result.to(result_dtype)
+
+
+def fused_delta(lora_module: BaseTunerLayer, hidden_states: torch.Tensor) -> torch.Tensor:
+    """
+    Low-rank term of the condition adapters that `FusedLoRA` merged into the
+    base weight of `lora_module`, at the merge scale.
+    """
+    delta = 0
+    for adapter in lora_module.merged_adapters:
+        lora_A = lora_module.lora_A[adapter]
+        lora_B = lora_module.lora_B[adapter]
+        # the unscaled value, `StreamScaling` reads 0 on the image stream
+        scaling = dict.__getitem__(lora_module.scaling, adapter) * lora_module.fused_scale
+        delta = delta + lora_B(lora_A(hidden_states.to(lora_A.weight.dtype))) * scaling
+    return delta
+
+
+def fused_image_stream_hook(
+    lora_module: BaseTunerLayer, inputs: Tuple[torch.Tensor, ...], output: torch.Tensor
+) -> Optional[torch.Tensor]:
+    # on the image stream, the merged adapters are subtracted from the output
+    if lora_module.fused_scale is None or not lora_module.lora_registry.image_stream:
+        return None
+    return output - fused_delta(lora_module, inputs[0]).to(output.dtype)
+
+
+def image_lora_sites(transformer: torch.nn.Module) -> List[torch.nn.Module]:
+    """
+    Returns the modules whose condition adapters are disabled on the image
+    stream by `enable_lora` when `latent_lora` is not set.
+    """
+    sites = [transformer.x_embedder]
+    for block in transformer.transformer_blocks:
+        sites += [
+            block.norm1.linear,
+            block.attn.to_q,
+            block.attn.to_k,
+            block.attn.to_v,
+            block.attn.to_out[0],
+            block.ff.net[2],
+        ]
+    for block in transformer.single_transformer_blocks:
+        sites += [
+            block.norm.linear,
+            block.proj_mlp,
+            block.proj_out,
+            block.attn.to_q,
+            block.attn.to_k,
+            block.attn.to_v,
+        ]
+    return sites
+
+
+class FusedLoRA(object):
+    """
+    Inference mode with the condition adapters merged into the base weights,
+    the LoRA layers then cost a plain linear. `activate(scale)` merges them
+    scaled like `set_lora_scale`; the merged weights of the last
+    `max_variants` (adapters, scale) pairs are kept on `offload_device` so
+    switching back to a recent one is a copy instead of a merge. The LoRA
+    layers are collected on activation, deactivate before loading or
+    switching adapters.
+
+    Unless `latent_lora` is set, the sites returned by `image_lora_sites`
+    subtract the low-rank term of the merged adapters from their image stream
+    (a forward hook inside `enable_lora`, `fused_delta` in `packed_linear`),
+    so no unmerged copy of their weights is kept on the device. The original
+    weights are kept on `offload_device` to deactivate. Layers that are not a
+    plain floating point `nn.Linear` (e.g. quantized) stay unmerged.
+
+    Trade-offs of the bypass sites, which are most LoRA layers:
+
+    - Precision: the image stream is `round(W + s * BA) x - s * B(A(x))`, the
+      rounding of the merged weight to its dtype is not cancelled. In bf16
+      this adds noise of the order of the bf16 rounding itself to the image
+      stream, which the unmerged path computes from the exact base weight.
+    - Speed: the image tokens still pay the low-rank matmuls plus the
+      subtraction there, only the condition tokens (and every token of the
+      other merged layers) run at the speed of the base model.
+    """
+
+    def __init__(
+        self,
+        transformer: torch.nn.Module,
+        latent_lora: bool = False,
+        max_variants: int = 2,
+        offload_device: Union[str, torch.device] = "cpu",
+    ) -> None:
+        self.transformer = transformer
+        self.latent_lora = latent_lora
+        self.max_variants = max_variants
+        self.offload_device = offload_device
+        self.modules: List[BaseTunerLayer] = []
+        self.bypass = set()
+        self.hooks = []
+        self.original: Dict[torch.nn.Module, torch.Tensor] = {}
+        self.variants: "OrderedDict[Tuple, Dict[torch.nn.Module, torch.Tensor]]" = (
+            OrderedDict()
+        )
+        self.key: Optional[Tuple] = None
+
+    @property
+    def scale(self) -> Optional[float]:
+        return self.key[1] if self.key is not None else None
+
+    def collect(self) -> None:
+        """
+        Collects the LoRA layers to merge and copies their original weights.
+        """
+        bypass = set() if self.latent_lora else set(image_lora_sites(self.transformer))
+        self.modules = [
+            module
+            for module in self.transformer.modules()
+            if isinstance(module, BaseTunerLayer)
+            and type(module.base_layer) is torch.nn.Linear
+            and module.base_layer.weight.is_floating_point()
+            and self.adapters(module)
+        ]
+        self.bypass = {module for module in self.modules if module in bypass}
+        if self.bypass:
+            # the hooks read the image stream flag of the registry
+            lora_registry(self.transformer)
+        self.original = {
+            module: module.base_layer.weight.detach().to(self.offload_device, copy=True)
+            for module in self.modules
+        }
+
+    @staticmethod
+    def adapters(module: BaseTunerLayer) -> List[str]:
+        return [
+            each
+            for each in module.active_adapters
+            if is_condition_adapter(each) and each in module.lora_A.keys()
+        ]
+
+    @torch.no_grad()
+    def merged_weights(self, key: Tuple) -> Dict[torch.nn.Module, torch.Tensor]:
+        if key in self.variants:
+            self.variants.move_to_end(key)
+            return self.variants[key]
+        scale = key[1]
+        weights = {}
+        for module in self.modules:
+            weight = module.base_layer.weight
+            merged = self.original[module].to(weight.device, torch.float32, copy=True)
+            for adapter in self.adapters(module):
+                merged += module.get_delta_weight(adapter).float() * scale
+            weights[module] = merged.to(weight.dtype)
+        if self.max_variants > 0:
+            self.variants[key] = {
+                module: weight.to(self.offload_device)
+                for module, weight in weights.items()
+            }
+            while len(self.variants) > self.max_variants:
+                self.variants.popitem(last=False)
+        return weights
+
+    @torch.no_grad()
+    def activate(self, scale: float = 1.0) -> "FusedLoRA":
+        """
+        Merges the condition adapters at `scale` into the base weights.
+        """
+        if self.key is None:
+            self.collect()
+        adapters = tuple(
+            sorted({adapter for module in self.modules for adapter in self.adapters(module)})
+        )
+        key = (adapters, scale)
+        if self.key == key:
+            return self
+        for module, weight in self.merged_weights(key).items():
+            base_weight = module.base_layer.weight
+            base_weight.data.copy_(weight, non_blocking=True)
+            module.merged_adapters = self.adapters(module)
+            if module in self.bypass:
+                module.fused_scale = scale
+        if not self.hooks:
+            self.hooks = [
+                module.register_forward_hook(fused_image_stream_hook)
+                for module in self.bypass
+            ]
+        self.key = key
+        return self
+
+    @torch.no_grad()
+    def deactivate(self) -> None:
+        """
+        Restores the original weights and the unmerged LoRA layers.
+        """
+        if self.key is None:
+            return
+        for module in self.modules:
+            module.base_layer.weight.data.copy_(self.original[module])
+            module.merged_adapters = []
+            module.fused_scale = None
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+        self.original = {}
+        self.key = None
+
+    def __enter__(self) -> "FusedLoRA":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.deactivate()
@@ -0,0 +1,189 @@
+import bisect
+import itertools
+import threading
+import torch
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Union
+from torch.profiler import ProfilerActivity, profile, record_function
+
+from .tracing import Tracer
+
+# the `MemoryTracer` counting the transient tensors of this thread, see
+# `count_transient`
+_local = threading.local()
+
+
+class MemoryTracer(Tracer):
+    """
+    `Tracer` also recording, for every span, the allocated bytes when it ends
+    and the peak allocated bytes while it runs, to attribute the peak memory
+    of `generate` to its stages (prompt encoding, condition encoding, each
+    block, attention layout, VAE decode...). Used as a context manager around
+    the calls it traces:
+
+        with MemoryTracer() as memory:
+            generate(pipe, ..., tracer=memory)
+        memory.report()
+
+    On CUDA the allocator statistics are read at the span boundaries. On CPU
+    the allocations are recorded with the torch profiler and attributed to
+    the spans when the context exits, the byte counts are then relative to
+    the memory allocated when it was entered.
+
+    While active, the tensors of at least `large_tensor_bytes` passed to
+    `count_transient` (attention inputs, masks and outputs) in the same
+    thread are counted per name.
+    """
+
+    def __init__(
+        self,
+        device: Optional[Union[str, torch.device]] = None,
+        large_tensor_bytes: int = 64 * 1024**2,
+        synchronize: bool = False,
+    ) -> None:
+        super().__init__(synchronize=synchronize)
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == "cuda"
+        self.large_tensor_bytes = large_tensor_bytes
+        self.transients: Dict[str, Dict[str, int]] = {}
+        self._stack: List[Dict[str, Any]] = []
+        self._labels = itertools.count()
+        self._profiler: Optional[profile] = None
+
+    def __enter__(self) -> "MemoryTracer":
+        if not self.use_cuda:
+            self._profiler = profile(
+                activities=[ProfilerActivity.CPU], profile_memory=True
+            )
+            self._profiler.__enter__()
+        _local.active = self
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        _local.active = None
+        if self._profiler is not None:
+            self._profiler.__exit__(*args)
+            self._attribute_profile(self._profiler)
+            self._profiler = None
+
+    def _fold_peak(self) -> None:
+        # the device peak since the last reset belongs to every open span
+        peak = torch.cuda.max_memory_allocated(self.device)
+        for frame in self._stack:
+            frame["peak"] = max(frame["peak"], peak)
+        torch.cuda.reset_peak_memory_stats(self.device)
+
+    @contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[None]:
+        if self.use_cuda:
+            self._fold_peak()
+            frame = {"peak": torch.cuda.memory_allocated(self.device)}
+            self._stack.append(frame)
+            try:
+                with super().span(name, **args):
+                    yield
+                self._fold_peak()
+            finally:
+                self._stack.pop()
+            # the event of this span was recorded last, after its children
+            self.events[-1]["args"].update(
+                allocated_bytes=torch.cuda.memory_allocated(self.device),
+                peak_bytes=frame["peak"],
+            )
+        elif self._profiler is not None:
+            # matched with the profiler events on exit
+            label = f"{name}#{next(self._labels)}"
+            args["label"] = label
+            with super().span(name, **args), record_function(label):
+                yield
+        else:
+            with super().span(name, **args):
+                yield
+
+    def _attribute_profile(self, profiler: profile) -> None:
+        # the public event list only keeps the net allocation of each op, the
+        # kineto events keep every allocation and free with its timestamp
+        events = profiler.profiler.kineto_results.events()
+        allocations = sorted(
+            (event.start_ns(), event.nbytes())
+            for event in events
+            if event.name() == "[memory]" and event.device_type().name == "CPU"
+        )
+        times = [time for time, _ in allocations]
+        allocated = list(itertools.accumulate(nbytes for _, nbytes in allocations))
+        ranges = {
+            event.name(): (event.start_ns(), event.end_ns())
+            for event in events
+            if event.is_user_annotation()
+        }
+        for event in self.events:
+            label = event["args"].pop("label", None)
+            if label not in ranges:
+                continue
+            start, end = ranges[label]
+            first = bisect.bisect_left(times, start)
+            last = bisect.bisect_right(times, end)
+            before = allocated[first - 1] if first > 0 else 0
+            event["args"]["allocated_bytes"] = allocated[last - 1] if last > 0 else 0
+            event["args"]["peak_bytes"] = max([before] + allocated[first:last])
+
+    def count(self, name: str, tensor: torch.Tensor) -> None:
+        nbytes = tensor.numel() * tensor.element_size()
+        if nbytes < self.large_tensor_bytes:
+            return
+        entry = self.transients.setdefault(
+            name, {"count": 0, "max_bytes": 0, "total_bytes": 0}
+        )
+        entry["count"] += 1
+        entry["max_bytes"] = max(entry["max_bytes"], nbytes)
+        entry["total_bytes"] += nbytes
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Returns, per span name, the span count, the highest peak and the
+        allocated bytes at the end of the last span, and the counts of large
+        transient tensors.
+        """
+        stages: Dict[str, Dict[str, int]] = {}
+        for event in self.events:
+            if "peak_bytes" not in event["args"]:
+                continue
+            entry = stages.setdefault(event["name"], {"count": 0, "peak_bytes": 0})
+            entry["count"] += 1
+            entry["peak_bytes"] = max(entry["peak_bytes"], event["args"]["peak_bytes"])
+            entry["allocated_bytes"] = event["args"]["allocated_bytes"]
+        return {"stages": stages, "transients": dict(self.transients)}
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        trace = super().chrome_trace()
+        # allocated bytes as a counter track below the spans
+        for event in self.events:
+            if "allocated_bytes" in event["args"]:
+                trace["traceEvents"].append(
+                    {
+                        "name": "allocated",
+                        "ph": "C",
+                        "ts": event["ts"] + event["dur"],
+                        "pid": event["pid"],
+                        "args": {"bytes": event["args"]["allocated_bytes"]},
+                    }
+                )
+        return trace
+
+    def clear(self) -> None:
+        super().clear()
+        self.transients.clear()
+
+
+def count_transient(name: str, *tensors: torch.Tensor) -> None:
+    """
+    Counts the large `tensors` in the `MemoryTracer` active in this thread,
+    does nothing when no tracer is active.
+    """
+    active = getattr(_local, "active", None)
+    if active is None:
+        return
+    for tensor in tensors:
+        active.count(name, tensor)
@@ -1,14 +1,20 @@
 #As is from OminiControl
+import hashlib
 from diffusers.pipelines import FluxPipeline
 from diffusers.utils import logging
 from diffusers.pipelines.flux.pipeline_flux import logger
+import torch
 from torch import Tensor
+from typing import List, Optional, Tuple, Union
+from .cache import LatentCache, PromptCache, content_key
+from .tracing import Tracer, span
 
 
-def encode_images(pipeline: FluxPipeline, images: Tensor):
+def encode_images(pipeline: FluxPipeline, images: Tensor, deterministic: bool = False):
     images = pipeline.image_processor.preprocess(images)
     images = images.to(pipeline.device).to(pipeline.dtype)
-    images = pipeline.vae.encode(images).latent_dist.sample()
+    latent_dist = pipeline.vae.encode(images).latent_dist
+    images = latent_dist.mode() if deterministic else latent_dist.sample()
     images = (
         images - pipeline.vae.config.shift_factor
     ) * pipeline.vae.config.scaling_factor
@@ -31,14 +37,178 @@ def encode_images(pipeline: FluxPipeline, images: Tensor):
     return images_tokens, images_ids
 
 
-def prepare_text_input(pipeline: FluxPipeline, prompts, max_sequence_length=512):
+def encode_condition_images(
+    pipeline: FluxPipeline,
+    images: List,
+    latent_cache: Optional[LatentCache] = None,
+    tracer: Optional[Tracer] = None,
+) -> List[Tuple[Tensor, Tensor]]:
+    """
+    Encodes condition images, identical images are encoded only once and the
+    distinct ones of the same size share a single `vae.encode` call.
+    Returns one `(tokens, ids)` pair per image, copies of the cached tensors
+    that can be modified in place.
+    """
+    deterministic = latent_cache is not None and latent_cache.deterministic
+    keys = [content_key(image) for image in images]
+    encoded = {}
+    pending = {}
+    for key, image in zip(keys, images):
+        if key in encoded or key in pending:
+            continue
+        cached = latent_cache.get(key) if latent_cache is not None else None
+        if cached is not None:
+            encoded[key] = cached
+        else:
+            pending[key] = image
+
+    # the key ends with the size of the image, batch the images sharing it
+    batches = {}
+    for key, image in pending.items():
+        batches.setdefault(key[1:], []).append((key, image))
+    for size, batch in batches.items():
+        with span(tracer, "vae_encode", images=len(batch), size=str(size[-1])):
+            tokens, ids = encode_images(
+                pipeline, [image for _, image in batch], deterministic=deterministic
+            )
+        for i, (key, _) in enumerate(batch):
+            encoded[key] = (tokens[i : i + 1].clone(), ids)
+            if latent_cache is not None:
+                latent_cache.put(key, encoded[key])
+
+    return [(encoded[key][0].clone(), encoded[key][1].clone()) for key in keys]
+
+
+def text_encoder_key(pipeline: FluxPipeline) -> str:
+    """
+    Returns a fingerprint of the text encoders of `pipeline` (class, config
+    with the checkpoint path, revision and dtype), so that a persistent
+    prompt cache is not served to another encoder or checkpoint.
+    """
+    parts = []
+    for name in ("text_encoder", "text_encoder_2"):
+        encoder = getattr(pipeline, name, None)
+        if encoder is None:
+            parts.append(None)
+            continue
+        config = getattr(encoder, "config", None)
+        parts.append(
+            (
+                type(encoder).__name__,
+                config.to_json_string() if hasattr(config, "to_json_string") else None,
+                getattr(config, "_commit_hash", None),
+                str(getattr(encoder, "dtype", None)),
+            )
+        )
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+def prompt_cache_keys(
+    pipeline: FluxPipeline,
+    prompts: List[str],
+    prompts_2: Optional[List[str]] = None,
+    max_sequence_length: int = 512,
+    lora_scale: Optional[float] = None,
+) -> List[Tuple]:
+    """
+    Returns the `PromptCache` keys of `prompts`.
+    """
+    encoder = text_encoder_key(pipeline)
+    return [
+        (encoder, each, each_2, max_sequence_length, lora_scale)
+        for each, each_2 in zip(prompts, prompts_2 or prompts)
+    ]
+
+
+def encode_prompt_cached(
+    pipeline: FluxPipeline,
+    prompt: Union[str, List[str]],
+    prompt_2: Optional[Union[str, List[str]]] = None,
+    device: Optional[torch.device] = None,
+    num_images_per_prompt: int = 1,
+    prompt_embeds: Optional[Tensor] = None,
+    pooled_prompt_embeds: Optional[Tensor] = None,
+    max_sequence_length: int = 512,
+    lora_scale: Optional[float] = None,
+    prompt_cache: Optional[PromptCache] = None,
+):
+    """
+    `pipeline.encode_prompt` with a prompt cache in front of it. Prompts are
+    cached one by one, only the missing ones of a batch are encoded.
+    """
+    if prompt_cache is None or prompt_embeds is not None:
+        return pipeline.encode_prompt(
+            prompt=prompt,
+            prompt_2=prompt_2,
+            prompt_embeds=prompt_embeds,
+            pooled_prompt_embeds=pooled_prompt_embeds,
+            device=device,
+            num_images_per_prompt=num_images_per_prompt,
+            max_sequence_length=max_sequence_length,
+            lora_scale=lora_scale,
+        )
+    device = device or pipeline._execution_device
+    prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+    prompts_2 = prompt_2 or prompts
+    prompts_2 = [prompts_2] if isinstance(prompts_2, str) else list(prompts_2)
+    keys = prompt_cache_keys(
+        pipeline, prompts, prompts_2, max_sequence_length, lora_scale
+    )
+
+    entries = {}
+    missing = []
+    for key in keys:
+        if key in entries or key in missing:
+            continue
+        entry = prompt_cache.get(key)
+        if entry is None:
+            missing.append(key)
+        elif entry[0].device != torch.device(device):
+            # loaded from disk, keep the device copy in memory
+            entries[key] = tuple(each.to(device) for each in entry)
+            prompt_cache.put(key, entries[key])
+        else:
+            entries[key] = entry
+    if missing:
+        embeds, pooled, text_ids = pipeline.encode_prompt(
+            prompt=[key[1] for key in missing],
+            prompt_2=[key[2] for key in missing],
+            prompt_embeds=None,
+            pooled_prompt_embeds=None,
+            device=device,
+            num_images_per_prompt=1,
+            max_sequence_length=max_sequence_length,
+            lora_scale=lora_scale,
+        )
+        for i, key in enumerate(missing):
+            entries[key] = (embeds[i : i + 1].clone(), pooled[i : i + 1].clone(), text_ids)
+            prompt_cache.put(key, entries[key])
+
+    prompt_embeds = torch.cat([entries[key][0] for key in keys], dim=0)
+    pooled_prompt_embeds = torch.cat([entries[key][1] for key in keys], dim=0)
+    text_ids = entries[keys[0]][2]
+    if num_images_per_prompt > 1:
+        prompt_embeds = prompt_embeds.repeat_interleave(num_images_per_prompt, dim=0)
+        pooled_prompt_embeds = pooled_prompt_embeds.repeat_interleave(
+            num_images_per_prompt, dim=0
+        )
+    return prompt_embeds, pooled_prompt_embeds, text_ids
+
+
+def prepare_text_input(
+    pipeline: FluxPipeline,
+    prompts,
+    max_sequence_length=512,
+    prompt_cache: Optional[PromptCache] = None,
+):
     # Turn off warnings (CLIP overflow)
     logger.setLevel(logging.ERROR)
     (
         prompt_embeds,
         pooled_prompt_embeds,
         text_ids,
-    ) = pipeline.encode_prompt(
+    ) = encode_prompt_cached(
+        pipeline,
         prompt=prompts,
         prompt_2=None,
         prompt_embeds=None,
@@ -47,6 +217,7 @@ def prepare_text_input(pipeline: FluxPipeline, prompts, max_sequence_length=512)
         num_images_per_prompt=1,
         max_sequence_length=max_sequence_length,
         lora_scale=None,
+        prompt_cache=prompt_cache,
     )
     # Turn on warnings
     logger.setLevel(logging.WARNING)
@@ -0,0 +1,99 @@
+import torch
+from typing import List, Optional, Sequence
+from diffusers.pipelines import FluxPipeline
+from PIL import Image
+
+from .pipeline_tools import encode_images
+
+# Linear approximation of the FLUX VAE decoder: RGB in [-1, 1] of each latent
+# pixel from its 16 channels (scaled and shifted latents, as unpacked).
+FLUX_LATENT_RGB_FACTORS = [
+    [-0.0346, 0.0244, 0.0681],
+    [0.0034, 0.0210, 0.0687],
+    [0.0275, -0.0668, -0.0433],
+    [-0.0174, 0.0160, 0.0617],
+    [0.0859, 0.0721, 0.0329],
+    [0.0004, 0.0383, 0.0115],
+    [0.0405, 0.0861, 0.0915],
+    [-0.0236, -0.0185, -0.0259],
+    [-0.0245, 0.0250, 0.1180],
+    [0.1008, 0.0755, -0.0421],
+    [-0.0515, 0.0201, 0.0011],
+    [0.0428, -0.0012, -0.0036],
+    [0.0817, 0.0765, 0.0749],
+    [-0.1264, -0.0522, -0.1103],
+    [-0.0280, -0.0881, -0.0499],
+    [-0.1262, -0.0982, -0.0778],
+]
+FLUX_LATENT_RGB_BIAS = [-0.0329, -0.0718, -0.0851]
+
+
+class Preview(object):
+    """
+    Intermediate result of `generate_stream` after denoising step `step`.
+    """
+
+    def __init__(self, step: int, images: List[Image.Image]) -> None:
+        self.step = step
+        self.images = images
+
+
+class LatentPreviewer(object):
+    """
+    Cheap previews of unpacked latents (B, C, H / 8, W / 8): a per-pixel
+    linear projection to RGB instead of a VAE decode, one preview pixel per
+    latent pixel (`upscale` enlarges them with nearest neighbours).
+
+    The default factors approximate the FLUX VAE, `fit` computes them for
+    another VAE from a few images.
+    """
+
+    def __init__(
+        self,
+        factors: Optional[Sequence[Sequence[float]]] = None,
+        bias: Optional[Sequence[float]] = None,
+        upscale: int = 1,
+    ) -> None:
+        self.factors = torch.as_tensor(
+            FLUX_LATENT_RGB_FACTORS if factors is None else factors, dtype=torch.float32
+        )
+        self.bias = torch.as_tensor(
+            FLUX_LATENT_RGB_BIAS if bias is None else bias, dtype=torch.float32
+        )
+        self.upscale = upscale
+
+    @classmethod
+    def fit(
+        cls, pipeline: FluxPipeline, images: List[Image.Image], upscale: int = 1
+    ) -> "LatentPreviewer":
+        """
+        Least-squares fit of the projection from the latents of `images` to
+        their pixels averaged over each latent pixel.
+        """
+        latents, _ = encode_images(pipeline, images, deterministic=True)
+        height, width = images[0].size[1], images[0].size[0]
+        latents = pipeline._unpack_latents(
+            latents, height, width, pipeline.vae_scale_factor
+        ).float()
+        pixels = pipeline.image_processor.preprocess(images).float()
+        pixels = torch.nn.functional.adaptive_avg_pool2d(pixels, latents.shape[-2:])
+        inputs = latents.permute(0, 2, 3, 1).reshape(-1, latents.shape[1]).cpu()
+        inputs = torch.cat([inputs, torch.ones_like(inputs[:, :1])], dim=1)
+        targets = pixels.permute(0, 2, 3, 1).reshape(-1, 3).cpu()
+        solution = torch.linalg.lstsq(inputs, targets).solution
+        return cls(solution[:-1], solution[-1], upscale=upscale)
+
+    def __call__(self, latents: torch.Tensor) -> List[Image.Image]:
+        factors = self.factors.to(latents.device)
+        bias = self.bias.to(latents.device)
+        rgb = torch.einsum("bchw,cr->bhwr", latents.float(), factors) + bias
+        rgb = ((rgb + 1) * 127.5).clamp(0, 255).to(torch.uint8).cpu().numpy()
+        previews = [Image.fromarray(each) for each in rgb]
+        if self.upscale > 1:
+            previews = [
+                each.resize(
+                    (each.width * self.upscale, each.height * self.upscale), Image.NEAREST
+                )
+                for each in previews
+            ]
+        return previews
@@ -0,0 +1,192 @@
+import threading
+import time
+import torch
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Optional
+from diffusers.pipelines import FluxPipeline
+
+from .condition import image_size
+from .generate import GenerationRequest, generate_batch
+
+
+class PendingRequest(object):
+    def __init__(self, request: GenerationRequest, params: Dict[str, Any]) -> None:
+        self.request = request
+        self.params = params
+        self.future: Future = Future()
+        self.enqueued = time.monotonic()
+
+
+def param_key(value: Any) -> Hashable:
+    """
+    Returns a hashable key of a generation parameter: containers by content,
+    tensors and unhashable objects by identity, other values as is.
+    """
+    if isinstance(value, dict):
+        return tuple((key, param_key(value[key])) for key in sorted(value))
+    if isinstance(value, (list, tuple)):
+        return tuple(param_key(each) for each in value)
+    if isinstance(value, torch.Tensor):
+        return ("tensor", id(value))
+    try:
+        hash(value)
+    except TypeError:
+        return (type(value).__name__, id(value))
+    return value
+
+
+def batch_key(request: GenerationRequest, params: Dict[str, Any]) -> Hashable:
+    """
+    Returns the key of the requests that can share a batch: same generation
+    parameters and conditions of the same type, size and position.
+    """
+    conditions = tuple(
+        (
+            condition.condition_type,
+            tuple(image_size(condition.condition)),
+            tuple(condition.position_delta or ()),
+        )
+        for condition in request.conditions or ()
+    )
+    return param_key(params), conditions
+
+
+def pipeline_runner(pipeline: FluxPipeline) -> Callable[..., List[Any]]:
+    """
+    Returns a `run_batch` function generating the batched requests with
+    `generate_batch` on the given pipeline.
+    """
+
+    def run_batch(requests: List[GenerationRequest], **params: dict) -> List[Any]:
+        return generate_batch(pipeline, requests, **params).images
+
+    return run_batch
+
+
+class BatchingServer(object):
+    """
+    Dynamic micro-batching in front of the pipeline. Submitted requests are
+    queued and grouped by `batch_key`; a group is dispatched to the worker
+    thread when it reaches `max_batch_size` or when its oldest request has
+    waited `max_wait` seconds. Callers get a `Future` of their result.
+
+    `run_batch(requests, **params)` returns one result per request, or a
+    `Future` of them (see `StagedExecutor`), it is only ever called from the
+    worker thread, which thus owns the pipeline.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[..., List[Any]],
+        max_batch_size: int = 4,
+        max_wait: float = 0.05,
+    ) -> None:
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.groups: "OrderedDict[Hashable, List[PendingRequest]]" = OrderedDict()
+        self.batch_sizes: List[int] = []
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._worker: Optional[threading.Thread] = None
+
+    def start(self) -> "BatchingServer":
+        with self._condition:
+            if self._worker is None:
+                self._stopped = False
+                self._worker = threading.Thread(target=self._serve, daemon=True)
+                self._worker.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops the worker once the already queued requests are served.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+    def __enter__(self) -> "BatchingServer":
+        return self.start()
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+    def submit(self, request: GenerationRequest, **params: dict) -> Future:
+        pending = PendingRequest(request, params)
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("The server is stopped")
+            self.groups.setdefault(batch_key(request, params), []).append(pending)
+            self._condition.notify()
+        return pending.future
+
+    def _next_batch(self) -> Optional[List[PendingRequest]]:
+        with self._condition:
+            while True:
+                if not self.groups:
+                    if self._stopped:
+                        return None
+                    self._condition.wait()
+                    continue
+                now = time.monotonic()
+                timeout = None
+                for key, group in self.groups.items():
+                    waited = now - group[0].enqueued
+                    if (
+                        len(group) >= self.max_batch_size
+                        or waited >= self.max_wait
+                        or self._stopped
+                    ):
+                        batch = group[: self.max_batch_size]
+                        if len(group) > len(batch):
+                            self.groups[key] = group[len(batch) :]
+                        else:
+                            del self.groups[key]
+                        return batch
+                    remaining = self.max_wait - waited
+                    timeout = remaining if timeout is None else min(timeout, remaining)
+                self._condition.wait(timeout)
+
+    def _serve(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            batch = [each for each in batch if each.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            self.batch_sizes.append(len(batch))
+            try:
+                results = self.run_batch(
+                    [each.request for each in batch], **batch[0].params
+                )
+            except Exception as e:
+                for each in batch:
+                    each.future.set_exception(e)
+                continue
+            if isinstance(results, Future):
+                # staged execution, the worker moves on to the next batch
+                results.add_done_callback(
+                    lambda done, batch=batch: resolve(batch, done)
+                )
+            else:
+                for each, result in zip(batch, results):
+                    each.future.set_result(result)
+
+
+def resolve(batch: List[PendingRequest], results: Future) -> None:
+    """
+    Resolves the requests of `batch` from the `Future` of their results.
+    """
+    error = results.exception()
+    if error is not None:
+        for each in batch:
+            each.future.set_exception(error)
+        return
+    for each, result in zip(batch, results.result()):
+        each.future.set_result(result)
@@ -0,0 +1,282 @@
+import base64
+import importlib
+import io
+import json
+import mmap
+import os
+import pickle
+import struct
+import torch
+from typing import Any, Dict, Optional, Union
+from accelerate import init_empty_weights
+from diffusers.pipelines import FluxPipeline
+from peft import LoraConfig
+from safetensors.torch import save_file
+from torch.utils._python_dispatch import is_traceable_wrapper_subclass
+
+from .lora_controller import FusedLoRA
+
+SNAPSHOT_FILE = "snapshot.json"
+WEIGHTS_FILE = "weights.safetensors"
+COMPONENTS = (
+    "transformer",
+    "vae",
+    "text_encoder",
+    "text_encoder_2",
+    "tokenizer",
+    "tokenizer_2",
+    "scheduler",
+)
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+    "F8_E4M3": torch.float8_e4m3fn,
+    "F8_E5M2": torch.float8_e5m2,
+}
+
+
+def class_path(obj: Any) -> str:
+    return f"{type(obj).__module__}.{type(obj).__qualname__}"
+
+
+# the packages whose classes a snapshot may name, in its JSON (components,
+# tensor subclasses) or in the pickled tensor subclass contexts
+TRUSTED_PACKAGES = ("diffusers", "transformers", "peft", "torch", "torchao")
+# what pickle itself needs for plain objects
+TRUSTED_GLOBALS = {
+    ("copyreg", "_reconstructor"),
+    ("builtins", "object"),
+    ("builtins", "set"),
+    ("builtins", "frozenset"),
+    ("builtins", "slice"),
+    ("builtins", "complex"),
+}
+
+
+def is_trusted(module: str) -> bool:
+    return module.split(".", 1)[0] in TRUSTED_PACKAGES
+
+
+def import_class(path: str) -> type:
+    module, name = path.rsplit(".", 1)
+    if not is_trusted(module):
+        raise ValueError(f"Snapshot class {path} is not from {TRUSTED_PACKAGES}")
+    return getattr(importlib.import_module(module), name)
+
+
+class ContextUnpickler(pickle.Unpickler):
+    """
+    Unpickler of the tensor subclass contexts, restricted to the globals of
+    `TRUSTED_PACKAGES` and `TRUSTED_GLOBALS`.
+    """
+
+    def find_class(self, module: str, name: str) -> Any:
+        if is_trusted(module) or (module, name) in TRUSTED_GLOBALS:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(
+            f"Snapshot context global {module}.{name} is not allowed"
+        )
+
+
+def mmap_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Returns the tensors of a safetensors file as CPU views of a copy-on-write
+    memory map of it: nothing is read until a tensor is used or copied, e.g.
+    by moving the model to the device.
+    """
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    header.pop("__metadata__", None)
+    tensors = {}
+    for key, entry in header.items():
+        dtype = SAFETENSORS_DTYPES[entry["dtype"]]
+        start, end = entry["data_offsets"]
+        if end == start:
+            tensors[key] = torch.empty(entry["shape"], dtype=dtype)
+            continue
+        tensors[key] = torch.frombuffer(
+            buffer,
+            dtype=dtype,
+            count=(end - start) // dtype.itemsize,
+            offset=8 + header_size + start,
+        ).view(entry["shape"])
+    return tensors
+
+
+def flatten_tensor(
+    key: str,
+    tensor: torch.Tensor,
+    tensors: Dict[str, torch.Tensor],
+    subclasses: Dict[str, Dict[str, Any]],
+) -> None:
+    # quantized weights (e.g. torchao) are tensor subclasses, they are stored
+    # as their inner tensors plus the pickled context to rebuild them
+    if is_traceable_wrapper_subclass(tensor):
+        attrs, context = tensor.__tensor_flatten__()
+        subclasses[key] = {
+            "class": class_path(tensor),
+            "attrs": list(attrs),
+            "context": base64.b64encode(pickle.dumps(context)).decode(),
+            "shape": list(tensor.shape),
+            "stride": list(tensor.stride()),
+        }
+        for attr in attrs:
+            flatten_tensor(f"{key}::{attr}", getattr(tensor, attr), tensors, subclasses)
+    else:
+        tensors[key] = tensor.detach().to("cpu").contiguous()
+
+
+def unflatten_tensor(
+    key: str, tensors: Dict[str, torch.Tensor], subclasses: Dict[str, Dict[str, Any]]
+) -> torch.Tensor:
+    if key not in subclasses:
+        return tensors[key]
+    entry = subclasses[key]
+    inner = {
+        attr: unflatten_tensor(f"{key}::{attr}", tensors, subclasses)
+        for attr in entry["attrs"]
+    }
+    return import_class(entry["class"]).__tensor_unflatten__(
+        inner,
+        ContextUnpickler(io.BytesIO(base64.b64decode(entry["context"]))).load(),
+        torch.Size(entry["shape"]),
+        tuple(entry["stride"]),
+    )
+
+
+def adapter_config(config: LoraConfig) -> Dict[str, Any]:
+    return {
+        key: sorted(value) if isinstance(value, set) else value
+        for key, value in config.to_dict().items()
+    }
+
+
+@torch.no_grad()
+def save_snapshot(
+    pipeline: FluxPipeline, directory: str, fused_lora: Optional[FusedLoRA] = None
+) -> None:
+    """
+    Writes the assembled pipeline to `directory`: the weights of every model
+    (quantized transformer and loaded LoRA layers included) to a single
+    safetensors file, the configs, loaded adapters and active adapters to
+    `snapshot.json`, the tokenizers and scheduler to their subdirectories.
+
+    With a `fused_lora`, the original base weights are written so that
+    `FusedLoRA` can merge the adapters again after `load_snapshot`.
+    """
+    os.makedirs(directory, exist_ok=True)
+    original = {}
+    if fused_lora is not None and fused_lora.key is not None:
+        original = {
+            id(module.base_layer.weight): weight
+            for module, weight in fused_lora.original.items()
+        }
+    tensors: Dict[str, torch.Tensor] = {}
+    subclasses: Dict[str, Dict[str, Any]] = {}
+    # tied weights (e.g. the T5 embeddings) are written once
+    aliases: Dict[str, str] = {}
+    seen: Dict[tuple, str] = {}
+    snapshot: Dict[str, Any] = {"components": {}}
+    for name in COMPONENTS:
+        component = getattr(pipeline, name, None)
+        if component is None:
+            snapshot["components"][name] = None
+            continue
+        entry = {"class": class_path(component)}
+        if isinstance(component, torch.nn.Module):
+            config = component.config
+            entry["config"] = (
+                config.to_dict() if hasattr(config, "to_dict") else dict(config)
+            )
+            for key, tensor in component.state_dict(keep_vars=True).items():
+                key = f"{name}.{key}"
+                tensor = original.get(id(tensor), tensor)
+                if not is_traceable_wrapper_subclass(tensor):
+                    identity = (
+                        tensor.untyped_storage().data_ptr(),
+                        tensor.storage_offset(),
+                        tuple(tensor.shape),
+                        tensor.dtype,
+                    )
+                    if identity in seen:
+                        aliases[key] = seen[identity]
+                        continue
+                    seen[identity] = key
+                flatten_tensor(key, tensor, tensors, subclasses)
+            if getattr(component, "peft_config", None):
+                entry["adapters"] = {
+                    adapter: adapter_config(config)
+                    for adapter, config in component.peft_config.items()
+                }
+                entry["active_adapters"] = component.active_adapters()
+        else:
+            component.save_pretrained(os.path.join(directory, name))
+        snapshot["components"][name] = entry
+    snapshot["subclasses"] = subclasses
+    snapshot["aliases"] = aliases
+    save_file(tensors, os.path.join(directory, WEIGHTS_FILE))
+    with open(os.path.join(directory, SNAPSHOT_FILE), "w") as f:
+        json.dump(snapshot, f, default=str)
+
+
+def build_module(cls: type, entry: Dict[str, Any]) -> torch.nn.Module:
+    # the parameters stay on the meta device until the snapshot is assigned
+    with init_empty_weights():
+        if hasattr(cls, "config_class"):
+            module = cls(cls.config_class.from_dict(entry["config"]))
+        else:
+            module = cls.from_config(entry["config"])
+        for adapter, config in entry.get("adapters", {}).items():
+            module.add_adapter(LoraConfig.from_peft_type(**config), adapter_name=adapter)
+    return module
+
+
+def load_snapshot(
+    directory: str, device: Optional[Union[str, torch.device]] = None
+) -> FluxPipeline:
+    """
+    Loads a pipeline written by `save_snapshot`. The models are built without
+    weights and assigned the memory-mapped tensors of the snapshot, which are
+    read from disk when moved to `device` (or first used on CPU).
+
+    Only load snapshots from a trusted source: the classes named in the
+    snapshot are imported and instantiated. They are restricted to
+    `TRUSTED_PACKAGES`, which narrows but does not remove what a crafted
+    snapshot could run.
+    """
+    with open(os.path.join(directory, SNAPSHOT_FILE)) as f:
+        snapshot = json.load(f)
+    tensors = mmap_safetensors(os.path.join(directory, WEIGHTS_FILE))
+    subclasses, aliases = snapshot["subclasses"], snapshot["aliases"]
+    components = {}
+    for name, entry in snapshot["components"].items():
+        if entry is None:
+            components[name] = None
+            continue
+        cls = import_class(entry["class"])
+        if "config" not in entry:
+            components[name] = cls.from_pretrained(os.path.join(directory, name))
+            continue
+        module = build_module(cls, entry)
+        state_dict = {}
+        for key in module.state_dict(keep_vars=True):
+            stored = aliases.get(f"{name}.{key}", f"{name}.{key}")
+            state_dict[key] = unflatten_tensor(stored, tensors, subclasses)
+        module.load_state_dict(state_dict, strict=True, assign=True)
+        if entry.get("active_adapters"):
+            module.set_adapters(entry["active_adapters"])
+        components[name] = module.eval()
+    pipeline = FluxPipeline(**components)
+    if device is not None:
+        pipeline = pipeline.to(device)
+    return pipeline
@@ -0,0 +1,263 @@
+import threading
+import time
+import torch
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from diffusers.pipelines import FluxPipeline
+
+from .cache import LatentCache, PromptCache
+from .condition import condition_images
+from .generate import (
+    GenerationRequest,
+    decode_latents,
+    generate_batch,
+    prepare_params,
+)
+from .pipeline_tools import (
+    encode_condition_images,
+    encode_prompt_cached,
+    prompt_cache_keys,
+)
+
+STAGES = ("prepare", "run", "finish")
+
+
+class StagedExecutor(object):
+    """
+    Overlaps the stages of consecutive items: while `run` (the denoising
+    loop) processes item N on its own thread, `prepare` of item N+1 and
+    `finish` of item N-1 run in a pool of `workers` threads. In steady state
+    the throughput approaches one item per `run` duration.
+
+    `submit` returns a `Future` of `finish(run(prepare(item)))` and blocks
+    while `max_pending` items are in flight. A missing stage passes its input
+    through. `stats` gives the count and busy seconds of each stage.
+    """
+
+    def __init__(
+        self,
+        run: Callable[[Any], Any],
+        prepare: Optional[Callable[[Any], Any]] = None,
+        finish: Optional[Callable[[Any], Any]] = None,
+        workers: int = 2,
+        max_pending: int = 3,
+    ) -> None:
+        self.stages = {"prepare": prepare, "run": run, "finish": finish}
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="stage")
+        # a single thread owns the transformer
+        self._runner = ThreadPoolExecutor(1, thread_name_prefix="run")
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.busy = {name: 0.0 for name in STAGES}
+        self.counts = {name: 0 for name in STAGES}
+
+    def _stage(self, name: str, value: Any) -> Any:
+        fn = self.stages[name]
+        if fn is None:
+            return value
+        start = time.perf_counter()
+        try:
+            return fn(value)
+        finally:
+            with self._lock:
+                self.busy[name] += time.perf_counter() - start
+                self.counts[name] += 1
+
+    def submit(self, item: Any) -> Future:
+        self._slots.acquire()
+        result: Future = Future()
+        result.set_running_or_notify_cancel()
+
+        def then(executor: ThreadPoolExecutor, name: Optional[str]):
+            def callback(done: Future) -> None:
+                error = done.exception()
+                if error is not None:
+                    self._slots.release()
+                    result.set_exception(error)
+                elif name is None:
+                    self._slots.release()
+                    result.set_result(done.result())
+                else:
+                    executor.submit(self._stage, name, done.result()).add_done_callback(
+                        then(*next_stage[name])
+                    )
+
+            return callback
+
+        next_stage = {
+            "run": (self._pool, "finish"),
+            "finish": (None, None),
+        }
+        self._pool.submit(self._stage, "prepare", item).add_done_callback(
+            then(self._runner, "run")
+        )
+        return result
+
+    def shutdown(self) -> None:
+        """
+        Waits for the submitted items and stops the threads.
+        """
+        for _ in range(self.max_pending):
+            self._slots.acquire()
+        self._runner.shutdown()
+        self._pool.shutdown()
+
+    def __enter__(self) -> "StagedExecutor":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.shutdown()
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                name: {"count": self.counts[name], "busy": self.busy[name]}
+                for name in STAGES
+            }
+
+
+class GenerationStages(object):
+    """
+    The stages of `generate_batch` for a `StagedExecutor`, over items
+    `(requests, params)`:
+
+    - `prepare` encodes the conditions and prompts into the latent and prompt
+      caches (added to `params` when missing), so `run` finds them there.
+    - `run` is `generate_batch` up to the latents.
+    - `finish` decodes them with the VAE and postprocesses them.
+
+    On CUDA, `prepare` and `finish` use their own streams, synchronized with
+    the denoising through events.
+    """
+
+    def __init__(
+        self,
+        pipeline: FluxPipeline,
+        latent_cache: Optional[LatentCache] = None,
+        prompt_cache: Optional[PromptCache] = None,
+    ) -> None:
+        self.pipeline = pipeline
+        self.latent_cache = latent_cache or LatentCache()
+        self.prompt_cache = prompt_cache or PromptCache()
+        self.use_streams = pipeline._execution_device.type == "cuda"
+        self.streams = (
+            {name: torch.cuda.Stream() for name in ("prepare", "finish")}
+            if self.use_streams
+            else {}
+        )
+
+    def stream(self, name: str):
+        if not self.use_streams:
+            return nullcontext()
+        return torch.cuda.stream(self.streams[name])
+
+    def record(self) -> Optional[torch.cuda.Event]:
+        if not self.use_streams:
+            return None
+        event = torch.cuda.Event()
+        event.record()
+        return event
+
+    def size(self, params: Dict[str, Any]) -> Tuple[int, int]:
+        _, _, height, width, *_ = prepare_params(**params)
+        default = self.pipeline.default_sample_size * self.pipeline.vae_scale_factor
+        return height or default, width or default
+
+    @staticmethod
+    def wait(event: Optional[torch.cuda.Event]) -> None:
+        if event is not None:
+            torch.cuda.current_stream().wait_event(event)
+
+    def hand_over(self, tensors: Iterable[torch.Tensor]) -> None:
+        # allocated on the prepare stream and used by the denoising, which
+        # runs on the default stream of the runner thread
+        if not self.use_streams:
+            return
+        stream = torch.cuda.default_stream()
+        for tensor in tensors:
+            tensor.record_stream(stream)
+
+    @torch.no_grad()
+    def prepare(
+        self, item: Tuple[List[GenerationRequest], Dict[str, Any]]
+    ) -> Tuple[List[GenerationRequest], Dict[str, Any], Any]:
+        requests, params = item
+        params = dict(params)
+        params.setdefault("latent_cache", self.latent_cache)
+        params.setdefault("prompt_cache", self.prompt_cache)
+        height, width = self.size(params)
+        with self.stream("prepare"):
+            conditions = [
+                condition
+                for request in requests
+                for condition in request.conditions or ()
+            ]
+            if conditions:
+                images, _ = condition_images(
+                    conditions, params.get("condition_resolution"), (height, width)
+                )
+                latent_cache = params["latent_cache"]
+                with latent_cache.lock:
+                    cached = set(latent_cache.entries)
+                encode_condition_images(self.pipeline, images, latent_cache)
+                # the entries added by this encode, `run` copies them
+                with latent_cache.lock:
+                    added = [
+                        entry
+                        for key, entry in latent_cache.entries.items()
+                        if key not in cached
+                    ]
+                self.hand_over(tensor for entry in added for tensor in entry)
+            prompts = [request.prompt for request in requests]
+            max_sequence_length = params.get("max_sequence_length", 512)
+            lora_scale = (params.get("joint_attention_kwargs") or {}).get("scale", None)
+            encode_prompt_cached(
+                self.pipeline,
+                prompt=prompts,
+                device=self.pipeline._execution_device,
+                max_sequence_length=max_sequence_length,
+                lora_scale=lora_scale,
+                prompt_cache=params["prompt_cache"],
+            )
+            # the cached embeddings
+            self.hand_over(
+                tensor
+                for key in prompt_cache_keys(
+                    self.pipeline, prompts, None, max_sequence_length, lora_scale
+                )
+                for tensor in params["prompt_cache"].get(key) or ()
+            )
+            event = self.record()
+        return requests, params, event
+
+    def run(
+        self, item: Tuple[List[GenerationRequest], Dict[str, Any], Any]
+    ) -> Tuple[torch.Tensor, Dict[str, Any], Any]:
+        requests, params, event = item
+        # the encodings of `prepare` are complete before the denoising reads them
+        self.wait(event)
+        latents = generate_batch(
+            self.pipeline, requests, **dict(params, output_type="latent")
+        ).images
+        return latents, params, self.record()
+
+    @torch.no_grad()
+    def finish(self, item: Tuple[torch.Tensor, Dict[str, Any], Any]) -> List[Any]:
+        latents, params, event = item
+        height, width = self.size(params)
+        with self.stream("finish"):
+            self.wait(event)
+            if self.use_streams:
+                # allocated by the denoising stream, freed after the decode
+                latents.record_stream(self.streams["finish"])
+            return decode_latents(
+                self.pipeline,
+                latents,
+                height,
+                width,
+                params.get("output_type", "pil"),
+                params.get("tracer"),
+            )
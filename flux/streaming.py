@@ -0,0 +1,191 @@
+import torch
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from diffusers import FluxTransformer2DModel
+from diffusers.pipelines import FluxPipeline
+
+# returned by `streamed` without streamer
+NULL_STREAM = nullcontext()
+
+
+class BlockStreamer(object):
+    """
+    Just-in-time materialization of the transformer blocks for hosts whose
+    memory cannot hold the whole transformer. The parameters of
+    `transformer_blocks` and `single_transformer_blocks` stay in host memory,
+    typically memory-mapped from a snapshot (see `load_snapshot`); `use(block)`
+    copies them to `device` for the duration of the block while a background
+    thread already copies the `prefetch` next blocks, in execution order
+    (the last single block prefetches the first double block of the next
+    step). On CPU the copy reads the mapped pages into memory that is
+    released after the block, on CUDA it runs on a side stream.
+
+    With `pin_memory` (CUDA only) the host copies are made in page-locked
+    memory for faster asynchronous transfers; this reads memory-mapped
+    parameters into RAM, so it is meant for transformers loaded in memory.
+
+    The rest of the transformer is expected on `device`. Parameters are
+    collected on every use, so adapters loaded after the creation are
+    streamed too; the blocks must not be fused with `FusedLoRA`, which
+    keeps references to their weights.
+    """
+
+    def __init__(
+        self,
+        transformer: FluxTransformer2DModel,
+        device: Optional[Union[str, torch.device]] = None,
+        prefetch: int = 1,
+        pin_memory: bool = False,
+    ) -> None:
+        self.blocks = list(transformer.transformer_blocks) + list(
+            transformer.single_transformer_blocks
+        )
+        self.order = {block: index for index, block in enumerate(self.blocks)}
+        self.device = torch.device(
+            device if device is not None else transformer.x_embedder.weight.device
+        )
+        self.prefetch = prefetch
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.use_cuda = self.device.type == "cuda"
+        self.stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        # host copy of the parameters of each block, rebuilt from its current
+        # parameters so the ones of deleted adapters are dropped
+        self.host: Dict[int, Dict[torch.nn.Parameter, torch.Tensor]] = {}
+        self.pending: Dict[int, Future] = {}
+        # depth of the blocks in use
+        self.active: Dict[int, int] = {}
+        self._loader = ThreadPoolExecutor(1, thread_name_prefix="block_prefetch")
+        self.loads = 0
+        self.waits = 0
+        for index in range(len(self.blocks)):
+            for param, host in self.host_tensors(index).items():
+                param.data = host
+
+    def parameters(self, index: int) -> List[torch.nn.Parameter]:
+        return list(self.blocks[index].parameters())
+
+    @torch.no_grad()
+    def host_tensors(self, index: int) -> Dict[torch.nn.Parameter, torch.Tensor]:
+        previous = self.host.get(index, {})
+        tensors = {}
+        for param in self.parameters(index):
+            host = previous.get(param)
+            if host is None:
+                host = param.data
+                if host.device.type != "cpu":
+                    host = host.to("cpu")
+                if self.pin_memory and not host.is_pinned():
+                    host = host.pin_memory()
+            tensors[param] = host
+        self.host[index] = tensors
+        return tensors
+
+    @torch.no_grad()
+    def load(
+        self, index: int
+    ) -> Tuple[Dict[torch.nn.Parameter, torch.Tensor], Optional[torch.cuda.Event]]:
+        host = self.host_tensors(index)
+        if not self.use_cuda:
+            # reads the mapped pages
+            return {param: tensor.clone() for param, tensor in host.items()}, None
+        with torch.cuda.stream(self.stream):
+            tensors = {
+                param: tensor.to(self.device, non_blocking=True)
+                for param, tensor in host.items()
+            }
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return tensors, event
+
+    def fetch(self, index: int) -> None:
+        if index not in self.pending:
+            self.pending[index] = self._loader.submit(self.load, index)
+            self.loads += 1
+
+    def release(self, index: int, tensors: Dict[torch.nn.Parameter, torch.Tensor]) -> None:
+        previous = self.host.get(index, {})
+        host = {}
+        for param in self.parameters(index):
+            param.data = previous.get(param, param.data)
+            if param in previous:
+                host[param] = previous[param]
+        self.host[index] = host
+        if self.use_cuda:
+            # freed once the kernels using them are done
+            stream = torch.cuda.current_stream(self.device)
+            for tensor in tensors.values():
+                tensor.record_stream(stream)
+
+    @contextmanager
+    def use(self, block: torch.nn.Module) -> Iterator[None]:
+        """
+        Materializes `block` on the device while in the context. Nested uses
+        of a block in use (e.g. the step cache probe of the first block
+        followed by the block itself) reuse its tensors.
+        """
+        index = self.order[block]
+        if index in self.active:
+            self.active[index] += 1
+            try:
+                yield
+            finally:
+                self.active[index] -= 1
+            return
+        if index not in self.pending:
+            self.waits += 1
+        self.fetch(index)
+        for offset in range(1, self.prefetch + 1):
+            self.fetch((index + offset) % len(self.blocks))
+        tensors, event = self.pending.pop(index).result()
+        if event is not None:
+            torch.cuda.current_stream(self.device).wait_event(event)
+        for param, tensor in tensors.items():
+            param.data = tensor
+        self.active[index] = 1
+        try:
+            yield
+        finally:
+            del self.active[index]
+            self.release(index, tensors)
+
+    def clear(self) -> None:
+        """
+        Drops the prefetched blocks.
+        """
+        for future in self.pending.values():
+            future.result()
+        self.pending.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        # `waits` counts the blocks that were not prefetched
+        return {"blocks": len(self.blocks), "loads": self.loads, "waits": self.waits}
+
+
+def streamed(streamer: Optional[BlockStreamer], block: torch.nn.Module):
+    """
+    Returns the `use` context of `block`, or a shared no-op context without
+    streamer.
+    """
+    if streamer is None:
+        return NULL_STREAM
+    return streamer.use(block)
+
+
+def stream_blocks(
+    pipeline: FluxPipeline, device: Union[str, torch.device], **kwargs: dict
+) -> BlockStreamer:
+    """
+    Moves the pipeline to `device` except the transformer blocks, which are
+    left in host memory and streamed by the returned `BlockStreamer`.
+    """
+    streamer = BlockStreamer(pipeline.transformer, device=device, **kwargs)
+    for name in ("text_encoder", "text_encoder_2", "vae"):
+        component = getattr(pipeline, name, None)
+        if component is not None:
+            component.to(device)
+    for name, child in pipeline.transformer.named_children():
+        if name not in ("transformer_blocks", "single_transformer_blocks"):
+            child.to(device)
+    return streamer
@@ -0,0 +1,92 @@
+import torch
+from typing import Callable, Optional
+from diffusers import AutoencoderKL
+
+from .memory import MemoryTracer
+
+
+def peak_bytes(fn: Callable[[], object], device: torch.device) -> int:
+    """
+    Returns the peak memory allocated by `fn` on `device` above what was
+    allocated before.
+    """
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        start = torch.cuda.memory_allocated(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - start
+    with MemoryTracer(device) as memory, memory.span("probe"):
+        fn()
+    return memory.report()["stages"]["probe"]["peak_bytes"]
+
+
+class VAETiling(object):
+    """
+    Tile size of the diffusers VAE tiling (`AutoencoderKL.enable_tiling`)
+    chosen from a memory budget: the VAE activations per pixel are measured
+    by encoding and decoding a `probe_size` image on its device, the tile
+    side is the largest multiple of 64 pixels whose activations fit in
+    `memory_budget` bytes. The peak memory thus stays flat as the resolution
+    grows, apart from the decoded tiles kept for blending (a few times the
+    output image); images fitting in one tile go through the VAE untiled.
+    Applied once, after the VAE is on its device:
+
+        VAETiling(2 * 1024**3).apply(pipe.vae)
+    """
+
+    def __init__(
+        self,
+        memory_budget: int,
+        overlap_factor: float = 0.25,
+        probe_size: int = 256,
+        min_tile: int = 128,
+    ) -> None:
+        self.memory_budget = memory_budget
+        self.overlap_factor = overlap_factor
+        self.probe_size = probe_size
+        self.min_tile = min_tile
+        self.measured: Optional[float] = None
+
+    @torch.no_grad()
+    def bytes_per_pixel(self, vae: AutoencoderKL) -> float:
+        if self.measured is None:
+            side = self.probe_size
+            scale = 2 ** (len(vae.config.block_out_channels) - 1)
+            images = torch.zeros(1, 3, side, side, device=vae.device, dtype=vae.dtype)
+            latents = torch.zeros(
+                1,
+                vae.config.latent_channels,
+                side // scale,
+                side // scale,
+                device=vae.device,
+                dtype=vae.dtype,
+            )
+            use_tiling, vae.use_tiling = vae.use_tiling, False
+            try:
+                peak = max(
+                    peak_bytes(lambda: vae.encode(images), vae.device),
+                    peak_bytes(lambda: vae.decode(latents), vae.device),
+                )
+            finally:
+                vae.use_tiling = use_tiling
+            self.measured = peak / side**2
+        return self.measured
+
+    def tile_size(self, vae: AutoencoderKL) -> int:
+        side = int((self.memory_budget / self.bytes_per_pixel(vae)) ** 0.5) // 64 * 64
+        return max(side, self.min_tile)
+
+    def apply(self, vae: AutoencoderKL) -> int:
+        """
+        Enables the tiling of `vae` with the tile size of the budget, returns
+        the tile size in pixels.
+        """
+        tile = self.tile_size(vae)
+        scale = 2 ** (len(vae.config.block_out_channels) - 1)
+        vae.enable_tiling()
+        vae.tile_sample_min_size = tile
+        vae.tile_latent_min_size = tile // scale
+        vae.tile_overlap_factor = self.overlap_factor
+        return tile
@@ -0,0 +1,103 @@
+import json
+import os
+import threading
+import time
+import torch
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Iterator, List, Optional
+
+# returned by `span` when tracing is off, entering it costs next to nothing
+NULL_SPAN = nullcontext()
+
+
+class Tracer(object):
+    """
+    Records the duration of named spans (prompt encoding, condition encoding,
+    denoising steps, blocks, VAE decode...) of `generate` calls, exported as
+    Chrome trace JSON (chrome://tracing or https://ui.perfetto.dev).
+
+    CUDA kernels run asynchronously, with `synchronize` the device is
+    synchronized at the boundaries of every span so the spans measure the
+    device work; it slows the run down and is off by default.
+    """
+
+    def __init__(self, synchronize: bool = False) -> None:
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.events: List[Dict[str, Any]] = []
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def now(self) -> float:
+        # microseconds since the tracer was created
+        return (time.perf_counter() - self.origin) * 1e6
+
+    @contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[None]:
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = self.now()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": start,
+                    "dur": self.now() - start,
+                    "pid": self.pid,
+                    "tid": threading.get_ident(),
+                    "args": args,
+                }
+            )
+
+    def instant(self, name: str, **args: Any) -> None:
+        """
+        Records an event without duration, e.g. a skipped step.
+        """
+        self.events.append(
+            {
+                "name": name,
+                "ph": "i",
+                "s": "t",
+                "ts": self.now(),
+                "pid": self.pid,
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+        )
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the count and total duration in milliseconds of each span name.
+        """
+        summary: Dict[str, Dict[str, float]] = {}
+        for event in self.events:
+            entry = summary.setdefault(event["name"], {"count": 0, "total_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] += event.get("dur", 0.0) / 1000
+        return summary
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def clear(self) -> None:
+        self.events.clear()
+
+
+def span(tracer: Optional[Tracer], name: str, **args: Any):
+    """
+    Returns a span of `tracer`, or a shared no-op context without tracer.
+    """
+    if tracer is None:
+        return NULL_SPAN
+    return tracer.span(name, **args)
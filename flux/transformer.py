@@ -1,11 +1,22 @@
-# Recycled from Ominicontrol and modified to accept an extra condition.
+# Recycled from Ominicontrol and modified to accept several conditions.
 # While Zenctrl pursued a similar idea, it diverged structurally. 
 # We appreciate the clarity of Omini's implementation and decided to align with it.
 
 import torch
-from typing import  Optional, Dict, Any
-from .block import block_forward, single_block_forward
+from contextlib import ExitStack
+from typing import  Optional, Dict, Any, List, Tuple
+from .block import (
+    block_forward,
+    single_block_forward,
+    fused_block_forward,
+    fused_single_block_forward,
+)
 from .lora_controller import enable_lora
+from .cache import ConditionKVCache, StepCache
+from .layout import AttentionLayout
+from .embeddings import pack_rotary_emb
+from .tracing import Tracer, span
+from .streaming import BlockStreamer, streamed
 from accelerate.utils import is_torch_version
 from diffusers.models.transformers.transformer_flux import (
     FluxTransformer2DModel,
@@ -47,21 +58,49 @@ def prepare_params(
     )
 
 
+def transformer_output(
+    transformer: FluxTransformer2DModel,
+    hidden_states: torch.Tensor,
+    temb: torch.Tensor,
+    lora_scale: float,
+    return_dict: bool,
+):
+    hidden_states = transformer.norm_out(hidden_states, temb)
+    output = transformer.proj_out(hidden_states)
+
+    if USE_PEFT_BACKEND:
+        # remove `lora_scale` from each PEFT layer
+        unscale_lora_layers(transformer, lora_scale)
+
+    if not return_dict:
+        return (output,)
+    return Transformer2DModelOutput(sample=output)
+
+
 def tranformer_forward(
     transformer: FluxTransformer2DModel,
     condition_latents: torch.Tensor,
-    extra_condition_latents: torch.Tensor,
     condition_ids: torch.Tensor,
     condition_type_ids: torch.Tensor,
-    extra_condition_ids: torch.Tensor,
-    extra_condition_type_ids: torch.Tensor,
+    condition_sizes: Optional[List[int]] = None,
     model_config: Optional[Dict[str, Any]] = {},
     c_t=0,
+    kv_cache: Optional[ConditionKVCache] = None,
+    attention_layout: Optional[AttentionLayout] = None,
+    temb: Optional[torch.Tensor] = None,
+    cond_temb: Optional[torch.Tensor] = None,
+    image_rotary_emb: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    cond_rotary_emb: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    packed_rotary_emb: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    step_cache: Optional[StepCache] = None,
+    tracer: Optional[Tracer] = None,
+    block_streamer: Optional[BlockStreamer] = None,
     **params: dict,
 ):
     self = transformer
+    # the conditions are packed along the sequence, `condition_sizes` gives
+    # the token count of each of them
     use_condition = condition_latents is not None
-    use_extra_condition = extra_condition_latents is not None
 
     (
         hidden_states,
@@ -98,8 +137,9 @@ def tranformer_forward(
     with enable_lora((self.x_embedder,), model_config.get("latent_lora", False)):
         hidden_states = self.x_embedder(hidden_states)
     condition_latents = self.x_embedder(condition_latents) if use_condition else None
-    extra_condition_latents = self.x_embedder(extra_condition_latents) if use_extra_condition else None
 
+    # the embeddings and rotary tables may be precomputed for the whole
+    # schedule (see `EmbeddingSchedule`)
     timestep = timestep.to(hidden_states.dtype) * 1000
 
     if guidance is not None:
@@ -107,156 +147,200 @@ def tranformer_forward(
     else:
         guidance = None
 
-    temb = (
-        self.time_text_embed(timestep, pooled_projections)
-        if guidance is None
-        else self.time_text_embed(timestep, guidance, pooled_projections)
-    )
-
-    cond_temb = (
-        self.time_text_embed(torch.ones_like(timestep) * c_t * 1000, pooled_projections)
-        if guidance is None
-        else self.time_text_embed(
-            torch.ones_like(timestep) * c_t * 1000, torch.ones_like(guidance) * 1000, pooled_projections
+    if temb is None:
+        temb = (
+            self.time_text_embed(timestep, pooled_projections)
+            if guidance is None
+            else self.time_text_embed(timestep, guidance, pooled_projections)
         )
-    )
-    extra_cond_temb = (
-        self.time_text_embed(torch.ones_like(timestep) * c_t * 1000, pooled_projections)
-        if guidance is None
-        else self.time_text_embed(
-            torch.ones_like(timestep) * c_t * 1000, torch.ones_like(guidance) * 1000, pooled_projections
+
+    if cond_temb is None and use_condition:
+        cond_temb = (
+            self.time_text_embed(torch.ones_like(timestep) * c_t * 1000, pooled_projections)
+            if guidance is None
+            else self.time_text_embed(
+                torch.ones_like(timestep) * c_t * 1000, torch.ones_like(guidance) * 1000, pooled_projections
+            )
         )
-    )
     encoder_hidden_states = self.context_embedder(encoder_hidden_states)
 
-    if txt_ids.ndim == 3:
-        logger.warning(
-            "Passing `txt_ids` 3d torch.Tensor is deprecated."
-            "Please remove the batch dimension and pass it as a 2d torch Tensor"
-        )
-        txt_ids = txt_ids[0]
-    if img_ids.ndim == 3:
-        logger.warning(
-            "Passing `img_ids` 3d torch.Tensor is deprecated."
-            "Please remove the batch dimension and pass it as a 2d torch Tensor"
-        )
-        img_ids = img_ids[0]
+    if image_rotary_emb is None:
+        if txt_ids.ndim == 3:
+            logger.warning(
+                "Passing `txt_ids` 3d torch.Tensor is deprecated."
+                "Please remove the batch dimension and pass it as a 2d torch Tensor"
+            )
+            txt_ids = txt_ids[0]
+        if img_ids.ndim == 3:
+            logger.warning(
+                "Passing `img_ids` 3d torch.Tensor is deprecated."
+                "Please remove the batch dimension and pass it as a 2d torch Tensor"
+            )
+            img_ids = img_ids[0]
 
-    ids = torch.cat((txt_ids, img_ids), dim=0)
-    image_rotary_emb = self.pos_embed(ids)
-    if use_condition:
+        ids = torch.cat((txt_ids, img_ids), dim=0)
+        image_rotary_emb = self.pos_embed(ids)
+    if cond_rotary_emb is None and use_condition:
         # condition_ids[:, :1] = condition_type_ids
         cond_rotary_emb = self.pos_embed(condition_ids)
 
-    if use_extra_condition:
-        extra_cond_rotary_emb = self.pos_embed(extra_condition_ids)
+    if attention_layout is None and use_condition:
+        attention_layout = AttentionLayout(
+            text_n=encoder_hidden_states.shape[1],
+            image_n=hidden_states.shape[1],
+            condition_sizes=condition_sizes or [condition_latents.shape[1]],
+            model_config=model_config,
+            device=hidden_states.device,
+            dtype=hidden_states.dtype,
+        )
 
 
-    # hidden_states = torch.cat([hidden_states, condition_latents], dim=1)
+    # `fuse_streams` runs the image and condition streams as one packed
+    # sequence through the layers sharing their weights
+    fuse_streams = use_condition and model_config.get("fuse_streams", False)
+    block_fn = fused_block_forward if fuse_streams else block_forward
+    single_block_fn = (
+        fused_single_block_forward if fuse_streams else single_block_forward
+    )
+    packed_kwargs = {}
+    if fuse_streams:
+        packed_kwargs["packed_rotary_emb"] = packed_rotary_emb or pack_rotary_emb(
+            image_rotary_emb, cond_rotary_emb
+        )
 
-    #print("here!")
-    for index_block, block in enumerate(self.transformer_blocks):
-        if self.training and self.gradient_checkpointing:
-            ckpt_kwargs: Dict[str, Any] = (
-                {"use_reentrant": False} if is_torch_version(">=", "1.11.0") else {}
-            )
-            encoder_hidden_states, hidden_states, condition_latents, extra_condition_latents = (
-                torch.utils.checkpoint.checkpoint(
-                    block_forward,
-                    self=block,
-                    model_config=model_config,
-                    hidden_states=hidden_states,
-                    encoder_hidden_states=encoder_hidden_states,
-                    condition_latents=condition_latents if use_condition else None,
-                    extra_condition_latents=extra_condition_latents if use_extra_condition else None,
-                    temb=temb,
-                    cond_temb=cond_temb if use_condition else None,
-                    cond_rotary_emb=cond_rotary_emb if use_condition else None,
-                    extra_cond_temb=extra_cond_temb if use_extra_condition else None,
-                    extra_cond_rotary_emb=extra_cond_rotary_emb if use_extra_condition else None,
-                    image_rotary_emb=image_rotary_emb,
-                    **ckpt_kwargs,
+    # reuse the residual of the previous step when the input of the first
+    # block barely changed; a streamed first block stays on the device from
+    # the probe to its run
+    with ExitStack() as first_block_resident:
+        if step_cache is not None:
+            first_block = self.transformer_blocks[0]
+            first_block_resident.enter_context(streamed(block_streamer, first_block))
+            with enable_lora(
+                (first_block.norm1.linear,), model_config.get("latent_lora", False)
+            ):
+                modulated = first_block.norm1(hidden_states, emb=temb)[0]
+            if step_cache.skip(modulated):
+                first_block_resident.close()
+                if block_streamer is not None:
+                    # no block runs this step, drop the prefetched ones
+                    block_streamer.clear()
+                if tracer is not None:
+                    tracer.instant("step_cache_skip")
+                return transformer_output(
+                    self, hidden_states + step_cache.residual, temb, lora_scale, return_dict
                 )
-            )
+            block_input = hidden_states
 
-        else:
-            encoder_hidden_states, hidden_states, condition_latents, extra_condition_latents = block_forward(
-                block,
-                model_config=model_config,
-                hidden_states=hidden_states,
-                encoder_hidden_states=encoder_hidden_states,
-                condition_latents=condition_latents if use_condition else None,
-                extra_condition_latents=extra_condition_latents if use_extra_condition else None,
-                temb=temb,
-                cond_temb=cond_temb if use_condition else None,
-                cond_rotary_emb=cond_rotary_emb if use_condition else None,
-                extra_cond_temb=cond_temb if use_extra_condition else None,
-                extra_cond_rotary_emb=extra_cond_rotary_emb if use_extra_condition else None,
-                image_rotary_emb=image_rotary_emb,
-            )
+        for index_block, block in enumerate(self.transformer_blocks):
+            with span(tracer, "double_block", index=index_block), streamed(
+                block_streamer, block
+            ):
+                if self.training and self.gradient_checkpointing:
+                    ckpt_kwargs: Dict[str, Any] = (
+                        {"use_reentrant": False} if is_torch_version(">=", "1.11.0") else {}
+                    )
+                    encoder_hidden_states, hidden_states, condition_latents = (
+                        torch.utils.checkpoint.checkpoint(
+                            block_fn,
+                            self=block,
+                            model_config=model_config,
+                            hidden_states=hidden_states,
+                            encoder_hidden_states=encoder_hidden_states,
+                            condition_latents=condition_latents if use_condition else None,
+                            temb=temb,
+                            cond_temb=cond_temb if use_condition else None,
+                            cond_rotary_emb=cond_rotary_emb if use_condition else None,
+                            image_rotary_emb=image_rotary_emb,
+                            kv_cache=kv_cache,
+                            attention_layout=attention_layout,
+                            **packed_kwargs,
+                            **ckpt_kwargs,
+                        )
+                    )
 
-        # controlnet residual
-        if controlnet_block_samples is not None:
-            interval_control = len(self.transformer_blocks) / len(
-                controlnet_block_samples
-            )
-            interval_control = int(np.ceil(interval_control))
-            hidden_states = (
-                hidden_states
-                + controlnet_block_samples[index_block // interval_control]
-            )
+                else:
+                    encoder_hidden_states, hidden_states, condition_latents = block_fn(
+                        block,
+                        model_config=model_config,
+                        hidden_states=hidden_states,
+                        encoder_hidden_states=encoder_hidden_states,
+                        condition_latents=condition_latents if use_condition else None,
+                        temb=temb,
+                        cond_temb=cond_temb if use_condition else None,
+                        cond_rotary_emb=cond_rotary_emb if use_condition else None,
+                        image_rotary_emb=image_rotary_emb,
+                        kv_cache=kv_cache,
+                        attention_layout=attention_layout,
+                        **packed_kwargs,
+                    )
+
+            # controlnet residual
+            if controlnet_block_samples is not None:
+                interval_control = len(self.transformer_blocks) / len(
+                    controlnet_block_samples
+                )
+                interval_control = int(np.ceil(interval_control))
+                hidden_states = (
+                    hidden_states
+                    + controlnet_block_samples[index_block // interval_control]
+                )
+            # released once it ran, or on errors by the `with`
+            first_block_resident.close()
     hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
     
 
     for index_block, block in enumerate(self.single_transformer_blocks):
-        if self.training and self.gradient_checkpointing:
-            ckpt_kwargs: Dict[str, Any] = (
-                {"use_reentrant": False} if is_torch_version(">=", "1.11.0") else {}
-            )
-            result = torch.utils.checkpoint.checkpoint(
-                single_block_forward,
-                self=block,
-                model_config=model_config,
-                hidden_states=hidden_states,
-                temb=temb,
-                image_rotary_emb=image_rotary_emb,
-                **(
-                    {
-                        "condition_latents": condition_latents,
-                        "extra_condition_latents": extra_condition_latents,
-                        "cond_temb": cond_temb,
-                        "cond_rotary_emb": cond_rotary_emb,
-                        "extra_cond_temb": extra_cond_temb,
-                        "extra_cond_rotary_emb": extra_cond_rotary_emb,
-                    }
-                    if use_condition
-                    else {}
-                ),
-                **ckpt_kwargs,
-            )
+        with span(tracer, "single_block", index=index_block), streamed(
+            block_streamer, block
+        ):
+            if self.training and self.gradient_checkpointing:
+                ckpt_kwargs: Dict[str, Any] = (
+                    {"use_reentrant": False} if is_torch_version(">=", "1.11.0") else {}
+                )
+                result = torch.utils.checkpoint.checkpoint(
+                    single_block_fn,
+                    self=block,
+                    model_config=model_config,
+                    hidden_states=hidden_states,
+                    temb=temb,
+                    image_rotary_emb=image_rotary_emb,
+                    kv_cache=kv_cache,
+                    attention_layout=attention_layout,
+                    **(
+                        {
+                            "condition_latents": condition_latents,
+                            "cond_temb": cond_temb,
+                            "cond_rotary_emb": cond_rotary_emb,
+                        }
+                        if use_condition
+                        else {}
+                    ),
+                    **packed_kwargs,
+                    **ckpt_kwargs,
+                )
 
-        else:
-            result = single_block_forward(
-                block,
-                model_config=model_config,
-                hidden_states=hidden_states,
-                temb=temb,
-                image_rotary_emb=image_rotary_emb,
-                **(
-                    {
-                        "condition_latents": condition_latents,
-                        "extra_condition_latents": extra_condition_latents,
-                        "cond_temb": cond_temb,
-                        "cond_rotary_emb": cond_rotary_emb,
-                        "extra_cond_temb": extra_cond_temb,
-                        "extra_cond_rotary_emb": extra_cond_rotary_emb,
-                    }
-                    if use_condition
-                    else {}
-                ),
-            )
+            else:
+                result = single_block_fn(
+                    block,
+                    model_config=model_config,
+                    hidden_states=hidden_states,
+                    temb=temb,
+                    image_rotary_emb=image_rotary_emb,
+                    kv_cache=kv_cache,
+                    attention_layout=attention_layout,
+                    **(
+                        {
+                            "condition_latents": condition_latents,
+                            "cond_temb": cond_temb,
+                            "cond_rotary_emb": cond_rotary_emb,
+                        }
+                        if use_condition
+                        else {}
+                    ),
+                    **packed_kwargs,
+                )
         if use_condition:
-            hidden_states, condition_latents, extra_condition_latents = result
+            hidden_states, condition_latents = result
         else:
             hidden_states = result
 
@@ -272,14 +356,7 @@ def tranformer_forward(
             )
 
     hidden_states = hidden_states[:, encoder_hidden_states.shape[1] :, ...]
+    if step_cache is not None:
+        step_cache.store(block_input, hidden_states)
 
-    hidden_states = self.norm_out(hidden_states, temb)
-    output = self.proj_out(hidden_states)
-
-    if USE_PEFT_BACKEND:
-        # remove `lora_scale` from each PEFT layer
-        unscale_lora_layers(self, lora_scale)
-
-    if not return_dict:
-        return (output,)
-    return Transformer2DModelOutput(sample=output)
+    return transformer_output(self, hidden_states, temb, lora_scale, return_dict)
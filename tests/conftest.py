@@ -0,0 +1,164 @@
+"""
+Shared fixtures: a tiny FLUX pipeline that runs on CPU in a fraction of a
+second, with a deterministic stand-in for the text encoders.
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+import torch
+from typing import Callable
+from diffusers import AutoencoderKL, FlowMatchEulerDiscreteScheduler, FluxTransformer2DModel
+from diffusers.pipelines import FluxPipeline
+from peft import LoraConfig
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flux.transformer import tranformer_forward  # noqa: E402
+
+LORA_TARGETS = [
+    "to_q",
+    "to_k",
+    "to_v",
+    "to_out.0",
+    "add_q_proj",
+    "ff.net.0.proj",
+    "ff.net.2",
+    "norm1.linear",
+    "norm.linear",
+    "proj_mlp",
+    "proj_out",
+    "x_embedder",
+]
+
+
+def tiny_transformer() -> FluxTransformer2DModel:
+    return FluxTransformer2DModel(
+        patch_size=1,
+        in_channels=64,
+        num_layers=2,
+        num_single_layers=2,
+        attention_head_dim=16,
+        num_attention_heads=2,
+        joint_attention_dim=32,
+        pooled_projection_dim=32,
+        guidance_embeds=False,
+        axes_dims_rope=(4, 6, 6),
+    ).eval()
+
+
+def tiny_vae() -> AutoencoderKL:
+    return AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        latent_channels=16,
+        down_block_types=["DownEncoderBlock2D"] * 4,
+        up_block_types=["UpDecoderBlock2D"] * 4,
+        block_out_channels=[8, 8, 8, 8],
+        norm_num_groups=4,
+        layers_per_block=1,
+        shift_factor=0.1,
+        scaling_factor=0.5,
+        use_quant_conv=False,
+        use_post_quant_conv=False,
+    ).eval()
+
+
+def encode_prompt(
+    prompt,
+    prompt_2=None,
+    device=None,
+    num_images_per_prompt=1,
+    prompt_embeds=None,
+    pooled_prompt_embeds=None,
+    max_sequence_length=512,
+    lora_scale=None,
+):
+    # random embeddings seeded by the prompt, in place of CLIP and T5
+    prompts = [prompt] if isinstance(prompt, str) else prompt
+    embeds, pooled = [], []
+    for text in prompts:
+        generator = torch.Generator().manual_seed(sum(map(ord, text)) % 1000)
+        embeds.append(torch.randn(1, 8, 32, generator=generator))
+        pooled.append(torch.randn(1, 32, generator=generator))
+    return (
+        torch.cat(embeds).repeat_interleave(num_images_per_prompt, 0),
+        torch.cat(pooled).repeat_interleave(num_images_per_prompt, 0),
+        torch.zeros(8, 3),
+    )
+
+
+@pytest.fixture
+def pipe() -> FluxPipeline:
+    torch.manual_seed(0)
+    pipeline = FluxPipeline(
+        scheduler=FlowMatchEulerDiscreteScheduler(shift=1.0, use_dynamic_shifting=True),
+        vae=tiny_vae(),
+        text_encoder=None,
+        tokenizer=None,
+        text_encoder_2=None,
+        tokenizer_2=None,
+        transformer=tiny_transformer(),
+    )
+    pipeline.encode_prompt = encode_prompt
+    return pipeline
+
+
+@pytest.fixture
+def lora_pipe(pipe: FluxPipeline) -> FluxPipeline:
+    # a random (not zero-initialized) "subject" adapter, so that it has an effect
+    torch.manual_seed(1)
+    pipe.transformer.add_adapter(
+        LoraConfig(
+            r=4, lora_alpha=4, init_lora_weights=False, target_modules=LORA_TARGETS
+        ),
+        adapter_name="subject",
+    )
+    return pipe
+
+
+@pytest.fixture
+def image() -> Callable[..., Image.Image]:
+    def make(size: int = 64, seed: int = 0) -> Image.Image:
+        rng = np.random.RandomState(seed)
+        return Image.fromarray(rng.randint(0, 255, (size, size, 3), dtype=np.uint8))
+
+    return make
+
+
+def transformer_forward(
+    transformer: FluxTransformer2DModel, seed: int = 0, **kwargs: dict
+) -> torch.Tensor:
+    # one `tranformer_forward` on random inputs: 16 image tokens, 16 tokens
+    # of one condition and 8 text tokens
+    generator = torch.Generator().manual_seed(seed)
+    side, text_n = 4, 8
+    ids = torch.zeros(side, side, 3)
+    ids[..., 1] = torch.arange(side)[:, None]
+    ids[..., 2] = torch.arange(side)[None, :]
+    condition_ids = ids.clone()
+    condition_ids[..., 2] += side
+    (output,) = tranformer_forward(
+        transformer,
+        condition_latents=torch.randn(1, side * side, 64, generator=generator),
+        condition_ids=condition_ids.reshape(-1, 3),
+        condition_type_ids=None,
+        condition_sizes=[side * side],
+        model_config={"union_cond_attn": True},
+        hidden_states=torch.randn(1, side * side, 64, generator=generator),
+        encoder_hidden_states=torch.randn(1, text_n, 32, generator=generator),
+        pooled_projections=torch.randn(1, 32, generator=generator),
+        timestep=torch.full((1,), 0.5),
+        img_ids=ids.reshape(-1, 3),
+        txt_ids=torch.zeros(text_n, 3),
+        return_dict=False,
+        **kwargs,
+    )
+    return output
+
+
+@pytest.fixture
+def forward() -> Callable[..., torch.Tensor]:
+    return transformer_forward
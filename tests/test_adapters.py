@@ -0,0 +1,65 @@
+import torch
+from peft import LoraConfig
+from peft.utils import get_peft_model_state_dict
+
+from flux.adapters import AdapterPool
+
+from conftest import LORA_TARGETS
+
+NAMES = ["subject", "sr", "cot"]
+
+
+def lora_state_dicts(pipe):
+    # random adapters in the format of `lora_state_dict`, removed again from
+    # the transformer
+    state_dicts = {}
+    for seed, name in enumerate(NAMES):
+        torch.manual_seed(seed)
+        pipe.transformer.add_adapter(
+            LoraConfig(
+                r=4, lora_alpha=4, init_lora_weights=False, target_modules=LORA_TARGETS
+            ),
+            adapter_name=name,
+        )
+        state_dict = get_peft_model_state_dict(pipe.transformer, adapter_name=name)
+        state_dicts[name] = {
+            f"transformer.{key}": value.clone() for key, value in state_dict.items()
+        }
+        pipe.transformer.delete_adapters(name)
+    return state_dicts
+
+
+def test_pool_evicts_least_recently_used_adapter(pipe):
+    state_dicts = lora_state_dicts(pipe)
+    deleted = []
+    delete_adapters = pipe.delete_adapters
+
+    def record(name):
+        deleted.append(name)
+        return delete_adapters(name)
+
+    pipe.delete_adapters = record
+    pool = AdapterPool(pipe, max_loaded=2)
+    for name in NAMES:
+        pool.preload(name, state_dicts[name])
+
+    layer = pipe.transformer.transformer_blocks[0].attn.to_q
+    for name in ["subject", "sr", "cot", "sr", "subject"]:
+        pool.activate(name)
+        assert layer.active_adapters == [name]
+    # `cot` evicts `subject`, then `subject` evicts `cot` as `sr` was used
+    # after it
+    assert deleted == ["subject", "cot"]
+    assert list(pool.loaded) == ["sr", "subject"]
+    assert set(pipe.transformer.peft_config) == {"sr", "subject"}
+    assert pool.stats["loads"] == 4 and pool.stats["switches"] == 5
+    assert pool.stats["disk_reads"] == 0
+
+    # the weights loaded again are the ones of the adapter
+    key = next(key for key in state_dicts["subject"] if "lora_A" in key)
+    module = pipe.transformer.get_submodule(
+        key[len("transformer.") : -len(".lora_A.weight")]
+    )
+    torch.testing.assert_close(
+        module.lora_A["subject"].weight, state_dicts["subject"][key]
+    )
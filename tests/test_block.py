@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from flux.cache import LatentCache
+from flux.condition import Condition
+from flux.generate import generate
+
+
+@pytest.mark.parametrize(
+    "model_config",
+    [
+        {"union_cond_attn": True},
+        {"union_cond_attn": True, "latent_lora": True},
+        {"union_cond_attn": True, "add_cond_attn": True},
+        {"independent_condition": True},
+        {"union_cond_attn": True, "dense_attention_mask": True},
+    ],
+)
+@pytest.mark.parametrize("condition_scale", [None, [0.5, 2.0]])
+def test_fused_streams_match(lora_pipe, image, model_config, condition_scale):
+    conditions = [
+        Condition("subject", image(64), position_delta=(0, 4)),
+        Condition("subject", image(64, 7), position_delta=(0, -4)),
+    ]
+
+    def run(fuse_streams):
+        return generate(
+            lora_pipe,
+            prompt="a cat",
+            conditions=conditions,
+            num_inference_steps=2,
+            height=64,
+            width=64,
+            condition_scale=condition_scale,
+            model_config=dict(model_config, fuse_streams=fuse_streams),
+            default_lora=True,
+            output_type="latent",
+            latent_cache=LatentCache(),
+            generator=torch.Generator().manual_seed(0),
+        ).images
+
+    torch.testing.assert_close(run(True), run(False))
@@ -0,0 +1,215 @@
+import os
+import pytest
+import torch
+from transformers import T5Config, T5EncoderModel
+
+from flux.cache import LatentCache, PromptCache, StepCache, content_key
+from flux.condition import Condition
+from flux.generate import generate
+from flux.pipeline_tools import encode_condition_images, encode_prompt_cached
+
+
+@pytest.mark.parametrize("condition_scale", [None, [1.3, 0.7]])
+def test_condition_kv_cache_matches(pipe, image, condition_scale):
+    conditions = [
+        Condition("subject", image(64), position_delta=(0, 4)),
+        Condition("subject", image(64, 1), position_delta=(0, -4)),
+    ]
+
+    def run(cache_condition_kv):
+        return generate(
+            pipe,
+            prompt="a cat",
+            conditions=conditions,
+            num_inference_steps=3,
+            height=64,
+            width=64,
+            condition_scale=condition_scale,
+            model_config={"union_cond_attn": True, "independent_condition": True},
+            default_lora=True,
+            output_type="latent",
+            latent_cache=LatentCache(),
+            cache_condition_kv=cache_condition_kv,
+            generator=torch.Generator().manual_seed(0),
+        ).images
+
+    torch.testing.assert_close(run(True), run(False))
+
+
+def test_condition_kv_cache_requires_independent_condition(pipe, image):
+    with pytest.raises(AssertionError):
+        generate(
+            pipe,
+            prompt="a cat",
+            conditions=[Condition("subject", image(64))],
+            num_inference_steps=1,
+            height=64,
+            width=64,
+            model_config={"union_cond_attn": True},
+            default_lora=True,
+            output_type="latent",
+            cache_condition_kv=True,
+        )
+
+
+def counting_encoder(pipe):
+    calls = []
+    encode_prompt = pipe.encode_prompt
+
+    def encode(prompt, **kwargs):
+        calls.append(list(prompt))
+        return encode_prompt(prompt, **kwargs)
+
+    pipe.encode_prompt = encode
+    return calls
+
+
+def test_prompt_cache_memory_hit(pipe):
+    calls = counting_encoder(pipe)
+    cache = PromptCache()
+    first = encode_prompt_cached(pipe, ["a cat", "a dog"], prompt_cache=cache)
+    second = encode_prompt_cached(pipe, ["a dog", "a cat", "a cat"], prompt_cache=cache)
+    assert calls == [["a cat", "a dog"]]
+    assert cache.stats["hits"] == 2
+    torch.testing.assert_close(second[0][0], first[0][1])
+    torch.testing.assert_close(second[0][1:], first[0][:1].expand(2, -1, -1))
+
+
+def test_prompt_cache_disk_roundtrip(pipe, tmp_path, monkeypatch):
+    replaced = []
+    replace = os.replace
+
+    def record(source, destination):
+        replaced.append((source, destination))
+        replace(source, destination)
+
+    monkeypatch.setattr(os, "replace", record)
+    expected = encode_prompt_cached(
+        pipe, "a cat", prompt_cache=PromptCache(cache_dir=str(tmp_path))
+    )
+    # written to a temporary file, then renamed
+    ((source, destination),) = replaced
+    assert source.endswith(".tmp") and not os.path.exists(source)
+    assert os.listdir(tmp_path) == [os.path.basename(destination)]
+
+    calls = counting_encoder(pipe)
+    cache = PromptCache(cache_dir=str(tmp_path))
+    restored = encode_prompt_cached(pipe, "a cat", prompt_cache=cache)
+    assert not calls and cache.disk_hits == 1
+    for each, expected_each in zip(restored, expected):
+        torch.testing.assert_close(each, expected_each)
+
+
+def disk_cache(directory) -> PromptCache:
+    return PromptCache(cache_dir=str(directory))
+
+
+def test_prompt_cache_keyed_by_text_encoder(pipe, tmp_path):
+    pipe.text_encoder_2 = T5EncoderModel(
+        T5Config(vocab_size=50, d_model=16, d_kv=4, d_ff=32, num_layers=1, num_heads=2)
+    )
+    encode_prompt_cached(pipe, "a cat", prompt_cache=disk_cache(tmp_path))
+    calls = counting_encoder(pipe)
+    encode_prompt_cached(pipe, "a cat", prompt_cache=disk_cache(tmp_path))
+    assert not calls
+    # another checkpoint or dtype of the encoder misses the persistent cache
+    pipe.text_encoder_2.to(torch.bfloat16)
+    encode_prompt_cached(pipe, "a cat", prompt_cache=disk_cache(tmp_path))
+    pipe.text_encoder_2 = T5EncoderModel(
+        T5Config(vocab_size=50, d_model=16, d_kv=4, d_ff=32, num_layers=2, num_heads=2)
+    )
+    encode_prompt_cached(pipe, "a cat", prompt_cache=disk_cache(tmp_path))
+    assert calls == [["a cat"], ["a cat"]]
+
+
+def counting_vae(pipe):
+    batches = []
+    encode = pipe.vae.encode
+
+    def record(images, *args, **kwargs):
+        batches.append(tuple(images.shape))
+        return encode(images, *args, **kwargs)
+
+    pipe.vae.encode = record
+    return batches
+
+
+def test_latent_cache_dedupes_and_batches_by_size(pipe, image):
+    batches = counting_vae(pipe)
+    cache = LatentCache()
+    images = [image(64, 1), image(32, 2), image(64, 1), image(64, 3)]
+    encoded = encode_condition_images(pipe, images, cache)
+    # one encode per size, the duplicate is encoded once
+    assert sorted(batches) == [(1, 3, 32, 32), (2, 3, 64, 64)]
+    assert len(cache) == 3
+    torch.testing.assert_close(encoded[0], encoded[2])
+    assert encoded[0][0].shape[1] == 16 and encoded[1][0].shape[1] == 4
+
+    again = encode_condition_images(pipe, images[::-1], cache)
+    assert len(batches) == 2
+    for each, expected in zip(again, encoded[::-1]):
+        torch.testing.assert_close(each, expected)
+
+
+def test_latent_cache_returns_copies(pipe, image):
+    cache = LatentCache()
+    (tokens, ids), = encode_condition_images(pipe, [image(64)], cache)
+    expected = tokens.clone()
+    tokens.zero_()
+    ids.zero_()
+    (tokens, ids), = encode_condition_images(pipe, [image(64)], cache)
+    torch.testing.assert_close(tokens, expected)
+    assert ids.abs().sum() > 0
+
+
+def test_latent_cache_byte_budget(pipe, image):
+    entry_bytes = LatentCache.size_of(
+        encode_condition_images(pipe, [image(64)], LatentCache())[0]
+    )
+    cache = LatentCache(max_bytes=int(entry_bytes * 2.5))
+    for seed in range(3):
+        encode_condition_images(pipe, [image(64, seed)], cache)
+    # the least recently used entry is evicted
+    assert len(cache) == 2 and cache.nbytes == 2 * entry_bytes
+    assert content_key(image(64, 0)) not in cache
+    assert content_key(image(64, 2)) in cache
+    # an entry larger than the budget is not stored
+    small = LatentCache(max_bytes=entry_bytes // 2)
+    encode_condition_images(pipe, [image(64)], small)
+    assert len(small) == 0 and small.nbytes == 0
+
+
+def test_step_cache_skip_decision():
+    step_cache = StepCache(threshold=0.1, warmup_steps=2)
+    modulated = torch.ones(1, 4, 8)
+    step_cache.store(torch.zeros(1, 4, 8), torch.ones(1, 4, 8))
+    # the warmup steps are computed, even with the same input
+    assert not step_cache.skip(modulated)
+    assert not step_cache.skip(modulated)
+    # relative changes of 4%, accumulated until the threshold
+    assert step_cache.skip(modulated * 1.04)
+    assert step_cache.skip(modulated * 1.04 * 1.04)
+    assert not step_cache.skip(modulated * 1.04**3)
+    assert step_cache.skip(modulated * 1.04**3)
+    assert step_cache.stats == {"steps": 6, "skipped": 3}
+
+    step_cache.reset()
+    assert not step_cache.skip(modulated)
+    step_cache.store(torch.zeros(1, 4, 8), torch.ones(1, 4, 8))
+    assert not step_cache.skip(modulated)
+    assert step_cache.skip(modulated)
+
+
+@torch.no_grad()
+def test_step_cache_reuses_residual(pipe, forward):
+    transformer = pipe.transformer
+    step_cache = StepCache(threshold=0.1)
+    expected = forward(transformer, step_cache=step_cache)
+    assert step_cache.skipped == 0 and step_cache.residual is not None
+    # same input: the blocks are skipped and input + residual goes through
+    # the output layers as the blocks output did
+    torch.testing.assert_close(forward(transformer, step_cache=step_cache), expected)
+    assert step_cache.skipped == 1
+    # another input is computed
+    assert not torch.allclose(forward(transformer, seed=1, step_cache=step_cache), expected)
+    assert step_cache.skipped == 1
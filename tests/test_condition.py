@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from flux.cache import LatentCache
+from flux.condition import (
+    Condition,
+    background_keep_mask,
+    background_keep_masks,
+    encode_conditions,
+)
+from flux.generate import generate, pack_conditions
+
+
+def white_image(size: int = 64, square: int = 0) -> Image.Image:
+    # white background with a red `square` in the top left corner
+    pixels = np.full((size, size, 3), 255, dtype=np.uint8)
+    pixels[:square, :square] = (200, 20, 20)
+    return Image.fromarray(pixels)
+
+
+def test_flat_image_keeps_all_tokens():
+    for color in [(255, 255, 255), (30, 60, 90)]:
+        image = Image.new("RGB", (64, 48), color)
+        keep = background_keep_mask(image, background=color)
+        assert keep.shape == (12,) and keep.all()
+
+
+def test_background_mask_keeps_subject_and_margin():
+    keep = background_keep_mask(white_image(64, 8)).reshape(4, 4)
+    expected = torch.zeros(4, 4, dtype=torch.bool)
+    expected[:2, :2] = True
+    assert torch.equal(keep, expected)
+    keep = background_keep_mask(white_image(64, 8), margin=0)
+    assert keep.nonzero().flatten().tolist() == [0]
+    # the same mask from a [0, 1] tensor
+    pixels = torch.from_numpy(np.array(white_image(64, 8))).permute(2, 0, 1) / 255
+    assert torch.equal(background_keep_mask(pixels[None]).reshape(4, 4), expected)
+
+
+@pytest.mark.parametrize(
+    "size, resolution", [(72, None), (88, None), (40, None), (100, 56)]
+)
+def test_mask_matches_token_count(pipe, image, size, resolution):
+    conditions = [Condition("subject", image(size))]
+    ((tokens, _, _),) = encode_conditions(pipe, conditions, resolution=resolution)
+    (keep,) = background_keep_masks(conditions, 1, resolution)
+    assert keep.shape == (tokens.shape[1],)
+
+
+def test_pruned_tokens_and_ids_stay_aligned(pipe, image):
+    conditions = [
+        Condition("subject", white_image(64, 8), position_delta=(0, 4)),
+        Condition("subject", image(64), position_delta=(0, -4)),
+    ]
+    encoded = encode_conditions(pipe, conditions, LatentCache())
+    keep_masks = background_keep_masks(conditions, 2)
+    assert keep_masks[0].sum() == 4 and keep_masks[1].all()
+
+    tokens, ids, type_ids, sizes = pack_conditions(encoded, 2, 1)
+    pruned = pack_conditions(encoded, 2, 1, keep_masks)
+    keep = torch.cat(keep_masks)
+    assert pruned[3] == [4, 16]
+    torch.testing.assert_close(pruned[0], tokens[:, keep])
+    torch.testing.assert_close(pruned[1], ids[keep])
+    torch.testing.assert_close(pruned[2], type_ids[keep])
+    # the kept tokens of the first condition are its top left corner
+    assert pruned[1][:4, 1:].tolist() == [[0, 4], [0, 5], [1, 4], [1, 5]]
+
+
+def test_prune_background_generate(pipe, image):
+    def run(condition, **kwargs):
+        return generate(
+            pipe,
+            prompt="a cat",
+            conditions=[condition],
+            height=64,
+            width=64,
+            num_inference_steps=2,
+            model_config={"union_cond_attn": True},
+            default_lora=True,
+            output_type="latent",
+            latent_cache=LatentCache(),
+            generator=torch.Generator().manual_seed(0),
+            **kwargs,
+        ).images
+
+    # nothing to prune on a random image
+    condition = Condition("subject", image(64))
+    torch.testing.assert_close(run(condition, prune_background=True), run(condition))
+    condition = Condition("subject", white_image(64, 8))
+    assert run(condition, prune_background=True).shape == run(condition).shape
+
+
+@pytest.mark.parametrize("output_size", [(128, 128), (96, 192)])
+def test_condition_ids_scale_to_output_grid(pipe, image, output_size):
+    condition = Condition("subject", image(128), position_delta=(0, -8))
+    ((full_tokens, full_ids, _),) = encode_conditions(pipe, [condition])
+    ((tokens, ids, type_ids),) = encode_conditions(
+        pipe, [condition], resolution=64, output_size=output_size
+    )
+    # a quarter of the tokens, spread over the output token grid
+    assert full_tokens.shape[1] == 64 and tokens.shape[1] == 16
+    assert ids.shape == (16, 3) and type_ids.shape == (16, 1)
+    row_scale, column_scale = output_size[0] / 64, output_size[1] / 64
+    grid = torch.arange(4, dtype=ids.dtype)
+    assert torch.equal(ids[:, 1].unique(), grid * row_scale)
+    assert torch.equal(ids[:, 2].unique(), grid * column_scale - 8)
+    if output_size == (128, 128):
+        # the downscaled tokens land on every other id of the full encoding
+        assert set(map(tuple, ids.tolist())) <= set(map(tuple, full_ids.tolist()))
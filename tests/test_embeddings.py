@@ -0,0 +1,33 @@
+import torch
+
+from flux.embeddings import EmbeddingSchedule
+
+
+@torch.no_grad()
+def test_schedule_matches_per_step_embeddings(pipe):
+    transformer = pipe.transformer
+    torch.manual_seed(0)
+    timesteps = torch.tensor([1.0, 0.6, 0.2])
+    pooled = torch.randn(2, 32)
+    txt_ids, img_ids = torch.zeros(8, 3), torch.randint(0, 4, (16, 3)).float()
+    condition_ids = img_ids + 4
+    schedule = EmbeddingSchedule(
+        transformer, timesteps, pooled, txt_ids, img_ids, condition_ids, c_t=0.1
+    )
+    assert len(schedule) == 3
+    cond_temb = transformer.time_text_embed(torch.full((2,), 0.1) * 1000, pooled)
+    image_rotary_emb = transformer.pos_embed(torch.cat((txt_ids, img_ids)))
+    cond_rotary_emb = transformer.pos_embed(condition_ids)
+    for step, timestep in enumerate(timesteps):
+        arguments = schedule.at(step)
+        temb = transformer.time_text_embed(timestep.expand(2) * 1000, pooled)
+        torch.testing.assert_close(arguments["temb"], temb)
+        torch.testing.assert_close(arguments["cond_temb"], cond_temb)
+        for actual, expected in zip(arguments["image_rotary_emb"], image_rotary_emb):
+            torch.testing.assert_close(actual, expected)
+        for actual, expected in zip(arguments["cond_rotary_emb"], cond_rotary_emb):
+            torch.testing.assert_close(actual, expected)
+        for actual, image, condition in zip(
+            arguments["packed_rotary_emb"], image_rotary_emb, cond_rotary_emb
+        ):
+            torch.testing.assert_close(actual, torch.cat((image, condition)))
@@ -0,0 +1,110 @@
+import pytest
+import torch
+
+from flux.cache import LatentCache
+from flux.condition import Condition
+from flux.generate import GenerationRequest, generate, generate_batch
+
+PROMPTS = ["a cat", "a dog on a hill", "x"]
+SCALES = [[1, 1], [1.5, 0.5], [0.3, 2.0]]
+
+
+@pytest.mark.parametrize(
+    "model_config",
+    [
+        {"union_cond_attn": True},
+        {"independent_condition": True},
+        {"independent_condition": True, "dense_attention_mask": True},
+    ],
+)
+def test_generate_batch_matches_generate(pipe, image, model_config):
+    def conditions(i):
+        return [
+            Condition("subject", image(64, i), position_delta=(0, 4)),
+            Condition("subject", image(64, i + 10), position_delta=(0, -4)),
+        ]
+
+    params = dict(
+        num_inference_steps=3,
+        height=64,
+        width=64,
+        model_config=model_config,
+        default_lora=True,
+        output_type="latent",
+    )
+    singles = [
+        generate(
+            pipe,
+            prompt=PROMPTS[i],
+            conditions=conditions(i),
+            condition_scale=SCALES[i],
+            latent_cache=LatentCache(),
+            generator=torch.Generator().manual_seed(10 + i),
+            **params,
+        ).images
+        for i in range(3)
+    ]
+    requests = [
+        GenerationRequest(PROMPTS[i], conditions(i), SCALES[i], seed=10 + i)
+        for i in range(3)
+    ]
+    batch = generate_batch(pipe, requests, latent_cache=LatentCache(), **params).images
+    assert batch.shape[0] == 3
+    for i, single in enumerate(singles):
+        torch.testing.assert_close(batch[i : i + 1], single)
+
+
+def test_generate_batch_rejects_mixed_conditions(pipe, image):
+    requests = [
+        GenerationRequest("a cat", [Condition("subject", image(64))]),
+        GenerationRequest("a dog"),
+    ]
+    with pytest.raises(ValueError):
+        generate_batch(pipe, requests, num_inference_steps=1, height=64, width=64)
+
+
+@pytest.mark.parametrize("condition_scale", [[1.5, 0.5], SCALES])
+def test_image_guidance_with_per_sample_conditions(pipe, image, condition_scale):
+    # one flat condition_scale shared by the batch or one list per sample,
+    # doubled with the batch for the unconditional pass
+    def conditions(i):
+        return [
+            Condition("subject", image(64, i), position_delta=(0, 4)),
+            Condition("subject", image(64, i + 10), position_delta=(0, -4)),
+        ]
+
+    params = dict(
+        num_inference_steps=2,
+        height=64,
+        width=64,
+        image_guidance_scale=1.5,
+        model_config={"union_cond_attn": True},
+        default_lora=True,
+        output_type="latent",
+    )
+    per_sample = isinstance(condition_scale[0], list)
+    scales = condition_scale if per_sample else [condition_scale] * 3
+    singles = [
+        generate(
+            pipe,
+            prompt=PROMPTS[i],
+            conditions=conditions(i),
+            condition_scale=scales[i],
+            latent_cache=LatentCache(),
+            generator=torch.Generator().manual_seed(10 + i),
+            **params,
+        ).images
+        for i in range(3)
+    ]
+    batch = generate(
+        pipe,
+        prompt=PROMPTS,
+        conditions=[conditions(i) for i in range(3)],
+        condition_scale=condition_scale,
+        latent_cache=LatentCache(),
+        generator=[torch.Generator().manual_seed(10 + i) for i in range(3)],
+        **params,
+    ).images
+    assert batch.shape[0] == 3
+    for i, single in enumerate(singles):
+        torch.testing.assert_close(batch[i : i + 1], single)
@@ -0,0 +1,102 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from flux.block import segmented_attention
+from flux.layout import AttentionLayout
+
+
+@pytest.mark.parametrize(
+    "model_config",
+    [{"union_cond_attn": False}, {"independent_condition": True}, {}],
+)
+@pytest.mark.parametrize("condition_scale", [[1.5, 0.5], [0.0, 2.0], [1, 1]])
+def test_segmented_attention_matches_dense_mask(model_config, condition_scale):
+    def layout(**config):
+        return AttentionLayout(
+            text_n=5,
+            image_n=7,
+            condition_sizes=[6, 4],
+            model_config=dict(model_config, **config),
+            condition_scale=condition_scale,
+        )
+
+    segmented, dense = layout(), layout(dense_attention_mask=True)
+    if not segmented.segmented:
+        assert dense.attention_mask is None
+        return
+    torch.manual_seed(0)
+    query = torch.randn(2, 2, segmented.sequence_n, 24)
+    key, value = torch.randn_like(query), torch.randn_like(query)
+    # full sequence, and the text and image queries only
+    for query_n in (segmented.sequence_n, segmented.main_n):
+        torch.testing.assert_close(
+            segmented_attention(query[:, :, :query_n], key, value, segmented),
+            F.scaled_dot_product_attention(
+                query[:, :, :query_n], key, value, attn_mask=dense.mask(query_n)
+            ),
+        )
+
+
+def reference_mask(model_config, condition_scale, main_n, condition_sizes):
+    # the mask as built in each attention call: boolean structure, then the
+    # log scale between the main segment and each condition
+    sequence_n = main_n + sum(condition_sizes)
+    allowed = torch.ones(sequence_n, sequence_n, dtype=torch.bool)
+    if not model_config.get("union_cond_attn", True):
+        allowed[main_n:, :main_n] = False
+        allowed[:main_n, main_n:] = False
+    elif model_config.get("independent_condition", False):
+        allowed[main_n:, :main_n] = False
+    bias = torch.zeros(sequence_n, sequence_n)
+    start = main_n
+    for size, scale in zip(condition_sizes, condition_scale):
+        end = start + size
+        bias[start:end, :main_n] = torch.log(torch.tensor(float(scale)))
+        bias[:main_n, start:end] = torch.log(torch.tensor(float(scale)))
+        start = end
+    return bias.masked_fill(~allowed, float("-inf"))
+
+
+@pytest.mark.parametrize(
+    "model_config",
+    [{"union_cond_attn": False}, {"independent_condition": True}, {}],
+)
+@pytest.mark.parametrize("condition_scale", [[1.5, 0.5], [0.0, 2.0], [1, 1]])
+def test_prebuilt_mask_matches_reference(model_config, condition_scale):
+    layout = AttentionLayout(
+        text_n=5,
+        image_n=7,
+        condition_sizes=[6, 4],
+        model_config=dict(model_config, dense_attention_mask=True),
+        condition_scale=condition_scale,
+    )
+    expected = reference_mask(model_config, condition_scale, 12, [6, 4])
+    mask = layout.attention_mask
+    if mask is None:
+        assert (expected == 0).all()
+        return
+    if mask.dtype == torch.bool:
+        assert torch.equal(mask, expected == 0)
+    else:
+        torch.testing.assert_close(mask, expected)
+    # built once, the replayed steps only take the main rows
+    assert layout.mask(layout.main_n).data_ptr() == mask.data_ptr()
+    assert torch.equal(layout.mask(layout.main_n), mask[: layout.main_n])
+
+
+def test_prebuilt_mask_per_sample_scales():
+    scales = [[1.5, 0.5], [1, 1], [0.3, 2.0]]
+    layout = AttentionLayout(
+        text_n=5,
+        image_n=7,
+        condition_sizes=[6, 4],
+        model_config={"dense_attention_mask": True},
+        condition_scale=scales,
+    )
+    mask = layout.attention_mask
+    assert mask.shape == (3, 1, 22, 22)
+    for sample, scale in enumerate(scales):
+        expected = reference_mask({}, scale, 12, [6, 4])
+        torch.testing.assert_close(mask[sample, 0], expected)
+    assert layout.mask(12).shape == (3, 1, 12, 22)
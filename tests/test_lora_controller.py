@@ -0,0 +1,181 @@
+import pytest
+import torch
+from peft import LoraConfig
+from peft.tuners.tuners_utils import BaseTunerLayer
+
+from flux.cache import LatentCache
+from flux.condition import Condition
+from flux.generate import generate
+import flux.lora_controller
+from flux.lora_controller import (
+    FusedLoRA,
+    StreamScaling,
+    enable_lora,
+    image_lora_sites,
+    lora_registry,
+    set_lora_scale,
+)
+
+
+@pytest.mark.parametrize(
+    "model_config",
+    [{}, {"fuse_streams": True}, {"latent_lora": True}],
+)
+@pytest.mark.parametrize("scale", [1.0, 3.0])
+def test_fused_lora_matches_lora_layers(lora_pipe, image, model_config, scale):
+    transformer = lora_pipe.transformer
+    lora_modules = [
+        module for module in transformer.modules() if isinstance(module, BaseTunerLayer)
+    ]
+    conditions = [
+        Condition("subject", image(64), position_delta=(0, 4)),
+        Condition("subject", image(32, 3), position_delta=(0, -4)),
+    ]
+
+    def run():
+        return generate(
+            lora_pipe,
+            prompt="a cat",
+            conditions=conditions,
+            num_inference_steps=3,
+            height=64,
+            width=64,
+            model_config=model_config,
+            default_lora=True,
+            output_type="latent",
+            latent_cache=LatentCache(),
+            generator=torch.Generator().manual_seed(0),
+        ).images
+
+    base = run()
+    with set_lora_scale(lora_modules, scale):
+        expected = run()
+    fused = FusedLoRA(transformer, latent_lora=model_config.get("latent_lora", False))
+    with fused.activate(scale):
+        torch.testing.assert_close(run(), expected)
+    # the original weights are restored
+    torch.testing.assert_close(run(), base, rtol=0, atol=0)
+
+
+def test_fused_lora_variants(lora_pipe):
+    fused = FusedLoRA(lora_pipe.transformer)
+    for scale in (2.0, 3.0, 2.0, 4.0):
+        fused.activate(scale)
+    assert list(fused.variants) == [(("subject",), 2.0), (("subject",), 4.0)]
+    fused.deactivate()
+
+
+@pytest.mark.parametrize("target_modules", [["proj_mlp"], ["to_q", "proj_mlp", "ff.net.2"]])
+@pytest.mark.parametrize("model_config", [{}, {"fuse_streams": True}])
+def test_fused_lora_with_partial_targets(pipe, image, target_modules, model_config):
+    # groups of `enable_lora` mix LoRA and plain layers, e.g.
+    # (norm.linear, proj_mlp) with only proj_mlp targeted
+    torch.manual_seed(1)
+    pipe.transformer.add_adapter(
+        LoraConfig(
+            r=4, lora_alpha=4, init_lora_weights=False, target_modules=target_modules
+        ),
+        adapter_name="subject",
+    )
+
+    def run():
+        return generate(
+            pipe,
+            prompt="a cat",
+            conditions=[Condition("subject", image(64), position_delta=(0, 4))],
+            num_inference_steps=2,
+            height=64,
+            width=64,
+            model_config=model_config,
+            default_lora=True,
+            output_type="latent",
+            latent_cache=LatentCache(),
+            generator=torch.Generator().manual_seed(0),
+        ).images
+
+    expected = run()
+    with FusedLoRA(pipe.transformer).activate(1.0):
+        torch.testing.assert_close(run(), expected)
+
+
+def test_fused_lora_bf16_drift(lora_pipe, image):
+    # the rounding of the merged bf16 weights is not cancelled on the image
+    # stream, the drift from fp32 stays close to the one of the unmerged path
+    encode_prompt = lora_pipe.encode_prompt
+
+    def run():
+        return generate(
+            lora_pipe,
+            prompt="a cat",
+            conditions=[Condition("subject", image(64), position_delta=(0, 4))],
+            num_inference_steps=4,
+            height=64,
+            width=64,
+            default_lora=True,
+            output_type="latent",
+            latent_cache=LatentCache(),
+            generator=torch.Generator().manual_seed(0),
+        ).images.float()
+
+    expected = run()
+    lora_pipe.to(torch.bfloat16)
+    lora_pipe.encode_prompt = lambda *args, **kwargs: tuple(
+        each.to(torch.bfloat16) for each in encode_prompt(*args, **kwargs)
+    )
+    unmerged = (run() - expected).abs().mean()
+    with FusedLoRA(lora_pipe.transformer).activate(1.0):
+        fused = (run() - expected).abs().mean()
+    assert unmerged < 0.01
+    assert fused < 1.5 * unmerged
+
+
+@torch.no_grad()
+def test_registry_follows_adapter_changes(pipe, monkeypatch):
+    transformer = pipe.transformer
+    scans = []
+    monkeypatch.setattr(
+        flux.lora_controller,
+        "image_lora_sites",
+        lambda transformer: scans.append(1) or image_lora_sites(transformer),
+    )
+
+    def add_adapter(name, target_modules):
+        torch.manual_seed(len(scans))
+        transformer.add_adapter(
+            LoraConfig(
+                r=4, lora_alpha=4, init_lora_weights=False, target_modules=target_modules
+            ),
+            adapter_name=name,
+        )
+
+    def check_bypass():
+        registry = lora_registry(transformer)
+        sites = [
+            site for site in image_lora_sites(transformer) if site in registry.modules
+        ]
+        assert sites
+        for site in sites:
+            assert isinstance(site.scaling, StreamScaling)
+            x = torch.randn(2, site.in_features)
+            with enable_lora((site,), False):
+                torch.testing.assert_close(site(x), site.base_layer(x))
+            assert not torch.allclose(site(x), site.base_layer(x))
+
+    add_adapter("subject", ["to_q"])
+    check_bypass()
+    lora_registry(transformer)
+    assert len(scans) == 1
+
+    # layers that become LoRA layers with the second adapter are registered
+    add_adapter("default", ["to_q", "proj_mlp"])
+    transformer.set_adapters(["subject", "default"], weights=[1.0, 2.0])
+    check_bypass()
+    assert len(scans) == 2
+    assert any(
+        site is block.proj_mlp
+        for site in lora_registry(transformer).modules
+        for block in transformer.single_transformer_blocks
+    )
+    transformer.set_adapters("default", weights=0.5)
+    check_bypass()
+    assert len(scans) == 2
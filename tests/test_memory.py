@@ -0,0 +1,19 @@
+import threading
+
+import torch
+
+from flux.memory import MemoryTracer, count_transient
+
+
+def test_count_transient_is_per_thread():
+    tensor = torch.zeros(256)
+    with MemoryTracer("cpu", large_tensor_bytes=1024) as memory:
+        count_transient("attention", tensor, torch.zeros(8))
+        # forward passes of other threads are not counted
+        thread = threading.Thread(target=count_transient, args=("other", tensor))
+        thread.start()
+        thread.join()
+    count_transient("attention", tensor)
+    assert memory.transients == {
+        "attention": {"count": 1, "max_bytes": 1024, "total_bytes": 1024}
+    }
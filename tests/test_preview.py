@@ -0,0 +1,63 @@
+import numpy as np
+import torch
+from PIL import Image
+
+from flux.generate import generate_stream
+from flux.pipeline_tools import encode_images
+from flux.preview import LatentPreviewer, Preview
+
+
+def test_preview_projects_each_latent_pixel():
+    torch.manual_seed(0)
+    latents = torch.randn(2, 16, 6, 5)
+    previewer = LatentPreviewer()
+    previews = previewer(latents)
+    assert len(previews) == 2 and previews[0].size == (5, 6)
+    rgb = latents[1, :, 4, 3] @ previewer.factors + previewer.bias
+    expected = ((rgb + 1) * 127.5).clamp(0, 255).to(torch.uint8)
+    assert np.array(previews[1])[4, 3].tolist() == expected.tolist()
+
+    upscaled = LatentPreviewer(upscale=4)(latents)
+    assert upscaled[0].size == (20, 24)
+    assert np.array_equal(np.array(upscaled[0])[::4, ::4], np.array(previews[0]))
+
+
+@torch.no_grad()
+def test_fit_approximates_the_vae(pipe, image):
+    images = [image(64, seed) for seed in range(4)]
+    previewer = LatentPreviewer.fit(pipe, images, upscale=8)
+    assert previewer.factors.shape == (16, 3) and previewer.bias.shape == (3,)
+
+    latents, _ = encode_images(pipe, images, deterministic=True)
+    latents = pipe._unpack_latents(latents, 64, 64, pipe.vae_scale_factor)
+    assert latents.shape == (4, 16, 8, 8)
+
+    def error(previewer):
+        previews = np.stack([np.array(each) for each in previewer(latents)])
+        pixels = np.stack([np.array(each.resize((8, 8), Image.BOX)) for each in images])
+        return np.abs(previews.astype(float) - pixels).mean()
+
+    # the fit is a least-squares solution, it beats the FLUX factors on a VAE
+    # it was fitted on
+    assert previewer(latents)[0].size == (64, 64)
+    assert error(LatentPreviewer.fit(pipe, images)) < error(LatentPreviewer())
+
+
+def test_generate_stream_yields_previews(pipe):
+    outputs = list(
+        generate_stream(
+            pipe,
+            prompt=["a cat", "a dog"],
+            height=64,
+            width=64,
+            num_inference_steps=3,
+            preview_steps=[0, 2],
+            previewer=LatentPreviewer(upscale=8),
+            generator=torch.Generator().manual_seed(0),
+        )
+    )
+    previews = [output for output in outputs if isinstance(output, Preview)]
+    assert [preview.step for preview in previews] == [0, 2]
+    for preview in previews:
+        assert [each.size for each in preview.images] == [(64, 64)] * 2
+    assert not isinstance(outputs[-1], Preview)
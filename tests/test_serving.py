@@ -0,0 +1,77 @@
+import pytest
+import torch
+
+from flux.cache import LatentCache
+from flux.condition import Condition
+from flux.generate import GenerationRequest, generate_batch
+from flux.serving import BatchingServer, batch_key, pipeline_runner
+
+
+def test_served_requests_match_generate_batch(pipe, image):
+    def request(i):
+        conditions = [
+            Condition("subject", image(64, i), position_delta=(0, 4)),
+            Condition("subject", image(64, i + 10), position_delta=(0, -4)),
+        ]
+        return GenerationRequest(f"prompt {i}", conditions, [1, 1 + i / 10], seed=i)
+
+    params = dict(
+        num_inference_steps=2,
+        height=64,
+        width=64,
+        model_config={"union_cond_attn": True},
+        default_lora=True,
+        output_type="latent",
+        latent_cache=LatentCache(),
+    )
+    requests = [request(i) for i in range(5)]
+    other = GenerationRequest("other size", seed=1)
+    server = BatchingServer(pipeline_runner(pipe), max_batch_size=3, max_wait=0.05)
+    # queued before the worker starts, so the grouping does not depend on timing
+    futures = [server.submit(each, **params) for each in requests]
+    other_future = server.submit(other, **dict(params, height=32, width=32))
+    with server:
+        results = [future.result() for future in futures]
+        other_result = other_future.result()
+    assert sorted(server.batch_sizes) == [1, 2, 3]
+
+    for each, result in zip(requests, results):
+        expected = generate_batch(pipe, [each], **params).images[0]
+        torch.testing.assert_close(result, expected)
+    expected = generate_batch(pipe, [other], **dict(params, height=32, width=32))
+    torch.testing.assert_close(other_result, expected.images[0])
+
+
+def test_errors_reach_every_request():
+    def fail(requests, **params):
+        raise RuntimeError("boom")
+
+    with BatchingServer(fail, max_batch_size=2) as server:
+        futures = [server.submit(GenerationRequest(f"p{i}")) for i in range(3)]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="boom"):
+                future.result()
+    with pytest.raises(RuntimeError):
+        server.submit(GenerationRequest("stopped"))
+
+
+def test_batch_key(image):
+    def request(condition):
+        return GenerationRequest("a cat", [Condition("subject", condition)])
+
+    params = dict(height=64, model_config={"union_cond_attn": True})
+    same = dict(height=64, model_config={"union_cond_attn": True})
+    key = batch_key(request(torch.zeros(3, 64, 64)), params)
+    # conditions by type and size, parameters by content
+    assert batch_key(request(torch.ones(3, 64, 64)), same) == key
+    assert batch_key(request(torch.ones(3, 32, 64)), params) != key
+    assert batch_key(request(image(64)), params) == batch_key(request(image(64, 1)), same)
+    assert batch_key(request(torch.zeros(3, 64, 64)), dict(params, height=32)) != key
+    # objects such as caches by identity
+    cache = LatentCache()
+    assert batch_key(request(image(64)), dict(params, latent_cache=cache)) == batch_key(
+        request(image(64)), dict(params, latent_cache=cache)
+    )
+    assert batch_key(
+        request(image(64)), dict(params, latent_cache=LatentCache())
+    ) != batch_key(request(image(64)), dict(params, latent_cache=cache))
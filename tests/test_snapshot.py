@@ -0,0 +1,73 @@
+import base64
+import pickle
+import numpy as np
+import pytest
+import torch
+from torch.testing._internal.two_tensor import TwoTensor
+
+from flux.cache import LatentCache
+from flux.condition import Condition
+from flux.generate import generate
+from flux.lora_controller import FusedLoRA
+from flux.snapshot import (
+    flatten_tensor,
+    import_class,
+    load_snapshot,
+    save_snapshot,
+    unflatten_tensor,
+)
+
+
+def run(pipeline, image):
+    return np.array(
+        generate(
+            pipeline,
+            prompt="a cat",
+            conditions=[Condition("subject", image(64, 3), position_delta=[0, -4])],
+            height=64,
+            width=64,
+            num_inference_steps=2,
+            model_config={"union_cond_attn": True},
+            default_lora=True,
+            latent_cache=LatentCache(),
+            generator=torch.Generator().manual_seed(0),
+        ).images[0]
+    )
+
+
+def test_snapshot_roundtrip(lora_pipe, image, tmp_path):
+    fused = FusedLoRA(lora_pipe.transformer).activate(1.0)
+    expected = run(lora_pipe, image)
+    save_snapshot(lora_pipe, str(tmp_path), fused)
+
+    loaded = load_snapshot(str(tmp_path))
+    loaded.encode_prompt = lora_pipe.encode_prompt
+    assert loaded.transformer.active_adapters() == ["subject"]
+    # the base weights were saved unmerged, the adapters merge again
+    loaded_fused = FusedLoRA(loaded.transformer).activate(1.0)
+    assert np.array_equal(run(loaded, image), expected)
+
+    fused.deactivate()
+    loaded_fused.deactivate()
+    assert np.array_equal(run(loaded, image), run(lora_pipe, image))
+
+
+def test_tensor_subclass_roundtrip():
+    tensor = TwoTensor(torch.randn(3, 4), torch.randn(3, 4))
+    tensors, subclasses = {}, {}
+    flatten_tensor("weight", tensor, tensors, subclasses)
+    restored = unflatten_tensor("weight", tensors, subclasses)
+    assert type(restored) is TwoTensor
+    assert torch.equal(restored.a, tensor.a) and torch.equal(restored.b, tensor.b)
+
+
+def test_untrusted_classes_are_rejected():
+    with pytest.raises(ValueError):
+        import_class("os.system")
+    tensors, subclasses = {}, {}
+    flatten_tensor(
+        "weight", TwoTensor(torch.ones(2), torch.ones(2)), tensors, subclasses
+    )
+    subclasses["weight"]["context"] = base64.b64encode(pickle.dumps(print)).decode()
+    with pytest.raises(pickle.UnpicklingError):
+        unflatten_tensor("weight", tensors, subclasses)
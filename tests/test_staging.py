@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from flux.cache import LatentCache, PromptCache
+from flux.condition import Condition
+from flux.generate import GenerationRequest, generate_batch
+from flux.staging import StagedExecutor, GenerationStages
+
+
+def test_staged_generation_matches_generate_batch(pipe, image):
+    def requests(i):
+        return [
+            GenerationRequest(
+                f"prompt {i} {j}",
+                [Condition("subject", image(64, i * 10 + j), position_delta=[0, -4])],
+                seed=i * 10 + j,
+            )
+            for j in range(2)
+        ]
+
+    params = dict(
+        num_inference_steps=3,
+        height=64,
+        width=64,
+        model_config={"union_cond_attn": True},
+        default_lora=True,
+    )
+    expected = [
+        generate_batch(
+            pipe,
+            requests(i),
+            latent_cache=LatentCache(),
+            prompt_cache=PromptCache(),
+            **params,
+        ).images
+        for i in range(4)
+    ]
+    stages = GenerationStages(pipe)
+    with StagedExecutor(stages.run, stages.prepare, stages.finish) as executor:
+        futures = [executor.submit((requests(i), params)) for i in range(4)]
+        results = [future.result() for future in futures]
+    for images, expected_images in zip(results, expected):
+        assert len(images) == len(expected_images)
+        for image_, expected_image in zip(images, expected_images):
+            assert np.array_equal(np.array(image_), np.array(expected_image))
+    assert all(stage["count"] == 4 for stage in executor.stats.values())
+
+
+def test_stage_errors_propagate():
+    def run(value):
+        return 1 / (value - 2)
+
+    with StagedExecutor(run, prepare=lambda value: value + 1, max_pending=1) as executor:
+        with pytest.raises(ZeroDivisionError):
+            executor.submit(1).result()
+        # the slot of the failed item is released
+        assert executor.submit(2).result() == 1.0
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+import torch
+
+from flux.cache import LatentCache, StepCache
+from flux.condition import Condition
+from flux.generate import generate
+from flux.streaming import BlockStreamer
+
+
+@torch.no_grad()
+def test_streamed_forward_matches(pipe, forward):
+    transformer = pipe.transformer
+    weight = transformer.transformer_blocks[0].attn.to_q.weight
+    host = weight.data_ptr()
+    expected = forward(transformer)
+
+    streamer = BlockStreamer(transformer, prefetch=1)
+    assert torch.equal(forward(transformer, block_streamer=streamer), expected)
+    # every block loaded once, plus the prefetch of the first one for the
+    # next step; only the first block was waited for
+    assert streamer.stats == {"blocks": 4, "loads": 5, "waits": 1}
+    assert list(streamer.pending) == [0]
+    assert weight.data_ptr() == host
+
+    assert torch.equal(forward(transformer, block_streamer=streamer), expected)
+    assert streamer.stats == {"blocks": 4, "loads": 9, "waits": 1}
+
+
+@torch.no_grad()
+def test_step_cache_loads_first_block_once(pipe, forward):
+    transformer = pipe.transformer
+    streamer = BlockStreamer(transformer, prefetch=1)
+    loaded = []
+    load = streamer.load
+
+    def record(index):
+        loaded.append(index)
+        return load(index)
+
+    streamer.load = record
+    step_cache = StepCache(threshold=1e9)
+    forward(transformer, step_cache=step_cache, block_streamer=streamer)
+    assert loaded == [0, 1, 2, 3, 0]
+
+    # skipped: the probe reuses the prefetched first block, the prefetch of
+    # the second one is dropped
+    forward(transformer, step_cache=step_cache, block_streamer=streamer)
+    assert step_cache.skipped == 1
+    assert loaded == [0, 1, 2, 3, 0, 1]
+    assert not streamer.pending and not streamer.active
+
+
+def test_streamed_generate_matches(pipe, image):
+    def run(**kwargs):
+        return np.array(
+            generate(
+                pipe,
+                prompt="a cat",
+                conditions=[Condition("subject", image(64, 3), position_delta=[0, -4])],
+                height=64,
+                width=64,
+                num_inference_steps=3,
+                model_config={"union_cond_attn": True},
+                default_lora=True,
+                latent_cache=LatentCache(),
+                generator=torch.Generator().manual_seed(0),
+                **kwargs,
+            ).images[0]
+        )
+
+    expected = run()
+    streamer = BlockStreamer(pipe.transformer, prefetch=2)
+    assert np.array_equal(run(block_streamer=streamer), expected)
+    assert streamer.stats["waits"] == 1
+
+
+@torch.no_grad()
+def test_first_block_released_on_error(pipe, forward):
+    transformer = pipe.transformer
+    weight = transformer.transformer_blocks[0].attn.to_q.weight
+    streamer = BlockStreamer(transformer, prefetch=1)
+    host = weight.data_ptr()
+
+    class FailingStepCache(StepCache):
+        def skip(self, modulated):
+            raise RuntimeError("probe failed")
+
+    with pytest.raises(RuntimeError) as error:
+        forward(transformer, step_cache=FailingStepCache(), block_streamer=streamer)
+    # the traceback keeps the frames, and whatever they did not release, alive
+    assert error.tb is not None
+    assert not streamer.active
+    assert weight.data_ptr() == host
+
+
+@torch.no_grad()
+def test_deleted_adapter_params_are_dropped(lora_pipe, forward):
+    transformer = lora_pipe.transformer
+    streamer = BlockStreamer(transformer, prefetch=1)
+    forward(transformer, block_streamer=streamer)
+    transformer.delete_adapters("subject")
+    expected = forward(transformer)
+    assert torch.equal(forward(transformer, block_streamer=streamer), expected)
+    streamer.clear()
+    params = set(transformer.parameters())
+    hosts = [param for host in streamer.host.values() for param in host]
+    assert hosts and all(param in params for param in hosts)
@@ -0,0 +1,78 @@
+import pytest
+import torch
+
+from flux.generate import decode_latents
+from flux.pipeline_tools import encode_images
+from flux.tiling import VAETiling, peak_bytes
+
+BUDGET = 4 * 1024**2
+
+
+def image_bytes(size: int) -> int:
+    return 3 * size * size * 4
+
+
+@torch.no_grad()
+def test_tile_size_from_budget(pipe):
+    tiling = VAETiling(BUDGET)
+    tile = tiling.apply(pipe.vae)
+    assert tile % 64 == 0 and tile >= tiling.min_tile
+    # the largest multiple of 64 whose activations fit in the budget
+    assert tiling.measured * tile**2 <= BUDGET or tile == tiling.min_tile
+    assert tiling.measured * (tile + 64) ** 2 > BUDGET
+    assert pipe.vae.use_tiling and pipe.vae.tile_sample_min_size == tile
+    assert pipe.vae.tile_latent_min_size == tile // 8
+
+
+@pytest.mark.parametrize("stage", ["encode", "decode"])
+@torch.no_grad()
+def test_tiled_peak_memory_is_flat(pipe, image, stage):
+    cpu = torch.device("cpu")
+    sizes = (384, 768)
+    latents = {
+        size: encode_images(pipe, [image(size, 1)], deterministic=True)[0]
+        for size in sizes
+    }
+    tile = VAETiling(BUDGET).apply(pipe.vae)
+    assert tile < sizes[0]
+
+    def peak(size):
+        if stage == "encode":
+            return peak_bytes(
+                lambda: encode_images(pipe, [image(size, 1)], deterministic=True), cpu
+            )
+        return peak_bytes(
+            lambda: decode_latents(pipe, latents[size], size, size, "pt"), cpu
+        )
+
+    # only the buffers of the size of the image grow with it (input, decoded
+    # tiles, blended output), untiled the activations grow about 16 times
+    # the image bytes on this VAE
+    growth = peak(sizes[1]) - peak(sizes[0])
+    assert growth <= 5 * (image_bytes(sizes[1]) - image_bytes(sizes[0]))
+
+
+@torch.no_grad()
+def test_tiled_decode_blends_tiles(pipe):
+    # normalization statistics and attention are global, without them the
+    # decoder is local and the tiles only differ from the full decode near
+    # their borders, where the overlap is blended
+    vae = pipe.vae
+    for module in list(vae.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, torch.nn.GroupNorm):
+                setattr(module, name, torch.nn.Identity())
+    for attention in vae.decoder.mid_block.attentions:
+        attention.to_out[0].weight.zero_()
+        attention.to_out[0].bias.zero_()
+    torch.manual_seed(0)
+    latents = torch.randn(1, 16, 64, 64)
+    expected = vae.decode(latents).sample
+
+    tile = VAETiling(BUDGET).apply(vae)
+    assert tile < 64 * 8
+    error = (vae.decode(latents).sample - expected).abs().mean()
+    assert error < 0.05 * expected.abs().mean()
+    vae.tile_overlap_factor = 0.0
+    unblended = (vae.decode(latents).sample - expected).abs().mean()
+    assert error < unblended / 2
@@ -0,0 +1,62 @@
+import json
+
+import torch
+
+from flux.cache import LatentCache, StepCache
+from flux.condition import Condition
+from flux.generate import generate
+from flux.tracing import NULL_SPAN, Tracer, span
+
+
+def test_span_without_tracer_is_shared_noop():
+    assert span(None, "step") is NULL_SPAN
+
+
+def test_generate_chrome_trace_round_trip(pipe, image, tmp_path):
+    tracer = Tracer()
+    generate(
+        pipe,
+        prompt="a cat",
+        conditions=[Condition("subject", image(64), position_delta=(0, 4))],
+        height=64,
+        width=64,
+        num_inference_steps=3,
+        model_config={"union_cond_attn": True},
+        default_lora=True,
+        latent_cache=LatentCache(),
+        step_cache=StepCache(threshold=1e9),
+        generator=torch.Generator().manual_seed(0),
+        tracer=tracer,
+    )
+    path = tmp_path / "trace.json"
+    tracer.save(str(path))
+    with open(path) as f:
+        trace = json.load(f)
+    assert trace == json.loads(json.dumps(tracer.chrome_trace()))
+    events = trace["traceEvents"]
+    assert len(events) == len(tracer)
+
+    spans = [event for event in events if event["ph"] == "X"]
+    assert all(event["dur"] >= 0 for event in spans)
+    summary = tracer.summary()
+    for name in ["encode_prompt", "encode_conditions", "vae_decode"]:
+        assert summary[name]["count"] == 1
+    assert summary["denoising_step"]["count"] == 3
+    # the first step runs every block, the next ones are skipped
+    assert summary["double_block"]["count"] == 2
+    assert summary["single_block"]["count"] == 2
+    assert [event["name"] for event in events if event["ph"] == "i"] == [
+        "step_cache_skip"
+    ] * 2
+
+    # the blocks are nested in the first denoising step
+    steps = [event for event in spans if event["name"] == "denoising_step"]
+    assert [step["args"]["step"] for step in steps] == [0, 1, 2]
+    first = steps[0]
+    for event in spans:
+        if event["name"].endswith("_block"):
+            assert first["ts"] <= event["ts"]
+            assert event["ts"] + event["dur"] <= first["ts"] + first["dur"]
+
+    tracer.clear()
+    assert len(tracer) == 0 and tracer.summary() == {}